@@ -0,0 +1,68 @@
+import hashlib
+import json
+
+# Local aggregation of the classification results. The counts, confidence
+# histogram and no-match rate are computed here without calling the model, the
+# optional narrative is written from this aggregate so its prompt stays the same
+# size however many symbols a plan has.
+
+HISTOGRAM_BINS = 10
+
+def is_no_match(label):
+    return not label or label.strip().strip(".").lower() == "no match"
+
+def normalize_label(label):
+    return " ".join((label or "").split()).upper()
+
+def confidence_histogram(probabilities, bins=HISTOGRAM_BINS):
+    counts = [0] * bins
+    for probability in probabilities:
+        counts[min(bins - 1, max(0, int(probability * bins)))] += 1
+    return {f"{index / bins:.1f}-{(index + 1) / bins:.1f}": count for index, count in enumerate(counts)}
+
+def aggregate_results(object_results):
+    symbols = {}
+    tags = {}
+    no_match = 0
+    probabilities = []
+    for result in object_results:
+        tag = result.get("tag")
+        probability = float(result.get("probability") or 0)
+        probabilities.append(probability)
+        tags[tag] = tags.get(tag, 0) + 1
+        if is_no_match(result.get("model_response")):
+            no_match += 1
+            continue
+        label = normalize_label(result["model_response"])
+        symbol = symbols.setdefault(label, {"label": label, "count": 0, "tags": {}, "confidence": 0.0})
+        symbol["count"] += 1
+        symbol["tags"][tag] = symbol["tags"].get(tag, 0) + 1
+        symbol["confidence"] += probability
+
+    total = len(object_results)
+    return {
+        "detections": total,
+        "symbols": [{"label": symbol["label"],
+                     "count": symbol["count"],
+                     "tags": dict(sorted(symbol["tags"].items())),
+                     "mean_confidence": round(symbol["confidence"] / symbol["count"], 3)}
+                    for symbol in sorted(symbols.values(), key=lambda symbol: (-symbol["count"], symbol["label"]))],
+        "tags": dict(sorted(tags.items(), key=lambda item: (-item[1], str(item[0])))),
+        "no_match": {"count": no_match, "rate": round(no_match / total, 3) if total else 0.0},
+        "mean_confidence": round(sum(probabilities) / total, 3) if total else 0.0,
+        "confidence_histogram": confidence_histogram(probabilities),
+    }
+
+def aggregate_hash(aggregate):
+    return hashlib.sha256(json.dumps(aggregate, sort_keys=True).encode("utf-8")).hexdigest()
+
+def format_aggregate(aggregate):
+    # Markdown summary of the aggregate, shown as is when the narrative is off
+    # and given to the model as the input of the narrative
+    lines = [f"{aggregate['detections']} symbols detected, "
+             f"{aggregate['no_match']['count']} without a legend match ({aggregate['no_match']['rate']:.0%}), "
+             f"mean confidence {aggregate['mean_confidence']:.0%}.", ""]
+    for symbol in aggregate["symbols"]:
+        tags = ", ".join(f"{tag} {count}" for tag, count in symbol["tags"].items())
+        lines.append(f"- {symbol['label']}: {symbol['count']} (detected as {tags}, mean confidence {symbol['mean_confidence']:.0%})")
+    return "\n".join(lines)
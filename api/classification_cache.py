@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Cache for symbol classifications. Entries are keyed by a perceptual hash of the
+# normalized crop, the legend ID and the prompt, so a symbol that was already
+# classified against the same legend and prompt never goes back to the model.
+
+def perceptual_hash(image_bytes, hash_size=8):
+    # Difference hash of the crop after normalizing it to a small black and white image.
+    # Thresholding removes the JPEG noise and trimming to the ink makes the hash
+    # independent of where the symbol sits inside its bounding box.
+    image = Image.open(BytesIO(image_bytes)).convert("L")
+    image = ImageOps.autocontrast(image).point(lambda p: 255 if p > 127 else 0)
+    ink_box = ImageOps.invert(image).getbbox()
+    if ink_box:
+        image = image.crop(ink_box)
+    image = image.resize((hash_size + 1, hash_size), Image.BOX)
+    pixels = list(image.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+def cache_key(crop_hash, legend_id, prompt):
+    prompt_hash = hashlib.sha256((prompt or "").encode("utf-8")).hexdigest()[:16]
+    return f"{crop_hash}-{legend_id}-{prompt_hash}"
+
+class MemoryCacheBackend:
+    def __init__(self, max_entries=10000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class DiskCacheBackend:
+    # The entries are counted in memory so a write doesn't list the directory,
+    # once the count goes over max_entries the oldest entries are removed down to
+    # evict_to, which leaves room for max_entries // 10 writes before the next listing
+    def __init__(self, directory, max_entries=100000, ttl=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.evict_to = max_entries - max(1, max_entries // 10)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._count = len(self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _entries(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".json")]
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if self.ttl and time.time() - stored_at > self.ttl:
+                os.remove(path)
+                with self._lock:
+                    self._count -= 1
+                return None
+            with open(path, "r") as f:
+                value = json.load(f)
+            # Touch the entry so eviction removes the least recently used ones
+            os.utime(path)
+            return value
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            path = self._path(key)
+            is_new = not os.path.exists(path)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+            if is_new:
+                self._count += 1
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # The listing also corrects the count for entries written or removed by
+        # other workers sharing the directory
+        entries = self._entries()
+        self._count = len(entries)
+        if self._count <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:self._count - self.evict_to]:
+            try:
+                os.remove(path)
+                self._count -= 1
+            except OSError:
+                pass
+
+class BlobCacheBackend:
+    # Size based eviction is left to a lifecycle management rule on the prefix,
+    # the TTL is checked against the blob's last modified time on read
+    def __init__(self, container_client, prefix="classification-cache", ttl=None):
+        self.container_client = container_client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        blob_client = self.container_client.get_blob_client(f"{self.prefix}/{key}.json")
+        try:
+            downloader = blob_client.download_blob()
+            if self.ttl and time.time() - downloader.properties.last_modified.timestamp() > self.ttl:
+                return None
+            return json.loads(downloader.readall())
+        except Exception:
+            return None
+
+    def set(self, key, value):
+        blob_client = self.container_client.get_blob_client(f"{self.prefix}/{key}.json")
+        blob_client.upload_blob(json.dumps(value), overwrite=True)
+
+class ClassificationCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self.backend.get(key) if self.backend else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.backend:
+            self.backend.set(key, value)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+def create_classification_cache(container_client_factory=None):
+    # CLASSIFICATION_CACHE_BACKEND is one of memory, disk, blob or none
+    backend_name = os.environ.get("CLASSIFICATION_CACHE_BACKEND", "memory").lower()
+    ttl = float(os.environ.get("CLASSIFICATION_CACHE_TTL", 0)) or None
+    max_entries = int(os.environ.get("CLASSIFICATION_CACHE_MAX_ENTRIES", 10000))
+
+    if backend_name == "memory":
+        backend = MemoryCacheBackend(max_entries=max_entries, ttl=ttl)
+    elif backend_name == "disk":
+        directory = os.environ.get("CLASSIFICATION_CACHE_DIR", os.path.join(os.getcwd(), ".classification_cache"))
+        backend = DiskCacheBackend(directory, max_entries=max_entries, ttl=ttl)
+    elif backend_name == "blob":
+        if container_client_factory is None:
+            raise ValueError("The blob classification cache needs a container client factory")
+        backend = BlobCacheBackend(container_client_factory(os.environ.get("CLASSIFICATION_CACHE_CONTAINER", "floorplans")),
+                                   prefix=os.environ.get("CLASSIFICATION_CACHE_PREFIX", "classification-cache"),
+                                   ttl=ttl)
+    elif backend_name == "none":
+        backend = None
+    else:
+        raise ValueError(f"Unknown classification cache backend: {backend_name}")
+
+    return ClassificationCache(backend)
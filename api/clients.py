@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import defaultdict
+
+# Registry of Azure SDK clients shared by every activity invocation in the worker.
+# Reusing the clients keeps their HTTP connection pools and tokens warm, so a
+# fan-out of activities doesn't pay a TLS handshake and a token request per call.
+
+class CachedTokenCredential:
+    # Wraps a credential and caches its tokens per scope. A token is refreshed
+    # proactively once it is within refresh_margin seconds of expiring, so callers
+    # never block on an expired token.
+    def __init__(self, credential_factory, refresh_margin=300):
+        self._credential_factory = credential_factory
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.tokens_acquired = 0
+        self.tokens_reused = 0
+
+    def get_token(self, *scopes, **kwargs):
+        if kwargs.get("claims"):
+            # A claims challenge needs a fresh token
+            return self._credential_factory().get_token(*scopes, **kwargs)
+        key = scopes
+        token = self._tokens.get(key)
+        if token is not None and token.expires_on - time.time() > self.refresh_margin:
+            with self._lock:
+                self.tokens_reused += 1
+            return token
+
+        # The factory is called before the lock is taken, it may prime() the cache
+        # with the token that resolved the credential
+        credential = self._credential_factory()
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is None or token.expires_on - time.time() <= self.refresh_margin:
+                token = credential.get_token(*scopes, **kwargs)
+                self._tokens[key] = token
+                self.tokens_acquired += 1
+            else:
+                self.tokens_reused += 1
+            return token
+
+    def prime(self, token, *scopes):
+        # Cache a token obtained outside of get_token
+        with self._lock:
+            self._tokens[scopes] = token
+            self.tokens_acquired += 1
+
+    def bearer_token_provider(self, scope):
+        return lambda: self.get_token(scope).token
+
+    def stats(self):
+        with self._lock:
+            return {"acquired": self.tokens_acquired, "reused": self.tokens_reused}
+
+class ClientRegistry:
+    # The stats count the clients created and the lookups that reused one, not HTTP
+    # connections: each client keeps its own keep-alive connection pool
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"created": 0, "reused": 0})
+
+    def get(self, service, key, factory):
+        # Clients are created lazily on first use, the key holds the settings the
+        # client was built with so a configuration change gets a new client
+        registry_key = (service, key)
+        client = self._clients.get(registry_key)
+        if client is not None:
+            with self._lock:
+                self._stats[service]["reused"] += 1
+            return client
+
+        with self._lock:
+            client = self._clients.get(registry_key)
+            if client is None:
+                client = factory()
+                self._clients[registry_key] = client
+                self._stats[service]["created"] += 1
+            else:
+                self._stats[service]["reused"] += 1
+            return client
+
+    def stats(self):
+        with self._lock:
+            return {service: dict(counts) for service, counts in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._clients.clear()
+            self._stats.clear()
@@ -0,0 +1,96 @@
+import numpy as np
+
+# Geometry helpers for object detection: splitting a large plan into overlapping
+# tiles, mapping tile boxes back to plan coordinates and merging duplicates.
+# Boxes are arrays of [left, top, width, height] in normalized plan coordinates.
+
+def plan_tiles(width, height, tile_size, overlap):
+    # Overlapping tiles covering the whole image, the last row and column are
+    # shifted back so every tile has the full size when the image allows it
+    if tile_size <= 0 or (width <= tile_size and height <= tile_size):
+        return [{"left": 0, "top": 0, "width": width, "height": height}]
+
+    stride = max(1, tile_size - overlap)
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, stride))
+        positions.append(length - tile_size)
+        return positions
+
+    return [{"left": left,
+             "top": top,
+             "width": min(tile_size, width - left),
+             "height": min(tile_size, height - top)}
+            for top in starts(height)
+            for left in starts(width)]
+
+def tile_to_plan_box(bounding_box, tile, width, height):
+    # Convert a box normalized to the tile into a box normalized to the whole plan
+    return {
+        "left": (tile["left"] + bounding_box["left"] * tile["width"]) / width,
+        "top": (tile["top"] + bounding_box["top"] * tile["height"]) / height,
+        "width": bounding_box["width"] * tile["width"] / width,
+        "height": bounding_box["height"] * tile["height"] / height
+    }
+
+def overlap_with(box, boxes, metric="iou"):
+    # Overlap between one box and an array of boxes, either intersection over union
+    # or intersection over the smaller box (catches partial boxes cut by a tile seam)
+    left = np.maximum(box[0], boxes[:, 0])
+    top = np.maximum(box[1], boxes[:, 1])
+    right = np.minimum(box[0] + box[2], boxes[:, 0] + boxes[:, 2])
+    bottom = np.minimum(box[1] + box[3], boxes[:, 1] + boxes[:, 3])
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+
+    area = box[2] * box[3]
+    areas = boxes[:, 2] * boxes[:, 3]
+    if metric == "iomin":
+        denominator = np.minimum(area, areas)
+    else:
+        denominator = area + areas - intersection
+    return np.divide(intersection, denominator, out=np.zeros_like(intersection), where=denominator > 0)
+
+def non_max_suppression(boxes, scores, iou_threshold=0.5, metric="iou", labels=None, top_k=None):
+    # Greedy NMS, returns the indices of the boxes to keep by descending score.
+    # Each step compares the best remaining box with all the others in one vector
+    # operation, so the loop runs once per kept box and memory stays linear.
+    # With labels, boxes only suppress boxes with the same label: every label is
+    # shifted to its own region of the plane so they can never overlap.
+    scores = np.asarray(scores, dtype=np.float64)
+    if scores.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4).copy()
+    if labels is not None:
+        _, label_ids = np.unique(np.asarray(labels), return_inverse=True)
+        span = np.max(boxes[:, :2] + boxes[:, 2:]) + 1
+        boxes[:, 0] += label_ids * span
+
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while order.size > 0:
+        best = order[0]
+        keep.append(best)
+        if top_k and len(keep) >= top_k:
+            break
+        rest = order[1:]
+        order = rest[overlap_with(boxes[best], boxes[rest], metric=metric) <= iou_threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+def deduplicate_boxes(boxes, scores, labels, iou_threshold=0.5, class_agnostic=False, top_k=None, metric="iou"):
+    # De-duplication of the overlapping boxes returned for a single symbol.
+    # Returns the indices to keep, the number of boxes suppressed as duplicates
+    # and the number dropped by the top_k cap.
+    keep = non_max_suppression(boxes,
+                               scores,
+                               iou_threshold=iou_threshold,
+                               metric=metric,
+                               labels=None if class_agnostic else labels)
+    suppressed = len(scores) - len(keep)
+    capped = 0
+    if top_k and len(keep) > top_k:
+        capped = len(keep) - top_k
+        keep = keep[:top_k]
+    return keep, suppressed, capped
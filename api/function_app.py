@@ -1,45 +1,92 @@
 import azure.functions as func
 import azure.durable_functions as df
-from azure.cognitiveservices.vision.customvision.prediction import CustomVisionPredictionClient  
-from azure.storage.blob import BlobServiceClient
-from msrest.authentication import ApiKeyCredentials
-from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
 import os
 import json
 import base64
-from openai import AzureOpenAI
-from PIL import Image
+import hashlib
+import math
+import re
+import threading
+import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from io import BytesIO
-from pydantic import BaseModel
+from clients import ClientRegistry, CachedTokenCredential
+from lazy import lazy_import
+from instrumentation import instrument_activity, set_worker_stats, StageMetrics
 
-# Extension registration
-import logging
-from azure.functions import AuthLevel, FuncExtensionVersion, HttpTrigger
-from azure.functions._durable_functions import DurableClient
+# The SDKs are imported on first use, each activity only loads the ones it needs
+CustomVisionPredictionClient = lazy_import("azure.cognitiveservices.vision.customvision.prediction", "CustomVisionPredictionClient")
+BlobServiceClient, ContentSettings = lazy_import("azure.storage.blob", "BlobServiceClient", "ContentSettings")
+RequestsTransport = lazy_import("azure.core.pipeline.transport", "RequestsTransport")
+ApiKeyCredentials = lazy_import("msrest.authentication", "ApiKeyCredentials")
+DefaultAzureCredential, ManagedIdentityCredential = lazy_import("azure.identity", "DefaultAzureCredential", "ManagedIdentityCredential")
+AzureOpenAI = lazy_import("openai", "AzureOpenAI")
+requests = lazy_import("requests")
+Image = lazy_import("PIL.Image")
+BlobReference, BoundingBox, Prediction = lazy_import("models", "BlobReference", "BoundingBox", "Prediction")
+create_classification_cache, perceptual_hash, cache_key = lazy_import("classification_cache", "create_classification_cache", "perceptual_hash", "cache_key")
+plan_tiles, tile_to_plan_box, non_max_suppression, deduplicate_boxes = lazy_import("detection", "plan_tiles", "tile_to_plan_box", "non_max_suppression", "deduplicate_boxes")
+normalize_image, is_identity, encode_image = lazy_import("normalization", "normalize_image", "is_identity", "encode_image")
+crop_descriptor, best_match = lazy_import("template_matching", "crop_descriptor", "best_match")
+build_legend_index, legend_sheet, index_descriptors, is_current_index = lazy_import(
+    "legend_index", "build_legend_index", "legend_sheet", "index_descriptors", "is_current_index")
+aggregate_results, aggregate_hash, format_aggregate = lazy_import("aggregation", "aggregate_results", "aggregate_hash", "format_aggregate")
+choose_detail, estimate_image_tokens, estimate_text_tokens, image_size, data_url_image_size = lazy_import(
+    "vision_tokens", "choose_detail", "estimate_image_tokens", "estimate_text_tokens", "image_size", "data_url_image_size")
 
 # Set up logging
 logging.getLogger('azure.core.pipeline.policies.http_logging_policy').setLevel(logging.WARNING)
 
-# TODO: Add logging to ensure we can troubleshoot issues
+# Every activity logs its wall time, payload sizes and OpenAI usage, see instrumentation.py
 
 # Initialize the Azure credential
+STORAGE_SCOPE = "https://storage.azure.com/.default"
+
 def get_credential():
+    # Returns the first credential in the chain that can get a token, with that token
     try:
         # Try managed identity first
         credential = ManagedIdentityCredential()
         # Test the credential
-        credential.get_token("https://storage.azure.com/.default")
-        return credential
+        return credential, credential.get_token(STORAGE_SCOPE)
     except Exception as e:
         try:
             # Fall back to DefaultAzureCredential
             credential = DefaultAzureCredential()
-            credential.get_token("https://storage.azure.com/.default")
-            return credential
+            return credential, credential.get_token(STORAGE_SCOPE)
         except Exception as e:
             raise Exception(f"Failed to get valid credential: {str(e)}")
 
-credential = get_credential()
+# The credential is resolved on first use and not at import, so a slow token endpoint
+# doesn't hold up the cold start. A failed resolution is retried on the next use.
+credential = None
+credential_lock = threading.Lock()
+
+def resolve_credential():
+    global credential
+    if credential is None:
+        with credential_lock:
+            if credential is None:
+                resolved, token = get_credential()
+                # The token that proved the credential works is the first one cached
+                token_credential.prime(token, STORAGE_SCOPE)
+                credential = resolved
+    return credential
+
+# Clients and tokens are shared across activity invocations in this worker
+client_registry = ClientRegistry()
+token_credential = CachedTokenCredential(resolve_credential)
+
+def create_pooled_session():
+    # Keep-alive connection pool shared by the storage clients
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                            pool_maxsize=int(os.environ.get("HTTP_POOL_MAXSIZE", 32)))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 def get_storage_client():
     storage_account_name = os.environ.get("STORAGE_ACCOUNT_NAME")
@@ -53,24 +100,430 @@ def get_storage_client():
                 raise Exception("Could not determine storage account name")
     
     storage_account_url = f"https://{storage_account_name}.blob.core.windows.net"
-    return BlobServiceClient(
+    return client_registry.get("storage", storage_account_url, lambda: BlobServiceClient(
         account_url=storage_account_url,
-        credential=credential
-    )
+        credential=token_credential,
+        transport=RequestsTransport(session=create_pooled_session(), session_owner=False)
+    ))
+
+def get_custom_vision_client():
+    endpoint = os.environ["VISION_PREDICTION_ENDPOINT"]
+    prediction_key = os.environ["CV_KEY"]
+
+    def create_client():
+        # Custom Vision still requires API key
+        credentials = ApiKeyCredentials(in_headers={"Prediction-key": prediction_key})
+        predictor = CustomVisionPredictionClient(endpoint, credentials)
+        # Keep the HTTP session open between calls instead of closing it after every request
+        if getattr(predictor, "config", None) is not None:
+            predictor.config.keep_alive = True
+        return predictor
+
+    return client_registry.get("custom_vision", (endpoint, prediction_key), create_client)
+
+def client_stats():
+    return {"clients": client_registry.stats(), "tokens": token_credential.stats()}
+
+# Every activity's metrics log line carries the client and token reuse counters of its worker
+set_worker_stats(client_stats)
+
+def download_blob_bytes(container, blob):
+    blob_service_client = get_storage_client()
+    blob_client = blob_service_client.get_blob_client(container=container, blob=blob)
+    return blob_client.download_blob().readall()
+
+def upload_blob_bytes(container, blob, data, content_type="application/octet-stream"):
+    blob_service_client = get_storage_client()
+    blob_client = blob_service_client.get_blob_client(container=container, blob=blob)
+    result = blob_client.upload_blob(data, overwrite=True, content_settings=ContentSettings(content_type=content_type))
+    return BlobReference(container=container,
+                         blob=blob,
+                         size=len(data),
+                         etag=(result.get("etag") or "").strip('"'))
+
+@lru_cache(maxsize=4)
+def fetch_blob_bytes(container, blob, etag=None):
+    # The etag is part of the cache key so an overwritten blob is fetched again
+    return download_blob_bytes(container, blob)
+
+def read_blob_reference(ref, cache=True):
+    ref = BlobReference.model_validate(ref)
+    if not cache:
+        return download_blob_bytes(ref.container, ref.blob)
+    return fetch_blob_bytes(ref.container, ref.blob, ref.etag or None)
+
+# Blobs uploaded by the frontend are named after the SHA-256 of their content,
+# e.g. floorplan-<sha256>.png, so the name alone identifies the content
+CONTENT_ADDRESS_PATTERN = re.compile(r"^(?:[a-z]+-)?([0-9a-f]{64})(?:\.[A-Za-z0-9]+)?$")
+
+def content_address(blob_name):
+    # SHA-256 of a content-addressed blob from its name, None for other names
+    match = CONTENT_ADDRESS_PATTERN.match(blob_name.rsplit("/", 1)[-1])
+    return match.group(1) if match else None
+
+def legend_blob_name(legend_id):
+    return f"{os.environ.get('LEGENDS_PREFIX', 'legends')}/{legend_id}"
+
+def legend_index_blob_name(legend_id, extension="json"):
+    return f"{os.environ.get('LEGEND_INDEX_PREFIX', 'legend-index')}/{legend_id}.{extension}"
+
+def blob_not_found_error():
+    from azure.core.exceptions import ResourceNotFoundError
+    return ResourceNotFoundError
+
+def index_legend(container, legend_id, legend_bytes=None):
+    # Segments the legend into its entries and stores the index and the compact sheet next to it
+    if legend_bytes is None:
+        legend_bytes = download_blob_bytes(container, legend_blob_name(legend_id))
+    index = build_legend_index(legend_bytes)
+    sheet = legend_sheet(legend_bytes, index)
+    if sheet is not None:
+        upload_blob_bytes(container, legend_index_blob_name(legend_id, "png"), sheet, "image/png")
+    index["sheet"] = sheet is not None
+    upload_blob_bytes(container, legend_index_blob_name(legend_id), json.dumps(index).encode("utf-8"), "application/json")
+    return index
+
+@lru_cache(maxsize=8)
+def get_legend_index(container, legend_id):
+    # The index is built once per legend and kept in memory, a legend ID always maps to the same bytes
+    try:
+        index = json.loads(download_blob_bytes(container, legend_index_blob_name(legend_id)))
+    except blob_not_found_error():
+        index = None
+    if index is None or not is_current_index(index):
+        index = index_legend(container, legend_id)
+    return index
+
+def legend_compact():
+    return os.environ.get("LEGEND_COMPACT", "true").lower() == "true"
+
+@lru_cache(maxsize=8)
+def get_legend_data_url(container, legend_id, compact=False):
+    # Legends are content addressed, a legend ID always maps to the same bytes.
+    # The compact sheet holds the same entries without the blank space of the legend.
+    if compact and get_legend_index(container, legend_id).get("sheet"):
+        return to_data_url(download_blob_bytes(container, legend_index_blob_name(legend_id, "png")), "image/png")
+    return to_data_url(download_blob_bytes(container, legend_blob_name(legend_id)))
 
-class BoundingBox(BaseModel):
-    left: float
-    top: float
-    width: float
-    height: float
+@lru_cache(maxsize=8)
+def get_legend_symbols(container, legend_id):
+    # Glyph descriptors of the legend symbols for the template matcher, read from the legend index
+    return index_descriptors(get_legend_index(container, legend_id))
+
+def to_data_url(image_bytes, mime_type=None):
+    if mime_type is None:
+        mime_type = "image/png" if image_bytes.startswith(b"\x89PNG") else "image/jpeg"
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+
+def crop_region(image, bounding_box, buffer=10):
+    # Crop the image based on the bounding box, with a buffer around it
+    left = max(0, int(bounding_box["left"] * image.width) - buffer)
+    top = max(0, int(bounding_box["top"] * image.height) - buffer)
+    right = min(image.width, int((bounding_box["left"] + bounding_box["width"]) * image.width) + buffer)
+    bottom = min(image.height, int((bounding_box["top"] + bounding_box["height"]) * image.height) + buffer)
+    return image.crop((left, top, right, bottom))
+
+def crop_detection(image, bounding_box, buffer=10):
+    buffered = BytesIO()
+    crop_region(image, bounding_box, buffer).convert('RGB').save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+def get_openai_client():
+    endpoint = os.environ["OPENAI_ENDPOINT"]
+    api_version = os.environ.get("OPENAI_API_VERSION", "2024-02-01")
+
+    def create_client():
+        try:
+            # Use managed identity for Azure OpenAI
+            return AzureOpenAI(
+                azure_endpoint=endpoint,
+                api_version=api_version,
+                azure_ad_token_provider=token_credential.bearer_token_provider("https://cognitiveservices.azure.com/.default")
+            )
+        except Exception as e:
+            # Fall back to API key if managed identity fails
+            return AzureOpenAI(
+                azure_endpoint=endpoint,
+                api_key=os.environ["OPENAI_KEY"],
+                api_version=api_version
+            )
+
+    return client_registry.get("openai", (endpoint, api_version), create_client)
+
+@lru_cache(maxsize=1)
+def get_classification_cache():
+    return create_classification_cache(
+        lambda container: get_storage_client().get_container_client(container))
+
+def legend_entry_key(legend_id, entry, prompt):
+    # Label the model gave to crops matching a legend symbol, shared by the later matches
+    return cache_key(f"entry{entry}", legend_id, prompt)
+
+def remember_legend_entry(legend_id, entry, prompt, model_response):
+    # Every answer for a crop matching the entry is a vote. The entry only gets a local
+    # label once LEGEND_ENTRY_MIN_VOTES answers agree on it and they are at least
+    # LEGEND_ENTRY_MIN_AGREEMENT of the votes, so one wrong answer doesn't label every
+    # later match. A "No Match" answer counts against the other labels.
+    if entry is None or not model_response:
+        return
+    min_votes = int(os.environ.get("LEGEND_ENTRY_MIN_VOTES", 3))
+    min_agreement = float(os.environ.get("LEGEND_ENTRY_MIN_AGREEMENT", 0.8))
+    cache = get_classification_cache()
+    key = legend_entry_key(legend_id, entry, prompt)
+    # Concurrent activities may lose a vote, that only delays the promotion
+    votes = dict((cache.get(key) or {}).get("votes") or {})
+    label = "No Match" if model_response.strip().strip(".").lower() == "no match" else model_response.strip()
+    votes[label] = votes.get(label, 0) + 1
+    top_label, top_votes = max(votes.items(), key=lambda item: item[1])
+    promoted = (top_label != "No Match"
+                and top_votes >= min_votes
+                and top_votes >= min_agreement * sum(votes.values()))
+    cache.set(key, {"votes": votes, "model_response": top_label if promoted else None})
+
+def classification_cache_key(crop_bytes, legend_id, prompt):
+    return cache_key(perceptual_hash(crop_bytes), legend_id, prompt)
+
+def image_detail_settings():
+    # IMAGE_DETAIL_POLICY is adaptive (detail level from the image size) or high (always high detail)
+    return (os.environ.get("IMAGE_DETAIL_POLICY", "adaptive").lower(),
+            int(os.environ.get("LOW_DETAIL_MAX_SIDE", 512)))
+
+def image_content(image_bytes, max_tokens=None):
+    # Image part for a vision request with the detail level chosen for the image,
+    # shrunk to fit max_tokens when needed. Returns the part and its estimated tokens.
+    policy, low_detail_max_side = image_detail_settings()
+    size = image_size(image_bytes)
+    if policy != "adaptive" or size is None:
+        tokens = estimate_image_tokens(*size) if size else estimate_image_tokens(2048, 2048)
+        return {"type": "image_url", "image_url": {"url": to_data_url(image_bytes), "detail": "high"}}, tokens
+
+    choice = choose_detail(*size, max_tokens=max_tokens, low_detail_max_side=low_detail_max_side)
+    if choice["size"]:
+        image = Image.open(BytesIO(image_bytes)).resize(choice["size"], Image.LANCZOS)
+        image_bytes = encode_image(image, "PNG" if image_bytes.startswith(b"\x89PNG") else "JPEG")
+    return {"type": "image_url", "image_url": {"url": to_data_url(image_bytes), "detail": choice["detail"]}}, choice["tokens"]
+
+def legend_content(reference_img):
+    # The legend is only resized by the service, its detail level follows its size
+    policy, low_detail_max_side = image_detail_settings()
+    size = data_url_image_size(reference_img)
+    if policy != "adaptive" or size is None:
+        tokens = estimate_image_tokens(*size) if size else estimate_image_tokens(2048, 2048)
+        return {"type": "image_url", "image_url": {"url": reference_img}}, tokens
+    choice = choose_detail(*size, low_detail_max_side=low_detail_max_side)
+    return {"type": "image_url", "image_url": {"url": reference_img, "detail": choice["detail"]}}, choice["tokens"]
+
+def crop_token_budget(data, legend_tokens, crop_count):
+    # Share of the request's image token budget left for each crop once the legend is paid for
+    budget = int(data.get("image_token_budget") or 0)
+    if not budget:
+        return None
+    return max(1, (budget - legend_tokens) // max(1, crop_count))
+
+def token_usage(response, estimated_prompt_tokens):
+    usage = {"estimated_prompt_tokens": estimated_prompt_tokens}
+    for field in ("prompt_tokens", "completion_tokens"):
+        value = getattr(getattr(response, "usage", None), field, None)
+        if isinstance(value, int):
+            usage[field] = value
+    return usage
+
+def openai_rate_limit_error():
+    # Exception class for a 429 from Azure OpenAI, imported with the SDK
+    from openai import RateLimitError
+    return RateLimitError
+
+def retry_after_seconds(error, default=5.0):
+    # Azure OpenAI sends retry-after-ms and retry-after on 429 responses
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return default
+
+def throttled_result(error):
+    retry_after = retry_after_seconds(error)
+    logging.warning(f"Azure OpenAI throttled the request, retry after {retry_after}s")
+    return {"throttled": True, "retry_after": retry_after}
+
+CLASSIFY_PROMPT = """
+    Here's an image of a symbol and a legend
+    please match the symbol to the legend and give me the name of the symbol in the legend.
+    Use the exact symbol name as it appears in the legend, all in uppercase
+    only return the name of the symbol or No Match if there is no match
+    
+    Here is the legend
+"""
 
-class Prediction(BaseModel):
-    tag: str
-    probability: float
-    bounding_box: BoundingBox
+BATCH_CLASSIFY_INSTRUCTIONS = """
+You will be given {count} numbered symbols, match every symbol to the legend.
+Respond with a JSON object of the form {{"labels": [{{"symbol": <number>, "label": "<name>"}}]}}
+with exactly one entry per symbol, using the same label rules as for a single symbol.
+"""
 
 myApp = df.DFApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
+def schedule_activity(context, name, payload, retry_options=None):
+    if retry_options:
+        return context.call_activity_with_retry(name, retry_options, payload)
+    return context.call_activity(name, payload)
+
+def completed_tasks(in_flight):
+    # Splits the (index, task) pairs in flight into the completed and the pending ones.
+    # task_any completes with the first task to finish and never fails, a failed
+    # activity is completed with its exception as result.
+    completed = [(index, task) for index, task in in_flight if task.is_completed]
+    for _, task in completed:
+        if isinstance(task.result, Exception):
+            raise task.result
+    return completed, [(index, task) for index, task in in_flight if not task.is_completed]
+
+def call_activities_bounded(context, name, payloads, max_parallel, retry_options=None):
+    # Fan out over the payloads with at most max_parallel activities in flight, a slot
+    # is refilled as soon as its activity completes. Use with `yield from` inside an orchestrator
+    results = [None] * len(payloads)
+    queue = list(range(len(payloads)))
+    in_flight = []
+    while queue or in_flight:
+        while queue and len(in_flight) < max_parallel:
+            index = queue.pop(0)
+            in_flight.append((index, schedule_activity(context, name, payloads[index], retry_options)))
+        yield context.task_any([task for _, task in in_flight])
+        completed, in_flight = completed_tasks(in_flight)
+        for index, task in completed:
+            results[index] = task.result
+    return results
+
+def call_activities_adaptive(context, name, payloads, max_parallel, retry_options, max_throttle_retries=10, on_progress=None):
+    # Bounded fan-out that adapts to throttling. Activities report a 429 by returning
+    # {"throttled": True, "retry_after": seconds} instead of failing. The throttled
+    # payloads are scheduled again after a durable timer. The window is adjusted on
+    # every completion (AIMD): halved when throttled, grown by 1/window per success so
+    # a full window of successes grows it by one, and the orchestration settles at the
+    # rate the deployment can sustain. A slot is refilled as soon as its activity completes.
+    # Other failures are retried with retry_options. on_progress is called with the
+    # results (None while pending) after every completion.
+    results = [None] * len(payloads)
+    queue = list(range(len(payloads)))
+    throttle_counts = [0] * len(payloads)
+    window = float(max_parallel)
+    stats = {"throttled": 0, "backoffs": 0, "min_window": max_parallel}
+    in_flight = []
+
+    while queue or in_flight:
+        while queue and len(in_flight) < int(window):
+            index = queue.pop(0)
+            in_flight.append((index, schedule_activity(context, name, payloads[index], retry_options)))
+        yield context.task_any([task for _, task in in_flight])
+        completed, in_flight = completed_tasks(in_flight)
+
+        throttled = []
+        retry_after = 0
+        for index, task in completed:
+            result = task.result
+            if isinstance(result, dict) and result.get("throttled"):
+                throttle_counts[index] += 1
+                if throttle_counts[index] > max_throttle_retries:
+                    raise Exception(f"{name} was still throttled after {max_throttle_retries} retries")
+                throttled.append(index)
+                retry_after = max(retry_after, float(result.get("retry_after") or 1))
+            else:
+                results[index] = result
+                window = min(float(max_parallel), window + 1 / window)
+
+        if on_progress:
+            on_progress(results)
+
+        if throttled:
+            # The throttled completions seen together are one congestion signal
+            stats["throttled"] += len(throttled)
+            stats["backoffs"] += 1
+            window = max(1.0, window / 2)
+            stats["min_window"] = min(stats["min_window"], int(window))
+            queue = throttled + queue
+            yield context.create_timer(context.current_utc_datetime + timedelta(seconds=retry_after))
+
+    return results, stats
+
+def compact_detection(detection, label=None):
+    # Short form of a detection for the custom status: [left, top, width, height, tag, probability, label]
+    box = detection["bounding_box"]
+    return [round(box["left"], 4), round(box["top"], 4), round(box["width"], 4), round(box["height"], 4),
+            detection["tag"], round(detection["probability"], 3), label[:40] if label else None]
+
+def publish_progress(context, phase, detections=None, labels=None, max_chars=7500):
+    # Custom status is limited to 16KB of UTF-16 JSON, about 8K characters, so results are
+    # added while the serialized status stays under max_chars and flagged when truncated
+    status = {"phase": phase}
+    if detections is not None:
+        labels = labels or []
+        status["detections"] = len(detections)
+        status["classified"] = sum(1 for label in labels if label is not None)
+        status["truncated"] = False
+        status["results"] = []
+        # Each entry adds its JSON and a ", " separator to the serialized status
+        size = len(json.dumps(status))
+        for index, detection in enumerate(detections):
+            entry = compact_detection(detection, labels[index] if index < len(labels) else None)
+            size += len(json.dumps(entry)) + (2 if status["results"] else 0)
+            if size > max_chars:
+                status["truncated"] = True
+                break
+            status["results"].append(entry)
+    context.set_custom_status(status)
+
+# Orchestrators replay from their history and must not read app settings, a setting
+# changed during a run would schedule other work than the history recorded. The app
+# settings are resolved once when a run starts and go into its input, the orchestrator
+# only reads its input and falls back to fixed defaults.
+PLAN_SETTINGS = {
+    "classification_batch_size": "CLASSIFICATION_BATCH_SIZE",
+    "detection_tile_size": "DETECTION_TILE_SIZE",
+    "detection_tile_overlap": "DETECTION_TILE_OVERLAP",
+    "detection_max_parallel": "DETECTION_MAX_PARALLEL",
+    "openai_max_parallel": "OPENAI_MAX_PARALLEL",
+    "openai_max_throttle_retries": "OPENAI_MAX_THROTTLE_RETRIES",
+    "dedup_iou_threshold": "DEDUP_IOU_THRESHOLD",
+    "dedup_class_agnostic": "DEDUP_CLASS_AGNOSTIC",
+    "dedup_top_k": "DEDUP_TOP_K",
+    "template_match_threshold": "TEMPLATE_MATCH_THRESHOLD",
+    "summary_narrative": "SUMMARY_NARRATIVE",
+    "image_token_budget": "IMAGE_TOKEN_BUDGET",
+    "image_color_mode": "IMAGE_COLOR_MODE",
+    "image_palette_colors": "IMAGE_PALETTE_COLORS",
+    "detection_max_side": "DETECTION_MAX_SIDE",
+    "crop_max_side": "CROP_MAX_SIDE",
+    "crop_color_mode": "CROP_COLOR_MODE",
+    "crop_format": "CROP_FORMAT",
+    "crop_quality": "CROP_QUALITY",
+    "activity_retry_first_interval_ms": "ACTIVITY_RETRY_FIRST_INTERVAL_MS",
+    "activity_retry_max_attempts": "ACTIVITY_RETRY_MAX_ATTEMPTS",
+    "progress_max_chars": "PROGRESS_MAX_CHARS",
+}
+
+BATCH_SETTINGS = {
+    "max_concurrent_plans": "BATCH_MAX_CONCURRENT_PLANS",
+    "chunk_size": "BATCH_CHUNK_SIZE",
+}
+
+def settings_from_environment(settings):
+    # The app settings that are set, by orchestration input key
+    return {key: os.environ[name] for key, name in settings.items() if name in os.environ}
+
+def resolve_settings(function_name, payload):
+    # Values in the request take precedence over the app settings
+    if function_name == "vision_agent_orchestrator":
+        return {**settings_from_environment(PLAN_SETTINGS), **payload}
+    if function_name == "batch_floorplan_orchestrator":
+        return {**settings_from_environment(BATCH_SETTINGS),
+                **payload,
+                "options": {**settings_from_environment(PLAN_SETTINGS), **payload.get("options", {})}}
+    return payload
+
 # An HTTP-triggered function with a Durable Functions client binding
 @myApp.route(route="orchestrators/{functionName}")
 @myApp.durable_client_input(client_name="client")
@@ -99,7 +552,17 @@ async def http_start(req: func.HttpRequest, client):
     # Configure the durable client
     client._config = task_hub_config
     
-    instance_id = await client.start_new(function_name, client_input=payload)
+    instance_id = await client.start_new(function_name, client_input=resolve_settings(function_name, payload))
+
+    # Clients can wait for a short run to complete instead of polling for it,
+    # the usual check status response is returned when it takes longer
+    wait_ms = req.params.get('waitForCompletionMs')
+    if isinstance(wait_ms, str) and wait_ms.isdigit() and int(wait_ms) > 0:
+        return await client.wait_for_completion_or_create_check_status_response(
+            req, instance_id,
+            timeout_in_milliseconds=int(wait_ms),
+            retry_interval_in_milliseconds=min(1000, int(wait_ms)))
+
     response = client.create_check_status_response(req, instance_id)
     
     return response
@@ -113,88 +576,357 @@ def vision_agent_orchestrator(context):
     analyze_prompt = payload.get("analyze_prompt")
     reference_filename = payload.get("reference_filename")
     prediction_threshold = payload.get("prediction_threshold", 0.5)
+    batch_size = max(1, int(payload.get("classification_batch_size", 1)))
+    tile_size = int(payload.get("detection_tile_size", 0))
+    tile_overlap = int(payload.get("detection_tile_overlap", 128))
+    detection_max_parallel = max(1, int(payload.get("detection_max_parallel", 8)))
+    openai_max_parallel = max(1, int(payload.get("openai_max_parallel", 16)))
+    openai_max_throttle_retries = int(payload.get("openai_max_throttle_retries", 10))
+    dedup_options = {
+        "iou_threshold": float(payload.get("dedup_iou_threshold", 0.5)),
+        "class_agnostic": str(payload.get("dedup_class_agnostic", "false")).lower() == "true",
+        "top_k": int(payload.get("dedup_top_k", 0))}
+    template_match_threshold = float(payload.get("template_match_threshold", 0))
+    summary_narrative = str(payload.get("summary_narrative", "true")).lower() == "true"
+    image_token_budget = int(payload.get("image_token_budget", 0))
+    color_mode = payload.get("image_color_mode", "rgb")
+    palette_colors = int(payload.get("image_palette_colors", 16))
+    detection_normalization = {
+        "max_side": int(payload.get("detection_max_side", 0)),
+        "color_mode": color_mode,
+        "palette_colors": palette_colors}
+    crop_normalization = {
+        "max_side": int(payload.get("crop_max_side", 0)),
+        "color_mode": payload.get("crop_color_mode", color_mode),
+        "palette_colors": palette_colors,
+        "image_format": payload.get("crop_format", "jpeg").upper(),
+        "quality": int(payload.get("crop_quality", 0)) or None}
+    progress_max_chars = int(payload.get("progress_max_chars", 7500))
+
+    publish_progress(context, "reading")
+    # Wall time, payload bytes and token usage of every stage, returned in the results
+    metrics = StageMetrics(context)
 
-    ## Read the candidate image and reference image from blob storage
-    read_tasks = [context.call_activity("read_image",
-                                        json.dumps({"container": container, "filename": filename}))
-                                        for filename in [filename, reference_filename]]
+    ## Resolve the candidate image and reference image to blob references.
+    ## Only the references go through the orchestration history, each activity
+    ## fetches the bytes it needs so the history size doesn't depend on the image size.
+    read_payloads = [json.dumps({"container": container, "filename": filename, "by_reference": True})
+                     for filename in [filename, reference_filename]]
+    read_tasks = [context.call_activity("read_image", read_payload) for read_payload in read_payloads]
     
-    read_results = yield context.task_all(read_tasks)
-    b64_image = read_results[0]
-    b64_reference_image = read_results[1]
+    read_results = yield from metrics.measure("read_image", context.task_all(read_tasks), read_payloads)
+    image_ref = read_results[0]
+    reference_ref = read_results[1]
+
+    ## Register the legend once per run, the classification tasks only reference it by ID
+    legend_payload = json.dumps({"reference_ref": reference_ref})
+    legend = yield from metrics.measure("register_legend", context.call_activity("register_legend", legend_payload), [legend_payload])
     
     ## Perform object detection on the candidate image
-    retry_options = df.RetryOptions(200,3)
-    predictions = yield context.call_activity("object_detection", json.dumps({"image_data": b64_image}))
-    detections = [Prediction.model_validate_json(pred) for pred in predictions]
+    publish_progress(context, "detecting")
+    detection_bytes = {"bytes_before": image_ref["size"], "bytes_after": image_ref["size"]}
+    detection_ref = image_ref
+    if not is_identity(**detection_normalization):
+        # Detect on a smaller copy of the plan, the boxes are normalized so they apply to the original
+        normalize_payload = json.dumps({
+            "image_ref": image_ref,
+            **detection_normalization})
+        normalized = yield from metrics.measure("normalize_plan", context.call_activity("normalize_plan", normalize_payload), [normalize_payload])
+        detection_ref = normalized["image_ref"]
+        detection_bytes = {key: normalized[key] for key in ("bytes_before", "bytes_after")}
+
+    retry_options = df.RetryOptions(int(payload.get("activity_retry_first_interval_ms", 200)),
+                                    int(payload.get("activity_retry_max_attempts", 3)))
+    if tile_size > 0:
+        # Large plans are detected tile by tile so small symbols aren't lost to downsampling
+        tiling_payload = json.dumps({
+            "image_ref": detection_ref,
+            "tile_size": tile_size,
+            "tile_overlap": tile_overlap})
+        tiling = yield from metrics.measure("plan_detection_tiles", context.call_activity("plan_detection_tiles", tiling_payload), [tiling_payload])
+        tile_payloads = [json.dumps({"tile_ref": tile["tile_ref"],
+                                     "tile": {key: tile[key] for key in ("left", "top", "width", "height")},
+                                     "image_width": tiling["width"],
+                                     "image_height": tiling["height"]}) for tile in tiling["tiles"]]
+        tile_predictions = yield from metrics.measure("object_detection", call_activities_bounded(
+            context, "object_detection", tile_payloads, detection_max_parallel, retry_options), tile_payloads)
+        merge_payload = json.dumps({"tile_predictions": tile_predictions})
+        predictions = yield from metrics.measure("merge_detections", context.call_activity("merge_detections", merge_payload), [merge_payload])
+    else:
+        detection_payload = json.dumps({"image_ref": detection_ref})
+        predictions = yield from metrics.measure("object_detection", context.call_activity("object_detection", detection_payload), [detection_payload])
+
+    ## Drop the overlapping boxes returned for the same symbol before paying for their classification
+    dedup_payload = json.dumps({
+        "predictions": predictions,
+        "prediction_threshold": prediction_threshold,
+        **dedup_options})
+    deduplication = yield from metrics.measure("deduplicate_predictions", context.call_activity("deduplicate_predictions", dedup_payload), [dedup_payload])
+
+    ## Crop every detection above the threshold in a single activity, the orchestrator
+    ## replays after every yield so it must not decode or crop the image itself
+    crop_payload = json.dumps({
+        "image_ref": image_ref,
+        "predictions": deduplication["predictions"],
+        "prediction_threshold": prediction_threshold,
+        "normalization": crop_normalization})
+    crops = yield from metrics.measure("crop_detections", context.call_activity("crop_detections", crop_payload), [crop_payload])
 
     ### Make a call to Azure OpenAI to analyze the detected objects
-    binary_image_data = base64.b64decode(b64_image)
-    image = Image.open(BytesIO(binary_image_data))
-
-    tasks = []
-    for prediction in detections:
-        # Crop the image based on the bounding box
-        if prediction.probability > prediction_threshold:
-            buffered = BytesIO()
-
-            buffer = 10  # Buffer around the bounding box
-            left = max(0, int(prediction.bounding_box.left * image.width) - buffer)
-            top = max(0, int(prediction.bounding_box.top * image.height) - buffer)
-            right = min(image.width, int((prediction.bounding_box.left + prediction.bounding_box.width) * image.width) + buffer)
-            bottom = min(image.height, int((prediction.bounding_box.top + prediction.bounding_box.height) * image.height) + buffer)
-            
-            cropped_image = image.crop((left, top, right, bottom))
-            cropped_image.convert('RGB').save(buffered, format="JPEG")
-            
-            # Convert the cropped image to base64
-            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            base64_url = f"data:image/jpeg;base64,{img_str}"
-            b64_reference_image_url = f"data:image/jpeg;base64,{b64_reference_image}"
-            detection_payload = json.dumps({
-                "bounding_box": {
-                    "left": prediction.bounding_box.left,
-                    "top": prediction.bounding_box.top,
-                    "width": prediction.bounding_box.width,
-                    "height": prediction.bounding_box.height
-                },
-                "tag": prediction.tag,
-                "probability": prediction.probability,
-                "image": base64_url,
-                "reference_img": b64_reference_image_url,
-                "analyze_prompt": analyze_prompt})
-            
-            tasks.append(context.call_activity("azure_openai_processing", detection_payload))
-    
-    object_results = yield context.task_all(tasks)
+    detections = [{
+        "bounding_box": crop["bounding_box"],
+        "tag": crop["tag"],
+        "probability": crop["probability"],
+        "crop_ref": crop["crop_ref"]} for crop in crops]
+    # The boxes are published as soon as they are known, the labels follow as classifications complete
+    publish_progress(context, "classifying", detections, max_chars=progress_max_chars)
+
+    # Crops that closely match a legend symbol with a known label are classified locally,
+    # only the others are escalated to the model
+    local_results = {}
+    if template_match_threshold > 0 and detections:
+        match_payload = json.dumps({
+            "crop_refs": [detection["crop_ref"] for detection in detections],
+            "legend_id": legend["legend_id"],
+            "legend_container": legend["container"],
+            "analyze_prompt": analyze_prompt,
+            "threshold": template_match_threshold})
+        matches = yield from metrics.measure("match_legend_symbols", context.call_activity("match_legend_symbols", match_payload), [match_payload])
+        for index, match in enumerate(matches):
+            if match["label"] is not None:
+                local_results[index] = {"model_response": match["label"],
+                                        **{key: detections[index][key] for key in ("bounding_box", "tag", "probability")},
+                                        "cache_hit": False,
+                                        "match_score": match["score"]}
+            elif match["entry"] is not None:
+                detections[index]["legend_entry"] = match["entry"]
+    escalated = [index for index in range(len(detections)) if index not in local_results]
+    pending_detections = [detections[index] for index in escalated]
+
+    # The run's image token budget is shared evenly by the classification requests
+    request_count = max(1, math.ceil(len(pending_detections) / batch_size))
+    legend_fields = {
+        "legend_id": legend["legend_id"],
+        "legend_container": legend["container"],
+        "analyze_prompt": analyze_prompt,
+        "image_token_budget": image_token_budget // request_count}
+
+    if batch_size > 1:
+        # Classify groups of crops with one request each, the legend is only sent once per group
+        activity_name = "azure_openai_batch_processing"
+        activity_payloads = [json.dumps({"detections": pending_detections[start:start + batch_size], **legend_fields})
+                             for start in range(0, len(pending_detections), batch_size)]
+    else:
+        activity_name = "azure_openai_processing"
+        activity_payloads = [json.dumps({**detection, **legend_fields}) for detection in pending_detections]
+
+    def escalated_results(results):
+        # One result, None while pending, per escalated detection
+        if batch_size <= 1:
+            return results
+        flattened = []
+        for start, batch_results in zip(range(0, len(pending_detections), batch_size), results):
+            # A pending batch still counts for one result per detection it holds
+            flattened.extend(batch_results if batch_results is not None else [None] * len(pending_detections[start:start + batch_size]))
+        return flattened
+
+    def merged_results(results):
+        merged = [local_results.get(index) for index in range(len(detections))]
+        for index, result in zip(escalated, escalated_results(results)):
+            merged[index] = result
+        return merged
+
+    def classification_progress(results):
+        labels = [result["model_response"] if result else None for result in merged_results(results)]
+        publish_progress(context, "classifying", detections, labels, progress_max_chars)
+
+    task_results, throttling = yield from metrics.measure(activity_name,
+                                                          call_activities_adaptive(context,
+                                                                                   activity_name,
+                                                                                   activity_payloads,
+                                                                                   openai_max_parallel,
+                                                                                   retry_options,
+                                                                                   openai_max_throttle_retries,
+                                                                                   on_progress=classification_progress),
+                                                          activity_payloads)
+    object_results = merged_results(task_results)
     
     # Add summarization step
+    publish_progress(context, "summarizing", detections, [result["model_response"] for result in object_results], progress_max_chars)
+    # Only the fields the aggregation needs go to the summary
     summary_payload = {
-        "object_results": object_results,
-        "predictions": predictions,
-        "analyze_prompt": analyze_prompt
+        "object_results": [{key: result.get(key) for key in ("tag", "probability", "model_response")}
+                           for result in object_results],
+        "analyze_prompt": analyze_prompt,
+        "narrative": summary_narrative
     }
-    summary = yield context.call_activity("summarize_results", json.dumps(summary_payload))
+    summary_payload = json.dumps(summary_payload)
+    summarization = yield from metrics.measure("summarize_results", context.call_activity("summarize_results", summary_payload), [summary_payload])
     
     # Add summary to results
+    cache_hits = sum(1 for result in object_results if result.get("cache_hit"))
+    usages = [result["usage"] for result in object_results if result.get("usage")]
+    tokens = {"requests": len(usages),
+              **{field: sum(usage.get(field, 0) for usage in usages)
+                 for field in ("estimated_prompt_tokens", "prompt_tokens", "completion_tokens")}}
+    details = [result["detail"] for result in object_results if result.get("detail")]
     final_results = {
         "detections": object_results,
-        "summary": summary
+        "summary": summarization["summary"],
+        "aggregate": summarization["aggregate"],
+        "cache": {"hits": cache_hits, "misses": len(object_results) - cache_hits},
+        "deduplication": {key: deduplication[key] for key in ("candidates", "suppressed", "capped")},
+        "throttling": throttling,
+        "preclassification": {"threshold": template_match_threshold,
+                              "local": len(local_results),
+                              "escalated": len(escalated),
+                              "escalation_rate": round(len(escalated) / len(detections), 3) if detections else 0.0},
+        "tokens": tokens,
+        "image_detail": {detail: details.count(detail) for detail in sorted(set(details))},
+        "normalization": {
+            "detection": detection_bytes,
+            "crops": {"bytes_before": sum(crop.get("bytes_before", crop["crop_ref"]["size"]) for crop in crops),
+                      "bytes_after": sum(crop["crop_ref"]["size"] for crop in crops)}},
+        "metrics": metrics.as_dict()
     }
-    
+
+    if payload.get("save_results"):
+        # Batch runs keep the full results in blob storage and only return a compact status,
+        # so the batch history doesn't grow with the detections of every plan
+        results_payload = json.dumps({"container": container,
+                                      "instance_id": context.instance_id,
+                                      "results": final_results})
+        results_ref = yield context.call_activity("save_plan_results", results_payload)
+        return {"results_ref": results_ref, "detections": len(object_results)}
+
     return final_results
 
+@myApp.orchestration_trigger(context_name="context")
+def batch_floorplan_orchestrator(context):
+    payload = context.get_input()
+    container = payload.get("container")
+    prefix = payload.get("prefix", "")
+    reference_filename = payload.get("reference_filename")
+    analyze_prompt = payload.get("analyze_prompt")
+    plan_options = payload.get("options", {})
+    # Resolved into the input when the batch starts and carried over by continue_as_new
+    max_concurrent_plans = max(1, int(payload.get("max_concurrent_plans", 4)))
+    chunk_size = max(1, int(payload.get("chunk_size", 50)))
+
+    if payload.get("manifest"):
+        ## A continued execution picks up the partial manifest of the previous chunk
+        manifest = payload["manifest"]
+        plans = {plan["filename"]: plan for plan in manifest["plans"]}
+        filenames = list(plans)
+        resumed = manifest["resumed"]
+    else:
+        ## List the floorplans under the prefix. When resuming a previous batch, the plans
+        ## it already completed are carried over and only the others are analyzed again.
+        filenames = yield context.call_activity("list_floorplans", json.dumps({
+            "container": container,
+            "prefix": prefix,
+            "exclude": [reference_filename]}))
+        previous = {}
+        if payload.get("resume_from"):
+            previous_manifest = yield context.call_activity("load_batch_manifest", json.dumps({
+                "container": container,
+                "instance_id": payload["resume_from"]}))
+            previous = {plan["filename"]: plan for plan in previous_manifest.get("plans", []) if plan["status"] == "Completed"}
+        plans = {filename: previous.get(filename, {"filename": filename, "status": "Pending"}) for filename in filenames}
+        resumed = len(previous)
+
+    queue = [filename for filename in filenames if plans[filename]["status"] == "Pending"]
+    chunk, remaining = queue[:chunk_size], queue[chunk_size:]
+
+    ## Run the chunk's plans as sub-orchestrations with at most max_concurrent_plans running.
+    ## A failed plan is recorded in the manifest and doesn't stop the others. Each plan
+    ## saves its results to blob storage and only returns a compact status.
+    in_flight = {}
+    while chunk or in_flight:
+        while chunk and len(in_flight) < max_concurrent_plans:
+            filename = chunk.pop(0)
+            instance_id = f"{context.instance_id}-{filenames.index(filename)}"
+            task = context.call_sub_orchestrator("vision_agent_orchestrator", {
+                "container": container,
+                "filename": filename,
+                "reference_filename": reference_filename,
+                "analyze_prompt": analyze_prompt,
+                **plan_options,
+                "save_results": True}, instance_id)
+            in_flight[filename] = task
+            plans[filename] = {"filename": filename,
+                               "instance_id": instance_id,
+                               "status": "Running",
+                               "started": context.current_utc_datetime.isoformat()}
+
+        # task_any completes with the first plan to finish and never fails,
+        # a failed plan's task holds its exception as result
+        yield context.task_any(list(in_flight.values()))
+
+        for filename, task in list(in_flight.items()):
+            if not task.is_completed:
+                continue
+            del in_flight[filename]
+            plan = plans[filename]
+            finished = context.current_utc_datetime
+            plan["finished"] = finished.isoformat()
+            plan["duration_seconds"] = (finished - datetime.fromisoformat(plan["started"])).total_seconds()
+            if isinstance(task.result, Exception):
+                plan["status"] = "Failed"
+                plan["error"] = str(task.result)
+            else:
+                plan["status"] = "Completed"
+                plan["detections"] = task.result["detections"]
+                plan["results_ref"] = task.result["results_ref"]
+
+        context.set_custom_status({
+            "total": len(filenames),
+            "completed": sum(1 for plan in plans.values() if plan["status"] == "Completed"),
+            "failed": sum(1 for plan in plans.values() if plan["status"] == "Failed"),
+            "running": len(in_flight),
+            "pending": len(chunk) + len(remaining)})
+
+    manifest = {
+        "instance_id": context.instance_id,
+        "container": container,
+        "prefix": prefix,
+        "reference_filename": reference_filename,
+        "total": len(filenames),
+        "completed": sum(1 for plan in plans.values() if plan["status"] == "Completed"),
+        "failed": sum(1 for plan in plans.values() if plan["status"] == "Failed"),
+        "resumed": resumed,
+        "plans": [plans[filename] for filename in filenames]
+    }
+    # The manifest is saved after every chunk, a batch that stops can be resumed from it
+    yield context.call_activity("save_batch_manifest", json.dumps(manifest))
+
+    if remaining:
+        # Start the next chunk with a fresh history, the partial manifest carries the progress
+        context.continue_as_new({**payload, "manifest": manifest})
+        return None
+
+    return manifest
+
 # Activity
 @myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
 def read_image(activitypayload):
     data = json.loads(activitypayload)
     container = data.get("container")
     filename = data.get("filename")
+    by_reference = data.get("by_reference", False)
 
     try:
         # Get blob service client using managed identity
         blob_service_client = get_storage_client()
         blob_client = blob_service_client.get_blob_client(container=container, blob=filename)
+        if by_reference:
+            # Only return a small reference, the activities download the bytes themselves
+            properties = blob_client.get_blob_properties()
+            return BlobReference(container=container,
+                                 blob=filename,
+                                 size=properties.size,
+                                 etag=(properties.etag or "").strip('"')).model_dump()
         image_bytes = blob_client.download_blob().readall()
     except Exception as e:
         raise Exception(f"Failed to read image from blob storage: {str(e)}")
@@ -202,17 +934,23 @@ def read_image(activitypayload):
     return base64.b64encode(image_bytes).decode("utf-8")
 
 @myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
 def object_detection(activitypayload):
-    img_data = json.loads(activitypayload).get("image_data")
-    image_data = base64.b64decode(img_data)
+    data = json.loads(activitypayload)
+    if data.get("tile_ref"):
+        # A single tile cut by plan_detection_tiles, the boxes are mapped back to the plan below
+        image_data = read_blob_reference(data["tile_ref"], cache=False)
+    elif data.get("image_ref"):
+        image_data = read_blob_reference(data["image_ref"])
+    else:
+        image_data = base64.b64decode(data.get("image_data"))
+
+    tile = data.get("tile")
 
-    endpoint = os.environ["VISION_PREDICTION_ENDPOINT"]
     project_id = os.environ["CV_PROJECT_ID"]
     model_name = os.environ["CV_MODEL_NAME"]
 
-    # Create Custom Vision client with managed identity
-    credentials = ApiKeyCredentials(in_headers={"Prediction-key": os.environ["CV_KEY"]})  # Custom Vision still requires API key
-    predictor = CustomVisionPredictionClient(endpoint, credentials)
+    predictor = get_custom_vision_client()
     results = predictor.detect_image(project_id, 
                                      model_name, 
                                      image_data)
@@ -230,100 +968,413 @@ def object_detection(activitypayload):
         ) for p in results.predictions
     ]
 
+    if tile:
+        for prediction in predictions:
+            prediction.bounding_box = BoundingBox(**tile_to_plan_box(prediction.bounding_box.model_dump(),
+                                                                     tile,
+                                                                     data["image_width"],
+                                                                     data["image_height"]))
+
     return [pred.json() for pred in predictions]
 
 @myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def normalize_plan(activitypayload):
+    data = json.loads(activitypayload)
+    image_ref = BlobReference.model_validate(data["image_ref"])
+    settings = {key: data[key] for key in ("max_side", "color_mode", "palette_colors") if key in data}
+
+    image = Image.open(BytesIO(read_blob_reference(image_ref)))
+    normalized_bytes = normalize_image(image, image_format="PNG", **settings)
+    if len(normalized_bytes) >= image_ref.size and not settings.get("max_side"):
+        # Nothing gained, detect on the original
+        return {"image_ref": image_ref.model_dump(), "bytes_before": image_ref.size, "bytes_after": image_ref.size}
+
+    image_version = content_address(image_ref.blob) or f"{image_ref.blob}/{image_ref.etag or 'latest'}"
+    settings_name = "-".join(str(settings[key]) for key in sorted(settings))
+    normalized_ref = upload_blob_bytes(image_ref.container,
+                                       f"{os.environ.get('NORMALIZED_PREFIX', 'normalized')}/{image_version}/{settings_name}.png",
+                                       normalized_bytes,
+                                       content_type="image/png")
+    return {"image_ref": normalized_ref.model_dump(), "bytes_before": image_ref.size, "bytes_after": len(normalized_bytes)}
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def plan_detection_tiles(activitypayload):
+    data = json.loads(activitypayload)
+    image_ref = BlobReference.model_validate(data["image_ref"])
+    tile_size = data.get("tile_size", 0)
+    tile_overlap = data.get("tile_overlap", 0)
+    tiles_prefix = os.environ.get("TILES_PREFIX", "tiles")
+    image_version = content_address(image_ref.blob) or f"{image_ref.blob}/{image_ref.etag or 'latest'}"
+
+    # Decode the plan once and cut every tile in one pass, each detection activity
+    # then only fetches its own tile instead of decoding the whole plan again
+    image = Image.open(BytesIO(read_blob_reference(image_ref, cache=False)))
+    width, height = image.size
+    tiles = plan_tiles(width, height, tile_size, tile_overlap)
+    for index, tile in enumerate(tiles):
+        buffered = BytesIO()
+        image.crop((tile["left"], tile["top"], tile["left"] + tile["width"], tile["top"] + tile["height"])).save(buffered, format="PNG")
+        tile_ref = upload_blob_bytes(image_ref.container,
+                                     f"{tiles_prefix}/{image_version}/{tile_size}-{tile_overlap}/{index}.png",
+                                     buffered.getvalue(),
+                                     content_type="image/png")
+        tile["tile_ref"] = tile_ref.model_dump()
+    return {"width": width,
+            "height": height,
+            "tiles": tiles}
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def merge_detections(activitypayload):
+    data = json.loads(activitypayload)
+    iou_threshold = float(data.get("iou_threshold", os.environ.get("DETECTION_MERGE_IOU", 0.5)))
+    predictions = [Prediction.model_validate_json(pred)
+                   for tile_predictions in data.get("tile_predictions", [])
+                   for pred in tile_predictions]
+
+    # Merge the duplicates found in overlapping tiles, per tag. Intersection over the
+    # smaller box also removes the partial boxes cut by a tile seam.
+    boxes = [[p.bounding_box.left, p.bounding_box.top, p.bounding_box.width, p.bounding_box.height] for p in predictions]
+    keep = non_max_suppression(boxes,
+                               [p.probability for p in predictions],
+                               iou_threshold=iou_threshold,
+                               metric="iomin",
+                               labels=[p.tag for p in predictions])
+    merged = [predictions[index] for index in keep]
+
+    return [pred.json() for pred in merged]
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def deduplicate_predictions(activitypayload):
+    data = json.loads(activitypayload)
+    prediction_threshold = data.get("prediction_threshold", 0.5)
+    predictions = [Prediction.model_validate_json(pred) for pred in data.get("predictions", [])]
+    candidates = [p for p in predictions if p.probability > prediction_threshold]
+
+    # Custom Vision often returns several overlapping boxes for one symbol, keep the best one
+    keep, suppressed, capped = deduplicate_boxes(
+        [[p.bounding_box.left, p.bounding_box.top, p.bounding_box.width, p.bounding_box.height] for p in candidates],
+        [p.probability for p in candidates],
+        [p.tag for p in candidates],
+        iou_threshold=float(data.get("iou_threshold", 0.5)),
+        class_agnostic=bool(data.get("class_agnostic", False)),
+        top_k=int(data.get("top_k", 0)) or None)
+
+    return {"predictions": [candidates[index].json() for index in keep],
+            "candidates": len(candidates),
+            "suppressed": suppressed,
+            "capped": capped}
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def register_legend(activitypayload):
+    data = json.loads(activitypayload)
+    reference_ref = BlobReference.model_validate(data["reference_ref"])
+
+    # Legends are stored under their content hash so the same legend is only stored once across runs.
+    # A content-addressed reference already carries the hash, so a known legend isn't downloaded at all.
+    legend_id = content_address(reference_ref.blob)
+    legend_bytes = None
+    if legend_id is None:
+        legend_bytes = read_blob_reference(reference_ref)
+        legend_id = hashlib.sha256(legend_bytes).hexdigest()
+    blob_service_client = get_storage_client()
+    blob_client = blob_service_client.get_blob_client(container=reference_ref.container, blob=legend_blob_name(legend_id))
+    if not blob_client.exists():
+        if legend_bytes is None:
+            legend_bytes = read_blob_reference(reference_ref)
+        blob_client.upload_blob(legend_bytes, overwrite=True)
+
+    # Segment the legend once, the index is shared by every run that uses it
+    index_client = blob_service_client.get_blob_client(container=reference_ref.container, blob=legend_index_blob_name(legend_id))
+    if not index_client.exists():
+        index_legend(reference_ref.container, legend_id, legend_bytes)
+
+    return {"legend_id": legend_id,
+            "container": reference_ref.container,
+            "size": len(legend_bytes) if legend_bytes is not None else reference_ref.size}
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def crop_detections(activitypayload):
+    data = json.loads(activitypayload)
+    image_ref = BlobReference.model_validate(data["image_ref"])
+    prediction_threshold = data.get("prediction_threshold", 0.5)
+    crops_prefix = os.environ.get("CROPS_PREFIX", "crops")
+
+    image_version = content_address(image_ref.blob) or f"{image_ref.blob}/{image_ref.etag or 'latest'}"
+    normalization = data.get("normalization") or {}
+    image_format = normalization.get("image_format", "JPEG")
+    extension, content_type = ("png", "image/png") if image_format == "PNG" else ("jpg", "image/jpeg")
+    # The crop index is a position in the de-duplicated predictions, so the crops are
+    # stored per crop settings and prediction list: runs of the same plan with other
+    # options don't overwrite each other's crops
+    settings_digest = hashlib.sha256(json.dumps({
+        "normalization": normalization,
+        "predictions": data.get("predictions", []),
+        "prediction_threshold": prediction_threshold}, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    # Decode the image once and crop every detection above the threshold in one pass
+    image = Image.open(BytesIO(read_blob_reference(image_ref)))
+    crops = []
+    for index, pred in enumerate(data.get("predictions", [])):
+        prediction = Prediction.model_validate_json(pred)
+        if prediction.probability <= prediction_threshold:
+            continue
+
+        bounding_box = prediction.bounding_box.model_dump()
+        # Deterministic names so a retried activity overwrites its own crops, a
+        # content-addressed plan shares its crops with every run with the same settings
+        crop_name = f"{crops_prefix}/{image_version}/{settings_digest}/{index}.{extension}"
+        crop_bytes = crop_detection(image, bounding_box)
+        bytes_before = len(crop_bytes)
+        if not is_identity(**normalization):
+            crop_bytes = normalize_image(crop_region(image, bounding_box), **normalization)
+        crop_ref = upload_blob_bytes(image_ref.container,
+                                     crop_name,
+                                     crop_bytes,
+                                     content_type=content_type)
+        crops.append({
+            "index": index,
+            "tag": prediction.tag,
+            "probability": prediction.probability,
+            "bounding_box": bounding_box,
+            "crop_ref": crop_ref.model_dump(),
+            "bytes_before": bytes_before
+        })
+
+    return crops
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def match_legend_symbols(activitypayload):
+    data = json.loads(activitypayload)
+    threshold = float(data["threshold"])
+    prompt = data.get("analyze_prompt") or CLASSIFY_PROMPT
+    legend_symbols = get_legend_symbols(data["legend_container"], data["legend_id"])
+    cache = get_classification_cache()
+    labels = [(cache.get(legend_entry_key(data["legend_id"], entry, prompt)) or {}).get("model_response")
+              for entry in range(len(legend_symbols))]
+
+    # Each crop is compared against every legend symbol, a match above the threshold
+    # takes the label the model gave that symbol before. A match without a known label
+    # is escalated with its entry so the model's answer labels the symbol for later crops.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        crops = executor.map(lambda crop_ref: read_blob_reference(crop_ref, cache=False), data["crop_refs"])
+        matches = []
+        for crop_bytes in crops:
+            entry, score = best_match(crop_descriptor(crop_bytes), legend_symbols)
+            if score < threshold:
+                entry = None
+            matches.append({"entry": entry,
+                            "score": round(score, 3),
+                            "label": labels[entry] if entry is not None else None})
+    return matches
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
 def azure_openai_processing(activitypayload):
-    try:
-        # Use managed identity for Azure OpenAI
-        client = AzureOpenAI(
-            azure_endpoint=os.environ["OPENAI_ENDPOINT"],
-            api_version=os.environ.get("OPENAI_API_VERSION", "2024-02-01"),
-            azure_ad_token_provider=credential
-        )
-    except Exception as e:
-        # Fall back to API key if managed identity fails
-        client = AzureOpenAI(
-            azure_endpoint=os.environ["OPENAI_ENDPOINT"],
-            api_key=os.environ["OPENAI_KEY"],
-            api_version=os.environ.get("OPENAI_API_VERSION", "2024-02-01")
-        )
-    prompt ="""
-    Here's an image of a symbol and a legend
-    please match the symbol to the legend and give me the name of the symbol in the legend.
-    Use the exact symbol name as it appears in the legend, all in uppercase
-    only return the name of the symbol or No Match if there is no match
-    
-    Here is the legend
-"""
-    reference_img = json.loads(activitypayload).get("reference_img")
-    detected_img = json.loads(activitypayload).get("image")
-    analyze_prompt = json.loads(activitypayload).get("analyze_prompt")
+    prompt = CLASSIFY_PROMPT
+    data = json.loads(activitypayload)
+    reference_img = data.get("reference_img")
+    detected_img = data.get("image")
+    analyze_prompt = data.get("analyze_prompt")
     if analyze_prompt:
         sys_prompt = analyze_prompt
     else:
         sys_prompt = prompt
 
+    result = {"bounding_box": data.get("bounding_box"),
+              "tag": data.get("tag"),
+              "probability": data.get("probability")}
+
+    # By-reference payloads carry blob references and a legend ID, fetch the bytes here
+    key = None
+    if data.get("crop_ref"):
+        crop_ref = BlobReference.model_validate(data["crop_ref"])
+        crop_bytes = read_blob_reference(crop_ref, cache=False)
+        detected_img = to_data_url(crop_bytes)
+        if data.get("legend_id"):
+            # Repeated symbols are answered from the classification cache without calling the model
+            key = classification_cache_key(crop_bytes, data["legend_id"], sys_prompt)
+            cached = get_classification_cache().get(key)
+            if cached is not None:
+                # A cached answer is still an answer for the matched legend entry
+                remember_legend_entry(data["legend_id"], data.get("legend_entry"), sys_prompt, cached["model_response"])
+                return {"model_response": cached["model_response"], **result, "cache_hit": True}
+            reference_img = get_legend_data_url(data.get("legend_container", crop_ref.container), data["legend_id"], legend_compact())
+
+    client = get_openai_client()
+    # Pick the detail level of each image from its size and the request's token budget
+    legend_part, legend_tokens = legend_content(reference_img)
+    if data.get("crop_ref"):
+        symbol_part, symbol_tokens = image_content(crop_bytes, crop_token_budget(data, legend_tokens, 1))
+    else:
+        symbol_part = {"type": "image_url", "image_url": {"url": detected_img, "detail": "high"}}
+        symbol_tokens = estimate_image_tokens(2048, 2048)
     messages = [
        {
         "role": "user",
         "content": [
           {"type": "text", "text": sys_prompt},
-          {
-            "type": "image_url",
-            "image_url": {
-              "url": reference_img,
-            },
-          }
+          legend_part
         ],
       },
       {
                 "role": "user",
                 "content": [
                     {"type": "text", "text": "Here is the symbol and the legend"},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": detected_img,
-                            "detail": "high"
-                        },
-                    }
+                    symbol_part
                 ],
             }
     ]
+    estimated_prompt_tokens = legend_tokens + symbol_tokens + estimate_text_tokens(sys_prompt + "Here is the symbol and the legend")
 
-    response = client.chat.completions.create(
+    try:
+        # No client side retries, a 429 goes back to the orchestrator which backs off with a durable timer
+        response = client.with_options(max_retries=0).chat.completions.create(
+            model=os.environ["OPENAI_MODEL"],
+            messages=messages
+        )
+    except openai_rate_limit_error() as e:
+        return throttled_result(e)
+
+    model_response = response.choices[0].message.content
+    if key is not None:
+        get_classification_cache().set(key, {"model_response": model_response})
+        remember_legend_entry(data["legend_id"], data.get("legend_entry"), sys_prompt, model_response)
+
+    return {"model_response": model_response, **result, "cache_hit": False,
+            "usage": token_usage(response, estimated_prompt_tokens),
+            "detail": symbol_part["image_url"]["detail"]}
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def azure_openai_batch_processing(activitypayload):
+    data = json.loads(activitypayload)
+    detections = data.get("detections", [])
+    if not detections:
+        return []
+
+    sys_prompt = data.get("analyze_prompt") or CLASSIFY_PROMPT
+    cache = get_classification_cache()
+
+    # Answer repeated symbols from the cache, only the misses are sent to the model
+    cached_labels = {}
+    pending = []
+    for index, detection in enumerate(detections):
+        crop_bytes = read_blob_reference(detection["crop_ref"], cache=False)
+        key = classification_cache_key(crop_bytes, data["legend_id"], sys_prompt)
+        cached = cache.get(key)
+        if cached is not None:
+            cached_labels[index] = cached["model_response"]
+            remember_legend_entry(data["legend_id"], detection.get("legend_entry"), sys_prompt, cached["model_response"])
+        else:
+            pending.append((index, key, crop_bytes))
+
+    labels_by_index = dict(cached_labels)
+    usage = None
+    details = {}
+    if pending:
+        try:
+            labels, usage, details = classify_symbol_batch(data, detections, pending, sys_prompt)
+            labels_by_index.update(labels)
+        except openai_rate_limit_error() as e:
+            return throttled_result(e)
+        for index, key, _ in pending:
+            if index in labels_by_index:
+                cache.set(key, {"model_response": labels_by_index[index]})
+                remember_legend_entry(data["legend_id"], detections[index].get("legend_entry"), sys_prompt, labels_by_index[index])
+
+    results = [{"model_response": labels_by_index.get(index, "No Match"),
+                "bounding_box": detection.get("bounding_box"),
+                "tag": detection.get("tag"),
+                "probability": detection.get("probability"),
+                "cache_hit": index in cached_labels,
+                **({"detail": details[index]} if index in details else {})}
+               for index, detection in enumerate(detections)]
+    if usage:
+        # The request's usage is reported once, on the first symbol sent to the model
+        results[pending[0][0]]["usage"] = usage
+    return results
+
+def classify_symbol_batch(data, detections, pending, sys_prompt):
+    client = get_openai_client()
+    legend_container = data.get("legend_container", detections[0]["crop_ref"]["container"])
+    reference_img = get_legend_data_url(legend_container, data["legend_id"], legend_compact())
+
+    legend_part, legend_tokens = legend_content(reference_img)
+    max_crop_tokens = crop_token_budget(data, legend_tokens, len(pending))
+
+    # One image part per crop, each labelled with its symbol number
+    instructions = BATCH_CLASSIFY_INSTRUCTIONS.format(count=len(pending))
+    symbol_content = [{"type": "text", "text": instructions}]
+    estimated_prompt_tokens = legend_tokens + estimate_text_tokens(sys_prompt + instructions)
+    details = {}
+    for number, (index, _, crop_bytes) in enumerate(pending, start=1):
+        symbol_part, symbol_tokens = image_content(crop_bytes, max_crop_tokens)
+        details[index] = symbol_part["image_url"]["detail"]
+        estimated_prompt_tokens += symbol_tokens + estimate_text_tokens(f"Symbol {number}")
+        symbol_content.append({"type": "text", "text": f"Symbol {number}"})
+        symbol_content.append(symbol_part)
+
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": sys_prompt},
+                legend_part
+            ],
+        },
+        {
+            "role": "user",
+            "content": symbol_content
+        }
+    ]
+
+    response = client.with_options(max_retries=0).chat.completions.create(
         model=os.environ["OPENAI_MODEL"],
-        messages=messages
+        messages=messages,
+        response_format={"type": "json_object"}
     )
 
-    return {"model_response":response.choices[0].message.content,
-            "bounding_box": json.loads(activitypayload).get("bounding_box"),
-            "tag": json.loads(activitypayload).get("tag"),
-            "probability": json.loads(activitypayload).get("probability")}
+    # Map the labels back to the detections, a symbol the model skipped is left out
+    try:
+        labels = json.loads(response.choices[0].message.content).get("labels", [])
+    except (TypeError, ValueError, AttributeError):
+        logging.warning("Could not parse batch classification response")
+        labels = []
+    labels_by_symbol = {}
+    for entry in labels:
+        try:
+            labels_by_symbol[int(entry["symbol"])] = entry["label"]
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    labels_by_index = {index: labels_by_symbol[number]
+                       for number, (index, _, _) in enumerate(pending, start=1)
+                       if number in labels_by_symbol}
+    return labels_by_index, token_usage(response, estimated_prompt_tokens), details
 
 @myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
 def summarize_results(activitypayload):
     data = json.loads(activitypayload)
     object_results = data.get("object_results", [])
     analyze_prompt = data.get("analyze_prompt", "")
 
-    # Create a summary prompt for OpenAI
-    detection_summary = "\n".join([
-        f"- Found {result['tag']} (confidence: {result['probability']:.2%}) identified as: {result['model_response']}"
-        for result in object_results
-    ])
-
-    # Use managed identity for Azure OpenAI
-    client = AzureOpenAI(
-        azure_endpoint=os.environ["OPENAI_ENDPOINT"],
-        api_version=os.environ["OPENAI_API_VERSION"],
-        azure_ad_token_provider=credential
-    )
+    # Counts, confidences and the no-match rate are aggregated locally
+    aggregate = aggregate_results(object_results)
+    summary = format_aggregate(aggregate)
+    if not data.get("narrative", True):
+        return {"summary": summary, "aggregate": aggregate, "narrative": False, "cache_hit": False}
 
     summary_prompt = f"""Given the following floor plan analysis results:
 
-{detection_summary}
+{summary}
 
 Please provide:
 1. A concise summary of the detected elements
@@ -332,6 +1383,14 @@ Please provide:
 
 Keep the response clear and structured."""
 
+    # The narrative only depends on the aggregate and the prompt, plans with the same symbols share it
+    key = cache_key(aggregate_hash(aggregate), "summary", summary_prompt + (analyze_prompt or ""))
+    cached = get_classification_cache().get(key)
+    if cached is not None:
+        return {"summary": cached["summary"], "aggregate": aggregate, "narrative": True, "cache_hit": True}
+
+    client = get_openai_client()
+
     messages = [
         {
             "role": "system",
@@ -350,5 +1409,63 @@ Keep the response clear and structured."""
         max_tokens=500
     )
 
-    return response.choices[0].message.content
+    narrative = response.choices[0].message.content
+    get_classification_cache().set(key, {"summary": narrative})
+    return {"summary": narrative, "aggregate": aggregate, "narrative": True, "cache_hit": False,
+            "usage": token_usage(response, estimate_text_tokens(messages[0]["content"] + summary_prompt))}
 
+def batch_manifest_blob_name(instance_id):
+    return f"{os.environ.get('BATCH_MANIFESTS_PREFIX', 'manifests')}/{instance_id}.json"
+
+def plan_results_blob_name(instance_id):
+    return f"{os.environ.get('RESULTS_PREFIX', 'results')}/{instance_id}.json"
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def list_floorplans(activitypayload):
+    data = json.loads(activitypayload)
+    exclude = set(data.get("exclude") or [])
+    # Skip the blobs written by the pipeline itself
+    internal_prefixes = tuple(f"{os.environ.get(name, default)}/" for name, default in (
+        ("CROPS_PREFIX", "crops"),
+        ("LEGENDS_PREFIX", "legends"),
+        ("LEGEND_INDEX_PREFIX", "legend-index"),
+        ("NORMALIZED_PREFIX", "normalized"),
+        ("TILES_PREFIX", "tiles"),
+        ("CLASSIFICATION_CACHE_PREFIX", "classification-cache"),
+        ("BATCH_MANIFESTS_PREFIX", "manifests"),
+        ("RESULTS_PREFIX", "results")))
+
+    container_client = get_storage_client().get_container_client(data["container"])
+    return sorted(blob.name for blob in container_client.list_blobs(name_starts_with=data.get("prefix") or None)
+                  if blob.name.lower().endswith((".png", ".jpg", ".jpeg"))
+                  and blob.name not in exclude
+                  and not blob.name.startswith(internal_prefixes)
+                  # Legends uploaded by the frontend, reference-<sha256>.<ext>
+                  and not blob.name.rsplit("/", 1)[-1].startswith("reference-"))
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def save_batch_manifest(activitypayload):
+    manifest = json.loads(activitypayload)
+    upload_blob_bytes(manifest["container"],
+                      batch_manifest_blob_name(manifest["instance_id"]),
+                      activitypayload.encode("utf-8"),
+                      content_type="application/json")
+    return batch_manifest_blob_name(manifest["instance_id"])
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def save_plan_results(activitypayload):
+    data = json.loads(activitypayload)
+    results_ref = upload_blob_bytes(data["container"],
+                                    plan_results_blob_name(data["instance_id"]),
+                                    json.dumps(data["results"]).encode("utf-8"),
+                                    content_type="application/json")
+    return results_ref.model_dump()
+
+@myApp.activity_trigger(input_name="activitypayload")
+@instrument_activity
+def load_batch_manifest(activitypayload):
+    data = json.loads(activitypayload)
+    return json.loads(download_blob_bytes(data["container"], batch_manifest_blob_name(data["instance_id"])))
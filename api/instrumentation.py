@@ -0,0 +1,159 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+# Per-stage instrumentation of the pipeline. Every activity is wrapped to log its
+# wall time, payload sizes and OpenAI usage, and to export them as a span when
+# TELEMETRY_EXPORTER is set. The orchestrator collects the same figures per stage
+# with StageMetrics and returns them in the metrics block of its results.
+
+USAGE_FIELDS = ("estimated_prompt_tokens", "prompt_tokens", "completion_tokens")
+
+logger = logging.getLogger("pipeline.metrics")
+
+def payload_bytes(value):
+    # Size of an activity input or output as it goes through the orchestration history
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return len(json.dumps(value, default=str).encode("utf-8"))
+
+def collect_usage(result):
+    # Sums the OpenAI usage reported by an activity result, or by a list of them
+    totals = {}
+    items = result if isinstance(result, (list, tuple)) else [result]
+    for item in items:
+        if isinstance(item, (list, tuple)):
+            usage = collect_usage(item)
+        elif isinstance(item, dict) and isinstance(item.get("usage"), dict):
+            usage = item["usage"]
+        else:
+            continue
+        for field in USAGE_FIELDS:
+            if field in usage:
+                totals[field] = totals.get(field, 0) + usage[field]
+    return totals
+
+# Worker level counters, like the pooled SDK clients, added to the metrics of every activity
+worker_stats = None
+
+def set_worker_stats(provider):
+    global worker_stats
+    worker_stats = provider
+
+def flatten_stats(stats, prefix=""):
+    # {"clients": {"storage": {"created": 1}}} becomes {"clients.storage.created": 1}
+    flat = {}
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            flat.update(flatten_stats(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def client_summary(metrics):
+    created = sum(value for key, value in metrics.items() if key.startswith("clients.") and key.endswith(".created"))
+    reused = sum(value for key, value in metrics.items() if key.startswith("clients.") and key.endswith(".reused"))
+    return f", SDK clients {created} created, {reused} reused" if created or reused else ""
+
+tracer = None
+tracer_lock = threading.Lock()
+
+def get_tracer():
+    # OpenTelemetry is only imported when an exporter is configured. With "azure_monitor"
+    # the spans go to Application Insights, with "opentelemetry" to the globally configured provider.
+    global tracer
+    exporter = os.environ.get("TELEMETRY_EXPORTER", "none").lower()
+    if exporter == "none":
+        return None
+    with tracer_lock:
+        if tracer is None:
+            try:
+                if exporter == "azure_monitor":
+                    from azure.monitor.opentelemetry import configure_azure_monitor
+                    configure_azure_monitor()
+                from opentelemetry import trace
+                tracer = trace.get_tracer("floorplans.pipeline")
+            except ImportError:
+                logging.warning(f"TELEMETRY_EXPORTER is {exporter} but OpenTelemetry is not installed")
+                tracer = False
+    return tracer or None
+
+def export_span(name, metrics, error=None):
+    active_tracer = get_tracer()
+    if active_tracer is None:
+        return
+    end = time.time_ns()
+    span = active_tracer.start_span(f"activity {name}", start_time=end - int(metrics["seconds"] * 1e9))
+    span.set_attribute("pipeline.activity", name)
+    for field, value in metrics.items():
+        span.set_attribute(f"pipeline.{field}", value)
+    if error is not None:
+        span.record_exception(error)
+    span.end(end_time=end)
+
+def instrument_activity(func):
+    # Wraps an activity, the result is returned unchanged
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        payload = args[0] if args else next(iter(kwargs.values()), None)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            metrics = {"seconds": round(time.perf_counter() - start, 4), "input_bytes": payload_bytes(payload)}
+            logger.warning(f"activity {func.__name__} failed after {metrics['seconds']}s", extra={"metrics": metrics})
+            export_span(func.__name__, metrics, e)
+            raise
+        metrics = {"seconds": round(time.perf_counter() - start, 4),
+                   "input_bytes": payload_bytes(payload),
+                   "output_bytes": payload_bytes(result),
+                   **collect_usage(result)}
+        if worker_stats is not None:
+            metrics.update(flatten_stats(worker_stats()))
+        logger.info(f"activity {func.__name__} took {metrics['seconds']}s, "
+                    f"{metrics['input_bytes']} bytes in, {metrics['output_bytes']} bytes out"
+                    f"{client_summary(metrics)}", extra={"metrics": metrics})
+        export_span(func.__name__, metrics)
+        return result
+    return wrapper
+
+class StageMetrics:
+    # Collected in the orchestrator. The times come from context.current_utc_datetime,
+    # which is replayed from the history, so the metrics are the same on every replay.
+    def __init__(self, context):
+        self.context = context
+        self.started = context.current_utc_datetime
+        self.stages = {}
+
+    def measure(self, stage, work, payloads=()):
+        # Use with `yield from`, work is a task or a generator of tasks like the bounded fan-outs
+        started = self.context.current_utc_datetime
+        if inspect.isgenerator(work):
+            result = yield from work
+        else:
+            result = yield work
+        self.record(stage, started, payloads, result)
+        return result
+
+    def record(self, stage, started, payloads, result):
+        stats = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "input_bytes": 0, "output_bytes": 0})
+        stats["calls"] += len(payloads)
+        stats["seconds"] += (self.context.current_utc_datetime - started).total_seconds()
+        stats["input_bytes"] += sum(payload_bytes(payload) for payload in payloads)
+        stats["output_bytes"] += payload_bytes(result)
+        for field, value in collect_usage(result).items():
+            stats[field] = stats.get(field, 0) + value
+
+    def as_dict(self):
+        stages = {stage: {**stats, "seconds": round(stats["seconds"], 3)} for stage, stats in self.stages.items()}
+        return {"total_seconds": round((self.context.current_utc_datetime - self.started).total_seconds(), 3),
+                "hot_stage": max(stages, key=lambda stage: stages[stage]["seconds"]) if stages else None,
+                "stages": stages}
@@ -0,0 +1,38 @@
+import importlib
+
+# Deferred imports for the function app. Each activity only needs one or two of the
+# SDKs, so they are imported on first use instead of on every cold start.
+
+class LazyImport:
+    # Stands in for a module, or an attribute of a module, until it is used. The
+    # attribute is looked up on every use so patching the source module still works.
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._module = None
+
+    def _resolve(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        if self._attribute is None:
+            return self._module
+        return getattr(self._module, self._attribute)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        target = f"{self._module_name}.{self._attribute}" if self._attribute else self._module_name
+        return f"<lazy {target}>"
+
+def lazy_import(module_name, *attributes):
+    # lazy_import("PIL.Image") stands in for the module,
+    # lazy_import("openai", "AzureOpenAI") for one name and with more names a tuple is returned
+    if not attributes:
+        return LazyImport(module_name)
+    if len(attributes) == 1:
+        return LazyImport(module_name, attributes[0])
+    return tuple(LazyImport(module_name, attribute) for attribute in attributes)
@@ -0,0 +1,68 @@
+import base64
+import hashlib
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from template_matching import flatten, segment_legend
+
+# Index of a legend's symbols. The legend is segmented once into its symbol and
+# label entries, each with the boxes of its glyph and label, a hash of the glyph
+# and the downsampled glyph descriptor used by the template matcher. The index is
+# stored next to the legend under its content hash, together with a compact sheet
+# of the entries that the model is shown instead of the full legend image.
+
+INDEX_VERSION = 1
+SHEET_PADDING = 8
+
+def encode_descriptor(descriptor):
+    # Half precision is plenty for a correlation, a descriptor is 2KB
+    return base64.b64encode(descriptor.astype(np.float16).tobytes()).decode("ascii")
+
+def decode_descriptor(encoded):
+    return np.frombuffer(base64.b64decode(encoded), dtype=np.float16).astype(np.float32)
+
+def entry_box(entry):
+    # Box around the glyph and the label of an entry
+    boxes = [entry["glyph_box"]] + ([entry["label_box"]] if entry.get("label_box") else [])
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+def build_legend_index(legend_bytes):
+    image = flatten(Image.open(BytesIO(legend_bytes)))
+    entries = []
+    for entry in segment_legend(image):
+        glyph = np.asarray(image.crop(entry["glyph_box"]).convert("L"))
+        entries.append({"glyph_box": list(entry["glyph_box"]),
+                        "label_box": list(entry["label_box"]) if entry["label_box"] else None,
+                        "glyph_hash": hashlib.sha256(glyph.tobytes()).hexdigest()[:16],
+                        "descriptor": encode_descriptor(entry["descriptor"])})
+    return {"version": INDEX_VERSION,
+            "width": image.width,
+            "height": image.height,
+            "entries": entries}
+
+def legend_sheet(legend_bytes, index):
+    # The entries stacked on a white sheet without the legend's blank space, None when
+    # the legend couldn't be segmented. Every row keeps all of its ink.
+    if not index["entries"]:
+        return None
+    image = flatten(Image.open(BytesIO(legend_bytes)))
+    rows = [image.crop(entry_box(entry)) for entry in index["entries"]]
+    sheet = Image.new("RGB", (max(row.width for row in rows) + 2 * SHEET_PADDING,
+                              sum(row.height for row in rows) + SHEET_PADDING * (len(rows) + 1)), "white")
+    top = SHEET_PADDING
+    for row in rows:
+        sheet.paste(row, (SHEET_PADDING, top))
+        top += row.height + SHEET_PADDING
+    output = BytesIO()
+    sheet.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+def is_current_index(index):
+    # Indexes written by an older version are rebuilt
+    return index.get("version") == INDEX_VERSION
+
+def index_descriptors(index):
+    return [decode_descriptor(entry["descriptor"]) for entry in index["entries"]]
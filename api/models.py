@@ -0,0 +1,20 @@
+from pydantic import BaseModel
+
+# Payload models shared by the activities
+
+class BlobReference(BaseModel):
+    container: str
+    blob: str
+    size: int = 0
+    etag: str = ""
+
+class BoundingBox(BaseModel):
+    left: float
+    top: float
+    width: float
+    height: float
+
+class Prediction(BaseModel):
+    tag: str
+    probability: float
+    bounding_box: BoundingBox
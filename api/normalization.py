@@ -0,0 +1,47 @@
+from io import BytesIO
+
+from PIL import Image
+
+# Image normalization ahead of detection and classification. Floorplans are mostly
+# black and white line art, so dropping the color channels and the resolution the
+# models don't need shrinks every payload without changing what they see.
+# Resizing keeps the aspect ratio, so boxes normalized to the image still apply
+# to the original.
+
+COLOR_MODES = ("rgb", "grayscale", "palette")
+
+def downscale(image, max_side):
+    if not max_side or max(image.size) <= max_side:
+        return image
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGB")
+    scale = max_side / max(image.size)
+    return image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+def convert_color(image, color_mode="rgb", palette_colors=16):
+    # grayscale keeps the anti-aliasing of the lines, palette keeps a few colors
+    # for plans that use them to tell symbols apart
+    if color_mode == "grayscale":
+        return image.convert("L")
+    if color_mode == "palette":
+        return image.convert("RGB").convert("P", palette=Image.ADAPTIVE, colors=palette_colors)
+    if color_mode != "rgb":
+        raise ValueError(f"Unknown color mode: {color_mode}")
+    return image
+
+def encode_image(image, image_format="PNG", quality=None):
+    buffered = BytesIO()
+    if image_format.upper() in ("JPEG", "JPG"):
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(buffered, format="JPEG", quality=quality or 75, optimize=quality is not None)
+    else:
+        image.save(buffered, format="PNG", optimize=True)
+    return buffered.getvalue()
+
+def normalize_image(image, max_side=0, color_mode="rgb", image_format="PNG", quality=None, palette_colors=16):
+    return encode_image(convert_color(downscale(image, max_side), color_mode, palette_colors), image_format, quality)
+
+def is_identity(max_side=0, color_mode="rgb", image_format=None, quality=None, **_):
+    # Whether the settings leave the image as the pipeline encodes it by default
+    return not max_side and color_mode == "rgb" and (image_format or "JPEG").upper() == "JPEG" and quality is None
@@ -0,0 +1,114 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+# Local pre-classification of the symbol crops. Floorplan symbols are often drawn
+# with the same glyph as the legend, so a crop is compared against every legend
+# symbol with normalized cross-correlation and only the crops without a close
+# match are sent to the model. Everything runs on the CPU with NumPy.
+
+GLYPH_SIZE = 32
+
+def flatten(image):
+    # RGB copy of the image, transparent legends are flattened on white
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, "white")
+        return Image.alpha_composite(background, image).convert("RGB")
+    return image.convert("RGB")
+
+def ink_mask(image):
+    # True where there is ink
+    gray = ImageOps.autocontrast(flatten(image).convert("L"))
+    return np.asarray(gray) < 128
+
+def ink_box(mask):
+    # (left, top, right, bottom) of the ink, None for a blank mask
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return None
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+def runs(flags, max_gap=0):
+    # Start and end of the runs of True values, runs separated by up to max_gap False values are joined
+    spans = []
+    for index in np.flatnonzero(flags):
+        if spans and index - spans[-1][1] <= max_gap:
+            spans[-1][1] = int(index) + 1
+        else:
+            spans.append([int(index), int(index) + 1])
+    return [tuple(span) for span in spans]
+
+def glyph_descriptor(mask):
+    # The ink is padded to a square, so the aspect ratio is kept, and scaled to
+    # GLYPH_SIZE, then blurred so thin lines a pixel apart still overlap. The result is
+    # zero mean and unit norm, so the dot product of two descriptors is their
+    # normalized cross-correlation.
+    box = ink_box(mask)
+    if box is None:
+        return None
+    left, top, right, bottom = box
+    glyph = mask[top:bottom, left:right]
+    side = max(glyph.shape)
+    square = np.zeros((side, side), dtype=np.uint8)
+    row = (side - glyph.shape[0]) // 2
+    col = (side - glyph.shape[1]) // 2
+    square[row:row + glyph.shape[0], col:col + glyph.shape[1]] = glyph * 255
+    scaled = Image.fromarray(square).resize((GLYPH_SIZE, GLYPH_SIZE), Image.BOX).filter(ImageFilter.GaussianBlur(1))
+    scaled = np.asarray(scaled, dtype=np.float32)
+    scaled -= scaled.mean()
+    norm = np.linalg.norm(scaled)
+    if norm == 0:
+        return None
+    return (scaled / norm).ravel()
+
+def crop_descriptor(image_bytes):
+    return glyph_descriptor(ink_mask(Image.open(BytesIO(image_bytes))))
+
+def segment_legend(image):
+    # Legends list one symbol per row with its label to the right. Rows are split on
+    # blank lines and a row's ink on the first wide horizontal gap: the left part is
+    # the symbol, the rest is the label.
+    mask = ink_mask(image)
+    row_gap = max(4, round(mask.shape[0] * 0.01))
+    entries = []
+    for top, bottom in runs(mask.any(axis=1), row_gap):
+        band = mask[top:bottom]
+        column_gap = max(4, round((bottom - top) * 0.1))
+        clusters = runs(band.any(axis=0), column_gap)
+        glyph_left, glyph_right = clusters[0]
+        glyph = band[:, glyph_left:glyph_right]
+        glyph_rows = runs(glyph.any(axis=1))
+        glyph_top, glyph_bottom = glyph_rows[0][0], glyph_rows[-1][1]
+        descriptor = glyph_descriptor(glyph)
+        if descriptor is None:
+            continue
+        entry = {"glyph_box": (glyph_left, top + glyph_top, glyph_right, top + glyph_bottom),
+                 "label_box": None,
+                 "descriptor": descriptor}
+        if len(clusters) > 1:
+            label = band[:, clusters[1][0]:clusters[-1][1]]
+            label_rows = runs(label.any(axis=1))
+            entry["label_box"] = (clusters[1][0], top + label_rows[0][0], clusters[-1][1], top + label_rows[-1][1])
+        entries.append(entry)
+    return entries
+
+def orientations(descriptor):
+    # The eight rotations and mirror images of a descriptor, symbols are placed in any orientation
+    glyph = descriptor.reshape(GLYPH_SIZE, GLYPH_SIZE)
+    variants = []
+    for flipped in (glyph, np.fliplr(glyph)):
+        for turns in range(4):
+            variants.append(np.rot90(flipped, turns).ravel())
+    return np.stack(variants)
+
+def best_match(descriptor, legend_descriptors):
+    # Index of the closest legend symbol and its correlation, (None, 0.0) when nothing can be compared
+    if descriptor is None or not len(legend_descriptors):
+        return None, 0.0
+    scores = orientations(descriptor) @ np.stack(legend_descriptors).T
+    best = scores.max(axis=0)
+    entry = int(best.argmax())
+    return entry, float(best[entry])
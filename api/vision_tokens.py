@@ -0,0 +1,64 @@
+import base64
+import math
+from io import BytesIO
+
+from PIL import Image
+
+# Image detail policy for the vision requests. With "high" detail an image costs
+# a base of 85 tokens plus 170 per 512px tile after it is scaled to fit 2048x2048
+# and its shortest side to 768px. With "low" detail it is a flat 85 tokens for a
+# 512x512 view, which loses nothing for the small symbol crops.
+
+LOW_DETAIL_TOKENS = 85
+TILE_TOKENS = 170
+
+def high_detail_size(width, height):
+    # Size the service scales an image to before tiling it
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    return math.ceil(width * scale), math.ceil(height * scale)
+
+def estimate_image_tokens(width, height, detail="high"):
+    if detail == "low":
+        return LOW_DETAIL_TOKENS
+    width, height = high_detail_size(width, height)
+    return LOW_DETAIL_TOKENS + TILE_TOKENS * math.ceil(width / 512) * math.ceil(height / 512)
+
+def estimate_text_tokens(text):
+    # About four characters per token for English prompts
+    return math.ceil(len(text or "") / 4)
+
+def choose_detail(width, height, max_tokens=None, low_detail_max_side=512):
+    # Returns the detail level, the size to resize the image to (None to keep it)
+    # and the estimated tokens. Images that fit the low detail view use it, larger
+    # ones use high detail and are shrunk until they fit max_tokens.
+    if max(width, height) <= low_detail_max_side:
+        return {"detail": "low", "size": None, "tokens": LOW_DETAIL_TOKENS}
+
+    tokens = estimate_image_tokens(width, height)
+    if not max_tokens or tokens <= max_tokens:
+        return {"detail": "high", "size": None, "tokens": tokens}
+
+    for max_side in (1536, 1024, 768, 512):
+        scale = max_side / max(width, height)
+        if scale >= 1:
+            continue
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        tokens = estimate_image_tokens(*size)
+        if tokens <= max_tokens:
+            return {"detail": "high", "size": size, "tokens": tokens}
+    return {"detail": "low", "size": None, "tokens": LOW_DETAIL_TOKENS}
+
+def image_size(image_bytes):
+    # Pixel dimensions from the image header, None when it can't be read
+    try:
+        return Image.open(BytesIO(image_bytes)).size
+    except Exception:
+        return None
+
+def data_url_image_size(data_url):
+    try:
+        return image_size(base64.b64decode(data_url.split(",", 1)[1]))
+    except Exception:
+        return None
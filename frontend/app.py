@@ -1,12 +1,15 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
 import time
-from azure.storage.blob import BlobServiceClient
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
-import uuid
+import hashlib
 import json
 from datetime import datetime
 from PIL import Image, ImageDraw
+from io import BytesIO
 import os
 from dotenv import load_dotenv
 
@@ -15,6 +18,173 @@ st.set_page_config(layout="wide", page_title="Azure AI Vision Agent Floorplans",
 
 load_dotenv()
 
+@st.cache_resource(show_spinner=False)
+def get_container_client(conn_str, account, container_name, client_id=None):
+    # One blob client per process: the credential, its token and the connection pool
+    # are reused by every upload and the container is only checked once. Failures
+    # raise and aren't cached, so the next call tries again.
+    # Large scans are uploaded as blocks of UPLOAD_BLOCK_SIZE sent in parallel.
+    transfer_options = {
+        "max_block_size": int(os.getenv("UPLOAD_BLOCK_SIZE", 4 * 1024 * 1024)),
+        "max_single_put_size": int(os.getenv("UPLOAD_SINGLE_PUT_SIZE", 8 * 1024 * 1024))}
+    if conn_str:
+        client = BlobServiceClient.from_connection_string(conn_str, **transfer_options)
+    elif account:
+        # DefaultAzureCredential tries:
+        # 1. Environment variables
+        # 2. Managed Identity
+        # 3. Azure CLI
+        # 4. Visual Studio Code credentials
+        client = BlobServiceClient(
+            account_url=f"https://{account}.blob.core.windows.net",
+            credential=DefaultAzureCredential(managed_identity_client_id=client_id) if client_id else DefaultAzureCredential(),
+            **transfer_options
+        )
+    else:
+        raise ValueError("No valid authentication method available")
+
+    container_client = client.get_container_client(container_name)
+    container_client.get_container_properties()
+    return container_client
+
+def display_copy(image, max_side):
+    # RGB copy of the plan scaled to fit max_side, the boxes are normalized so they scale with it
+    image = image.convert("RGB")
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    return image
+
+def draw_boxes(image, detections):
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+    
+    for detection in detections:
+        box = detection['bounding_box']
+        left = box['left'] * width
+        top = box['top'] * height
+        right = left + (box['width'] * width)
+        bottom = top + (box['height'] * height)
+        
+        # Draw rectangle
+        draw.rectangle([left, top, right, bottom], outline="red", width=3)
+        
+        # Draw label
+        label = f"{detection['tag']} ({detection['probability']:.2f})"
+        if detection.get('model_response'):
+            label += f": {detection['model_response'][:40]}"
+        draw.text((left, top-20), label, fill="red")
+        
+    return image
+
+def crop_box(image, bounding_box):
+    img_width, img_height = image.size
+    left = int(bounding_box["left"] * img_width)
+    top = int(bounding_box["top"] * img_height)
+    width = int(bounding_box["width"] * img_width)
+    height = int(bounding_box["height"] * img_height)
+    return image.crop((left, top, left + width, top + height))
+
+# Rendering is cached across reruns by the plan's hash and the analysis instance ID,
+# arguments starting with an underscore aren't hashed by Streamlit
+@st.cache_data(show_spinner=False, max_entries=16)
+def display_plan(image_hash, _image_bytes, max_side):
+    return display_copy(Image.open(BytesIO(_image_bytes)), max_side)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def render_overlay(image_hash, instance_id, _image_bytes, _detections, max_side):
+    return draw_boxes(display_plan(image_hash, _image_bytes, max_side), _detections)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def render_thumbnails(image_hash, instance_id, indices, _image_bytes, _detections, size):
+    # Thumbnails are cut from the full resolution plan, it is decoded once per call
+    image = Image.open(BytesIO(_image_bytes)).convert("RGB")
+    thumbnails = []
+    for index in indices:
+        thumbnail = crop_box(image, _detections[index]["bounding_box"])
+        thumbnail.thumbnail((size, size))
+        thumbnails.append(thumbnail)
+    return thumbnails
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def raw_output_json(instance_id, _output):
+    return json.dumps(_output, indent=2)
+
+class StatusPoller:
+    # Polls the durable status endpoint over one pooled HTTP session. Polls start
+    # fast and back off exponentially up to max_interval, a Retry-After header from
+    # the endpoint takes precedence and a change in progress resets the interval.
+    def __init__(self, session=None, initial_interval=None, max_interval=None, backoff=1.5):
+        self.session = session or self.create_session()
+        self.initial_interval = float(initial_interval or os.getenv("POLL_INITIAL_INTERVAL", 0.5))
+        self.max_interval = float(max_interval or os.getenv("POLL_MAX_INTERVAL", 5))
+        self.backoff = backoff
+        self.last_metrics = None
+
+    @staticmethod
+    def create_session():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @staticmethod
+    def retry_after(response):
+        try:
+            return float(str(response.headers.get("Retry-After")))
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def post(self, url, payload):
+        return self.session.post(url, json=payload)
+
+    def wait(self, status_url, timeout=300, on_progress=None):
+        # Returns the final status, or None when the orchestration failed or timed out
+        start_time = time.time()
+        interval = self.initial_interval
+        last_progress = None
+        metrics = {"polls": 0, "sleep_seconds": 0.0, "first_progress_seconds": None}
+        self.last_metrics = metrics
+        try:
+            while True:
+                response = self.session.get(status_url)
+                metrics["polls"] += 1
+                status = response.json()
+
+                if status["runtimeStatus"] == "Completed":
+                    return status
+                elif status["runtimeStatus"] in ("Failed", "Terminated", "Canceled"):
+                    st.error(f"Function {status['runtimeStatus'].lower()}")
+                    return None
+
+                progress = status.get("customStatus")
+                if progress and progress != last_progress:
+                    last_progress = progress
+                    interval = self.initial_interval
+                    if metrics["first_progress_seconds"] is None:
+                        metrics["first_progress_seconds"] = round(time.time() - start_time, 3)
+                    if on_progress:
+                        on_progress(progress)
+
+                delay = self.retry_after(response)
+                if delay is None:
+                    delay = interval
+                    interval = min(self.max_interval, interval * self.backoff)
+                delay = min(delay, self.max_interval)
+                if time.time() - start_time + delay > timeout:
+                    st.error("Function timed out")
+                    return None
+                time.sleep(delay)
+                metrics["sleep_seconds"] += delay
+        finally:
+            metrics["wait_seconds"] = round(time.time() - start_time, 3)
+
+@st.cache_resource(show_spinner=False)
+def get_status_session():
+    # One pooled HTTP session per process for the status polls, so the connections
+    # to the function app are reused across reruns instead of a session per rerun
+    return StatusPoller.create_session()
+
 class FloorplanApp:
     def __init__(self):
         # Try to get the storage account name from connection string or environment
@@ -35,66 +205,46 @@ class FloorplanApp:
         function_app_url = os.getenv("FUNCTION_APP_URL", "http://localhost:7071")
         self.FUNCTION_START_URL = function_app_url.rstrip('/') + "/api/orchestrators/vision_agent_orchestrator"
         st.info(f"Using Function URL: {self.FUNCTION_START_URL}")
+        # The poller is cheap, its keep-alive session is shared by every rerun
+        self.poller = StatusPoller(session=get_status_session())
+        self.DISPLAY_MAX_SIDE = int(os.getenv("DISPLAY_MAX_SIDE", 1600))
+        self.THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 96))
+        self.RESULTS_PAGE_SIZE = int(os.getenv("RESULTS_PAGE_SIZE", 25))
 
-    def get_blob_service_client(self):
+    def get_container_client(self):
         try:
-            # For local development, try connection string first
-            if self.STORAGE_CONN_STR:
-                st.info("📝 Using connection string authentication...")
-                try:
-                    client = BlobServiceClient.from_connection_string(self.STORAGE_CONN_STR)
-                    client.get_service_properties()
-                    st.info("✅ Successfully connected with connection string")
-                    return client
-                except Exception as e:
-                    st.error(f"❌ Connection string auth failed: {str(e)}")
-
-            # For local development with Azure CLI or Azure-hosted scenarios
-            if self.STORAGE_ACCOUNT:
-                st.info(f"📝 Attempting Azure authentication for {self.STORAGE_ACCOUNT}...")
-                try:
-                    # DefaultAzureCredential tries:
-                    # 1. Environment variables
-                    # 2. Managed Identity
-                    # 3. Azure CLI
-                    # 4. Visual Studio Code credentials
-                    credential = DefaultAzureCredential()
-                    
-                    client = BlobServiceClient(
-                        account_url=f"https://{self.STORAGE_ACCOUNT}.blob.core.windows.net",
-                        credential=credential
-                    )
-                    
-                    # Test the connection
-                    client.get_service_properties()
-                    st.info("✅ Successfully connected using Azure authentication")
-                    return client
-                except Exception as e:
-                    st.error(f"❌ Azure authentication failed: {str(e)}")
-                    if hasattr(e, 'message'):
-                        st.error(f"Error details: {e.message}")
-            
-            st.error("❌ No valid authentication method available")
-            return None
-            
+            return get_container_client(self.STORAGE_CONN_STR,
+                                        self.STORAGE_ACCOUNT,
+                                        self.CONTAINER_NAME,
+                                        self.MANAGED_IDENTITY_CLIENT_ID)
         except Exception as e:
-            st.error(f"❌ Error creating blob client: {str(e)}")
-            if hasattr(e, 'message'):
-                st.error(f"Error message: {e.message}")
+            st.error(f"❌ Container access error ({type(e).__name__}): {str(e)}")
+            if hasattr(e, 'error_code'):
+                st.error(f"Container error code: {e.error_code}")
             return None
 
-    def upload_to_blob(self, file, blob_name):
+    def content_addressed_name(self, file, kind):
+        # Blob name from a streaming SHA-256 of the file, e.g. floorplan-<sha256>.png,
+        # so the same file always maps to the same blob
+        sha256 = hashlib.sha256()
+        file.seek(0)
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+        file.seek(0)
+        extension = os.path.splitext(getattr(file, 'name', '') or '')[1].lower()
+        if extension not in (".png", ".jpg", ".jpeg"):
+            extension = ".png"
+        return f"{kind}-{sha256.hexdigest()}{extension}"
+
+    def upload_to_blob(self, file, blob_name, skip_existing=False):
         max_retries = 3
         retry_delay = 1  # seconds
+        max_concurrency = int(os.getenv("UPLOAD_MAX_CONCURRENCY", 4))
         
         for attempt in range(max_retries):
             try:
-                st.info(f"Upload attempt {attempt + 1} of {max_retries} for {blob_name}")
-                
-                # Get the blob service client
-                blob_service_client = self.get_blob_service_client()
-                if not blob_service_client:
-                    st.error("Failed to get blob service client")
+                container_client = self.get_container_client()
+                if not container_client:
                     if attempt < max_retries - 1:
                         st.info(f"Retrying in {retry_delay} seconds...")
                         time.sleep(retry_delay)
@@ -102,27 +252,11 @@ class FloorplanApp:
                         continue
                     return None
                 
-                # Create the blob client for the container
-                st.info(f"Creating blob client for container: {self.CONTAINER_NAME}")
-                try:
-                    container_client = blob_service_client.get_container_client(self.CONTAINER_NAME)
-                    # Test container access
-                    container_client.get_container_properties()
-                    st.info("✅ Successfully accessed container")
-                except Exception as container_e:
-                    st.error(f"❌ Container access error ({type(container_e).__name__}): {str(container_e)}")
-                    if hasattr(container_e, 'error_code'):
-                        st.error(f"Container error code: {container_e.error_code}")
-                    if attempt < max_retries - 1:
-                        st.info(f"Retrying in {retry_delay} seconds...")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2
-                        continue
-                    return None
-                
-                # Create blob client and upload
                 blob_client = container_client.get_blob_client(blob_name)
-                st.info("Starting blob upload...")
+                if skip_existing and blob_client.exists():
+                    # Content-addressed blobs never change, an existing one is already this file
+                    st.info(f"✅ {blob_name} is already uploaded")
+                    return blob_client.url
                 
                 # Get file size and type info
                 file.seek(0, 2)  # Seek to end
@@ -130,13 +264,12 @@ class FloorplanApp:
                 file.seek(0)  # Reset to beginning
                 content_type = getattr(file, 'type', 'application/octet-stream')
                 
-                st.info(f"Uploading file: size={file_size} bytes, type={content_type}")
-                
-                # Upload with metadata
-                from azure.storage.blob import ContentSettings
+                # Upload with metadata, blocks of large files are sent in parallel
                 blob_client.upload_blob(
                     file,
+                    length=file_size,
                     overwrite=True,
+                    max_concurrency=max_concurrency,
                     content_settings=ContentSettings(
                         content_type=content_type
                     ),
@@ -147,21 +280,13 @@ class FloorplanApp:
                     }
                 )
                 
-                st.info(f"✅ Successfully uploaded blob: {blob_name}")
-                url = blob_client.url
-                st.info(f"Blob URL: {url}")
-                return url
+                st.info(f"✅ Uploaded {blob_name} ({file_size} bytes)")
+                return blob_client.url
                 
             except Exception as e:
                 st.error(f"❌ Error uploading to blob storage (Attempt {attempt + 1}) ({type(e).__name__}): {str(e)}")
                 if hasattr(e, 'error_code'):
                     st.error(f"Error code: {e.error_code}")
-                if hasattr(e, 'response'):
-                    st.error(f"Response status: {e.response.status_code}")
-                if hasattr(e, 'response'):
-                    st.error(f"Response text: {e.response.text}")
-                if hasattr(e, '__dict__'):
-                    st.error(f"Error details: {e.__dict__}")
                 
                 if attempt < max_retries - 1:
                     st.info(f"Retrying in {retry_delay} seconds...")
@@ -173,11 +298,21 @@ class FloorplanApp:
         
         return None
 
+    def upload_files(self, uploads, skip_existing=False):
+        # Uploads (file, blob_name) pairs concurrently and returns their URLs in order
+        ctx = get_script_run_ctx()
+        def upload(item):
+            # Worker threads need the script context to write to the page
+            add_script_run_ctx(ctx=ctx)
+            return self.upload_to_blob(*item, skip_existing=skip_existing)
+        with ThreadPoolExecutor(max_workers=max(1, len(uploads))) as executor:
+            return list(executor.map(upload, uploads))
+
     def start_durable_function(self, filename, reference_filename, analyze_prompt):
         try:
-            response = requests.post(
+            response = self.poller.post(
                 self.FUNCTION_START_URL,
-                json={
+                {
                     "container": self.CONTAINER_NAME,
                     "filename": filename,
                     "reference_filename": reference_filename,
@@ -190,60 +325,53 @@ class FloorplanApp:
             st.error(f"Error starting function: {e}")
             return None
 
-    def poll_function_status(self, status_url, timeout=300):
-        start_time = time.time()
-        while True:
-            if time.time() - start_time > timeout:
-                st.error("Function timed out")
-                return None
-                
-            try:
-                response = requests.get(status_url)
-                status = response.json()
-                
-                if status["runtimeStatus"] == "Completed":
-                    return status
-                elif status["runtimeStatus"] == "Failed":
-                    st.error("Function failed")
-                    return None
-                    
-                time.sleep(5)
-            except Exception as e:
-                st.error(f"Error polling function status: {e}")
-                return None
+    def poll_function_status(self, status_url, timeout=300, on_progress=None):
+        # on_progress is called with the orchestration's custom status every time it changes
+        try:
+            return self.poller.wait(status_url, timeout=timeout, on_progress=on_progress)
+        except Exception as e:
+            st.error(f"Error polling function status: {e}")
+            return None
+
+    def decode_progress(self, progress):
+        # Expand the compact partial results published by the orchestrator
+        detections = []
+        for left, top, width, height, tag, probability, label in progress.get("results", []):
+            detection = {"bounding_box": {"left": left, "top": top, "width": width, "height": height},
+                         "tag": tag,
+                         "probability": probability}
+            if label:
+                detection["model_response"] = label
+            detections.append(detection)
+        return detections
 
     def draw_bounding_boxes(self, image, detections):
-        draw = ImageDraw.Draw(image)
-        width, height = image.size
-        
-        for detection in detections:
-            box = detection['bounding_box']
-            left = box['left'] * width
-            top = box['top'] * height
-            right = left + (box['width'] * width)
-            bottom = top + (box['height'] * height)
-            
-            # Draw rectangle
-            draw.rectangle([left, top, right, bottom], outline="red", width=3)
-            
-            # Draw label
-            label = f"{detection['tag']} ({detection['probability']:.2f})"
-            draw.text((left, top-20), label, fill="red")
-            
-        return image
+        # Draws on a copy, the plan itself is left as uploaded
+        return draw_boxes(image.copy(), detections)
 
     def crop_detected_regions(self, image, detections):
-        cropped_images = []
-        img_width, img_height = image.size
-        for detection in detections:
-            bbox = detection["bounding_box"]
-            left = int(bbox["left"] * img_width)
-            top = int(bbox["top"] * img_height)
-            width = int(bbox["width"] * img_width)
-            height = int(bbox["height"] * img_height)
-            cropped_img = image.crop((left, top, left + width, top + height))
-            cropped_images.append((cropped_img, detection))
-        return cropped_images
+        return [(crop_box(image, detection["bounding_box"]), detection) for detection in detections]
+
+    def analysis_overlay(self, analysis):
+        # Boxes drawn on a display resolution copy of the plan, rendered once per analysis
+        return render_overlay(analysis["plan_hash"], analysis["instance_id"], analysis["plan_bytes"],
+                              analysis["result"]["output"]["detections"], self.DISPLAY_MAX_SIDE)
+
+    def filter_detections(self, detections, tags=None, labels=None):
+        # Indices of the detections with one of the tags and one of the labels, an empty filter keeps all
+        return [index for index, detection in enumerate(detections)
+                if (not tags or str(detection.get("tag")) in tags)
+                and (not labels or str(detection.get("model_response")) in labels)]
+
+    def paginate(self, indices, page, page_size):
+        # The indices on a 1-based page and the page count, out of range pages are clamped
+        page_count = max(1, -(-len(indices) // page_size))
+        page = min(max(1, page), page_count)
+        return indices[(page - 1) * page_size:page * page_size], page_count
+
+    def analysis_thumbnails(self, analysis, indices):
+        return render_thumbnails(analysis["plan_hash"], analysis["instance_id"], tuple(indices), analysis["plan_bytes"],
+                                 analysis["result"]["output"]["detections"], self.THUMBNAIL_SIZE)
 
 # Rest of the UI code...
 app = FloorplanApp()
@@ -295,53 +423,92 @@ with tab1:
     if run_analysis and fp_image and ref_image and prompt:
         with topcol1:
             with st.spinner("Uploading files to Azure Blob Storage..."):
-                fp_name = f"floorplan-{uuid.uuid4()}.png"
-                ref_name = f"reference-{uuid.uuid4()}.png"
-                fp_url = app.upload_to_blob(fp_image, fp_name)
-                ref_url = app.upload_to_blob(ref_image, ref_name)
+                fp_name = app.content_addressed_name(fp_image, "floorplan")
+                ref_name = app.content_addressed_name(ref_image, "reference")
+                fp_url, ref_url = app.upload_files([(fp_image, fp_name), (ref_image, ref_name)], skip_existing=True)
             
             with st.spinner("Starting Azure Durable Function..."):
                 status_url = app.start_durable_function(fp_name, ref_name, prompt)
 
+            # Show the boxes and labels found so far while the analysis runs
+            progress_text = st.empty()
+            progress_image = st.empty()
+            fp_bytes = fp_image.getvalue()
+            def show_progress(progress):
+                detections = app.decode_progress(progress)
+                if "detections" in progress:
+                    progress_text.info(f"{progress['phase'].capitalize()}: {progress['classified']} of {progress['detections']} symbols classified")
+                else:
+                    progress_text.info(f"{progress['phase'].capitalize()}...")
+                if detections:
+                    image = draw_boxes(display_plan(fp_name, fp_bytes, app.DISPLAY_MAX_SIDE), detections)
+                    progress_image.image(image, caption="Partial results")
+
             with st.spinner("Waiting for analysis to complete..."):
-                result = app.poll_function_status(status_url)
+                result = app.poll_function_status(status_url, on_progress=show_progress)
+            progress_text.empty()
+            progress_image.empty()
+            if app.poller.last_metrics:
+                metrics = app.poller.last_metrics
+                st.caption(f"Waited {metrics['wait_seconds']:.1f}s over {metrics['polls']} status polls"
+                           + (f", first results after {metrics['first_progress_seconds']:.1f}s" if metrics['first_progress_seconds'] is not None else ""))
             
             with st.spinner("Process completed"):
                 st.success("Analysis completed successfully!")
             
         if result and result["runtimeStatus"] == "Completed":
-            with tab2:
-                st.subheader("Summary")
-                st.markdown(result["output"]["summary"])
-
-            with tab3:
-                cola, colb = st.columns([2.5,1.5])
-                with cola:
-                    st.subheader("Detailed Analysis")
-                    # Load and cache image
-                    if 'processed_image' not in st.session_state:
-                        image = Image.open(fp_image)
-                        detections = result["output"]["detections"]
-                        image_with_boxes = app.draw_bounding_boxes(image, detections)
-                        st.session_state.processed_image = image_with_boxes
-                        st.session_state.original_image = image
-                    
-                    st.subheader("Object Detection Output")
-                    st.image(st.session_state.processed_image, caption="Detected Objects")
-
-                with colb:
-                    if 'original_image' in st.session_state:
-                        cropped_images = app.crop_detected_regions(st.session_state.original_image, result["output"]["detections"])
-                        st.subheader("Outputs")
-                        for cropped_img, detection in cropped_images:
-                            sub_col1, sub_col2 = st.columns([0.5,2])
-                            with sub_col1:
-                                st.image(cropped_img, width=50)
-                            with sub_col2:
-                                st.json(detection)
-                        st.subheader("Raw Output")
-                        st.json(result["output"])
+            # The analysis is kept across reruns, its rendering is cached by plan hash and instance ID
+            st.session_state.analysis = {"instance_id": result.get("instanceId") or status_url,
+                                         "plan_hash": fp_name,
+                                         "plan_bytes": fp_bytes,
+                                         "result": result}
         else:
             if result:  # Only show error if result exists but failed
                 st.error(f"Function failed with status: {result['runtimeStatus']}")
                 st.json(result)
+
+analysis = st.session_state.get("analysis")
+if analysis:
+    result = analysis["result"]
+    with tab2:
+        st.subheader("Summary")
+        st.markdown(result["output"]["summary"])
+
+    with tab3:
+        cola, colb = st.columns([2.5,1.5])
+        with cola:
+            st.subheader("Detailed Analysis")
+            st.subheader("Object Detection Output")
+            st.image(app.analysis_overlay(analysis), caption="Detected Objects")
+
+        with colb:
+            detections = result["output"]["detections"]
+            st.subheader("Outputs")
+            # Only the filtered page of detections is rendered, thumbnails are cut for the visible rows
+            filter_col1, filter_col2 = st.columns(2)
+            with filter_col1:
+                tags = st.multiselect("Tag", sorted({str(d.get("tag")) for d in detections}), key="filter_tags")
+            with filter_col2:
+                labels = st.multiselect("Label", sorted({str(d.get("model_response")) for d in detections}), key="filter_labels")
+            indices = app.filter_detections(detections, tags, labels)
+            _, page_count = app.paginate(indices, 1, app.RESULTS_PAGE_SIZE)
+            # The page starts over for a new analysis or filter
+            page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1,
+                                   key=f"results_page-{analysis['instance_id']}-{len(indices)}")
+            page_indices, _ = app.paginate(indices, int(page), app.RESULTS_PAGE_SIZE)
+            st.caption(f"{len(indices)} of {len(detections)} detections")
+
+            for index, thumbnail in zip(page_indices, app.analysis_thumbnails(analysis, page_indices)):
+                detection = detections[index]
+                sub_col1, sub_col2 = st.columns([0.5,2])
+                with sub_col1:
+                    st.image(thumbnail, width=50)
+                with sub_col2:
+                    st.markdown(f"**{detection.get('model_response') or 'Unclassified'}**  \n"
+                                f"#{index} {detection['tag']} ({detection['probability']:.2f})")
+
+            st.subheader("Raw Output")
+            st.download_button("Download raw output",
+                               data=raw_output_json(analysis["instance_id"], result["output"]),
+                               file_name=f"{analysis['plan_hash'].rsplit('.', 1)[0]}-results.json",
+                               mime="application/json")
@@ -0,0 +1,442 @@
+"""Offline end-to-end harness for the floorplan pipeline.
+
+Runs the real vision_agent_orchestrator and activities from api/function_app.py
+with local stand-ins for Azure: a durable context that runs the activities on a
+thread pool, an in-memory blob store, a fake Custom Vision detector and a fake
+Azure OpenAI client with configurable latency and 429 injection.
+
+    python scripts/pipeline_harness.py --openai-latency 0.3 --throttle-rate 0.05
+
+Reports plans/min, p50/p95 plan latency and the payload bytes of every stage.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import patch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "api"))
+
+import function_app  # noqa: E402
+from vision_tokens import estimate_image_tokens, estimate_text_tokens, data_url_image_size  # noqa: E402
+
+TAGS = ["door", "window", "outlet", "light", "switch"]
+LABELS = ["DUPLEX OUTLET", "SINGLE POLE SWITCH", "CEILING LIGHT", "EXIT SIGN", "SMOKE DETECTOR", "No Match"]
+
+# Stage the current thread is running, used to attribute blob traffic
+current_stage = threading.local()
+
+class StageStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, **values):
+        with self._lock:
+            stats = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "input_bytes": 0, "output_bytes": 0,
+                                                   "blob_read_bytes": 0, "blob_written_bytes": 0})
+            for key, value in values.items():
+                stats[key] += value
+
+def record_blob_traffic(stats, key, size):
+    stats.add(getattr(current_stage, "name", "harness"), **{key: size})
+
+class InMemoryBlobStore:
+    """Stands in for BlobServiceClient, the blobs are kept in a dict"""
+    def __init__(self, stats):
+        self.blobs = {}
+        self.stats = stats
+        self._lock = threading.Lock()
+        self._version = 0
+
+    def put(self, container, name, data):
+        with self._lock:
+            self._version += 1
+            self.blobs[(container, name)] = (bytes(data), f"0x{self._version:08X}")
+            return self.blobs[(container, name)][1]
+
+    def get_blob_client(self, container, blob):
+        return InMemoryBlobClient(self, container, blob)
+
+    def get_container_client(self, container):
+        return InMemoryContainerClient(self, container)
+
+class InMemoryContainerClient:
+    def __init__(self, store, container):
+        self.store = store
+        self.container = container
+
+    def get_blob_client(self, blob):
+        return InMemoryBlobClient(self.store, self.container, blob)
+
+    def list_blobs(self, name_starts_with=None):
+        return [SimpleNamespace(name=name) for container, name in sorted(self.store.blobs)
+                if container == self.container and name.startswith(name_starts_with or "")]
+
+class InMemoryBlobClient:
+    def __init__(self, store, container, blob):
+        self.store = store
+        self.container = container
+        self.blob = blob
+        self.url = f"memory://{container}/{blob}"
+
+    def _entry(self):
+        entry = self.store.blobs.get((self.container, self.blob))
+        if entry is None:
+            from azure.core.exceptions import ResourceNotFoundError
+            raise ResourceNotFoundError(f"BlobNotFound: {self.container}/{self.blob}")
+        return entry
+
+    def exists(self):
+        return (self.container, self.blob) in self.store.blobs
+
+    def get_blob_properties(self):
+        data, etag = self._entry()
+        return SimpleNamespace(size=len(data), etag=f'"{etag}"', metadata={})
+
+    def download_blob(self):
+        data, etag = self._entry()
+        record_blob_traffic(self.store.stats, "blob_read_bytes", len(data))
+        return SimpleNamespace(readall=lambda: data, properties=SimpleNamespace(etag=etag))
+
+    def upload_blob(self, data, overwrite=False, **kwargs):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif hasattr(data, "read"):
+            data = data.read()
+        if not overwrite and self.exists():
+            raise Exception(f"BlobAlreadyExists: {self.container}/{self.blob}")
+        record_blob_traffic(self.store.stats, "blob_written_bytes", len(data))
+        return {"etag": f'"{self.store.put(self.container, self.blob, data)}"'}
+
+class FakeCustomVision:
+    """Detects a deterministic set of symbols per image, with some duplicate boxes"""
+    def __init__(self, detections_per_plan=24, duplicate_rate=0.2, latency=0.0):
+        self.detections_per_plan = detections_per_plan
+        self.duplicate_rate = duplicate_rate
+        self.latency = latency
+
+    def detect_image(self, project_id, model_name, image_data):
+        time.sleep(self.latency)
+        rng = random.Random(hashlib.sha256(image_data).digest())
+        predictions = []
+        for _ in range(self.detections_per_plan):
+            size = rng.uniform(0.02, 0.05)
+            box = SimpleNamespace(left=rng.uniform(0, 1 - size), top=rng.uniform(0, 1 - size), width=size, height=size)
+            tag = rng.choice(TAGS)
+            predictions.append(SimpleNamespace(tag_name=tag, probability=rng.uniform(0.4, 0.99), bounding_box=box))
+            if rng.random() < self.duplicate_rate:
+                jitter = size * 0.1
+                duplicate = SimpleNamespace(left=box.left + jitter, top=box.top, width=size, height=size)
+                predictions.append(SimpleNamespace(tag_name=tag, probability=rng.uniform(0.4, 0.99), bounding_box=duplicate))
+        return SimpleNamespace(predictions=predictions)
+
+class FakeOpenAI:
+    """Answers classification and summary requests after a delay, and throttles a share of them.
+    Like the SDK, a 429 is retried max_retries times after its retry-after before it is raised."""
+    def __init__(self, latency=0.0, latency_jitter=0.0, throttle_rate=0.0, retry_after_ms=200, seed=0, max_retries=2):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after_ms = retry_after_ms
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.prompt_tokens = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            create=lambda **kwargs: self.create(max_retries=max_retries, **kwargs)))
+
+    def with_options(self, max_retries=None, **kwargs):
+        if max_retries is None:
+            return self
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+            create=lambda **kwargs: self.create(max_retries=max_retries, **kwargs))))
+
+    def create(self, max_retries=0, **kwargs):
+        from openai import RateLimitError
+        for attempt in range(max_retries + 1):
+            try:
+                return self._complete(**kwargs)
+            except RateLimitError:
+                if attempt == max_retries:
+                    raise
+                time.sleep(self.retry_after_ms / 1000)
+
+    def _complete(self, model=None, messages=None, response_format=None, **kwargs):
+        from openai import RateLimitError
+        with self._lock:
+            self.requests += 1
+            throttle = self._rng.random() < self.throttle_rate
+            delay = max(0.0, self.latency + self._rng.uniform(-self.latency_jitter, self.latency_jitter))
+        time.sleep(delay)
+        if throttle:
+            with self._lock:
+                self.throttled += 1
+            response = SimpleNamespace(status_code=429, headers={"retry-after-ms": str(self.retry_after_ms)}, request=None)
+            raise RateLimitError("Too many requests", response=response, body=None)
+
+        prompt_tokens = 0
+        symbols = 0
+        for message in messages:
+            content = message["content"]
+            parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+            for part in parts:
+                if part["type"] == "text":
+                    prompt_tokens += estimate_text_tokens(part["text"])
+                    symbols += part["text"].startswith("Symbol ")
+                else:
+                    size = data_url_image_size(part["image_url"]["url"]) or (2048, 2048)
+                    prompt_tokens += estimate_image_tokens(*size, part["image_url"].get("detail", "high"))
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+
+        if response_format:
+            content = json.dumps({"labels": [{"symbol": number, "label": self._rng.choice(LABELS)}
+                                             for number in range(1, symbols + 1)]})
+        elif messages[0]["role"] == "system":
+            content = "Summary of the detected elements."
+        else:
+            content = self._rng.choice(LABELS)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                               usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=estimate_text_tokens(content)))
+
+class HarnessTask:
+    def __init__(self, future):
+        self.future = future
+
+    @property
+    def result(self):
+        return self.future.result()
+
+    @property
+    def is_completed(self):
+        return self.future.done()
+
+class HarnessContext:
+    """Durable orchestration context that runs the activities on a shared thread pool.
+    Tasks start as soon as they are created, like scheduled activities do."""
+    def __init__(self, payload, executor, stats, instance_id):
+        self._payload = payload
+        self._executor = executor
+        self._stats = stats
+        self.instance_id = instance_id
+        self.custom_status = None
+
+    @property
+    def current_utc_datetime(self):
+        return datetime.now(timezone.utc)
+
+    def get_input(self):
+        return self._payload
+
+    def _run_activity(self, name, input_, retry_options=None):
+        activity = getattr(function_app, name)
+        attempts = retry_options.max_number_of_attempts if retry_options else 1
+        for attempt in range(attempts):
+            current_stage.name = name
+            start = time.perf_counter()
+            try:
+                result = activity(input_)
+                self._stats.add(name, calls=1, seconds=time.perf_counter() - start,
+                                input_bytes=len(input_ or ""), output_bytes=len(json.dumps(result, default=str)))
+                return result
+            except Exception:
+                self._stats.add(name, calls=1, seconds=time.perf_counter() - start, input_bytes=len(input_ or ""))
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(retry_options.first_retry_interval_in_milliseconds / 1000)
+            finally:
+                current_stage.name = "harness"
+
+    def call_activity(self, name, input_=None):
+        return HarnessTask(self._executor.submit(self._run_activity, name, input_))
+
+    def call_activity_with_retry(self, name, retry_options, input_=None):
+        return HarnessTask(self._executor.submit(self._run_activity, name, input_, retry_options))
+
+    def task_all(self, tasks):
+        return HarnessTask(self._executor.submit(lambda: [task.result for task in tasks]))
+
+    def task_any(self, tasks):
+        # Completes with the first task to finish, like task_any it never fails
+        done, _ = wait([task.future for task in tasks], return_when=FIRST_COMPLETED)
+        first = next(task for task in tasks if task.future in done)
+        completed = Future()
+        completed.set_result(first)
+        return HarnessTask(completed)
+
+    def create_timer(self, fire_at):
+        delay = max(0.0, (fire_at - self.current_utc_datetime).total_seconds())
+        return HarnessTask(self._executor.submit(time.sleep, delay))
+
+    def set_custom_status(self, status):
+        self.custom_status = status
+
+def run_orchestration(context):
+    # Drives the orchestrator generator, failed tasks are thrown back into it
+    generator = function_app.vision_agent_orchestrator._function._func.orchestrator_function(context)
+    try:
+        task = next(generator)
+        while True:
+            try:
+                result = task.result
+            except Exception as e:
+                task = generator.throw(e)
+                continue
+            task = generator.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return values[index]
+
+def run_harness(plan_paths, legend_paths, options=None, plan_concurrency=4, activity_workers=32,
+                cv_latency=0.0, detections_per_plan=24, openai_latency=0.0, openai_latency_jitter=0.0,
+                throttle_rate=0.0, retry_after_ms=200, analyze_prompt=None, seed=0):
+    stats = StageStats()
+    store = InMemoryBlobStore(stats)
+    custom_vision = FakeCustomVision(detections_per_plan=detections_per_plan, latency=cv_latency)
+    openai_client = FakeOpenAI(latency=openai_latency, latency_jitter=openai_latency_jitter,
+                               throttle_rate=throttle_rate, retry_after_ms=retry_after_ms, seed=seed)
+
+    container = "floorplans"
+    legends = []
+    for path in legend_paths:
+        with open(path, "rb") as f:
+            store.put(container, f"legends-source/{os.path.basename(path)}", f.read())
+        legends.append(f"legends-source/{os.path.basename(path)}")
+    plans = []
+    for path in plan_paths:
+        with open(path, "rb") as f:
+            store.put(container, f"plans/{os.path.basename(path)}", f.read())
+        plans.append(f"plans/{os.path.basename(path)}")
+
+    # Every run starts cold, without the caches of a previous run
+    function_app.client_registry.reset()
+    for cached in (function_app.fetch_blob_bytes, function_app.get_legend_data_url, function_app.get_classification_cache,
+                   function_app.get_legend_index, function_app.get_legend_symbols):
+        cached.cache_clear()
+
+    environment = {"CV_PROJECT_ID": "harness", "CV_MODEL_NAME": "harness", "OPENAI_MODEL": "harness",
+                   "CLASSIFICATION_CACHE_BACKEND": os.environ.get("CLASSIFICATION_CACHE_BACKEND", "memory")}
+    latencies = []
+    failures = []
+    results = {}
+
+    def run_plan(index, plan):
+        # The app settings go into the input like http_start does, the orchestrator doesn't read them
+        payload = function_app.resolve_settings("vision_agent_orchestrator", {
+            "container": container,
+            "filename": plan,
+            "reference_filename": legends[index % len(legends)],
+            "analyze_prompt": analyze_prompt,
+            **(options or {})})
+        context = HarnessContext(payload, activity_executor, stats, f"harness-{index}")
+        start = time.perf_counter()
+        try:
+            results[plan] = run_orchestration(context)
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            failures.append({"plan": plan, "error": str(e)})
+
+    with patch.object(function_app, "get_storage_client", return_value=store), \
+         patch.object(function_app, "get_custom_vision_client", return_value=custom_vision), \
+         patch.object(function_app, "get_openai_client", return_value=openai_client), \
+         patch.dict(os.environ, environment), \
+         ThreadPoolExecutor(max_workers=activity_workers) as activity_executor, \
+         ThreadPoolExecutor(max_workers=plan_concurrency) as plan_executor:
+        start = time.perf_counter()
+        list(plan_executor.map(lambda item: run_plan(*item), enumerate(plans)))
+        wall_seconds = time.perf_counter() - start
+
+    return {
+        "plans": len(plans),
+        "completed": len(latencies),
+        "failed": failures,
+        "wall_seconds": round(wall_seconds, 3),
+        "plans_per_minute": round(len(latencies) / wall_seconds * 60, 2) if wall_seconds else 0.0,
+        "latency_p50": round(percentile(latencies, 0.5), 3),
+        "latency_p95": round(percentile(latencies, 0.95), 3),
+        "detections": sum(len(result["detections"]) for result in results.values()),
+        "openai": {"requests": openai_client.requests, "throttled": openai_client.throttled,
+                   "prompt_tokens": openai_client.prompt_tokens},
+        "stages": {stage: {key: round(value, 3) if isinstance(value, float) else value for key, value in values.items()}
+                   for stage, values in sorted(stats.stages.items())}
+    }
+
+def format_report(report):
+    lines = [
+        f"plans: {report['completed']}/{report['plans']} completed in {report['wall_seconds']:.1f}s, "
+        f"{report['plans_per_minute']:.1f} plans/min",
+        f"plan latency: p50 {report['latency_p50']:.2f}s, p95 {report['latency_p95']:.2f}s",
+        f"openai: {report['openai']['requests']} requests, {report['openai']['throttled']} throttled, "
+        f"{report['openai']['prompt_tokens']} prompt tokens",
+        "",
+        f"{'stage':32} {'calls':>6} {'seconds':>9} {'input':>11} {'output':>11} {'blob read':>11} {'blob written':>13}",
+    ]
+    for stage, values in report["stages"].items():
+        lines.append(f"{stage:32} {values['calls']:>6} {values['seconds']:>9.2f} {values['input_bytes']:>11} "
+                     f"{values['output_bytes']:>11} {values['blob_read_bytes']:>11} {values['blob_written_bytes']:>13}")
+    for failure in report["failed"]:
+        lines.append(f"FAILED {failure['plan']}: {failure['error']}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the floorplan pipeline offline and report its throughput")
+    parser.add_argument("--plans", default=os.path.join(ROOT_DIR, "SampleDocs", "FloorPlans"), help="Directory of plan images")
+    parser.add_argument("--legends", default=os.path.join(ROOT_DIR, "SampleDocs", "DesignElements"), help="Directory of legend images")
+    parser.add_argument("--limit", type=int, default=0, help="Only run the first N plans")
+    parser.add_argument("--plan-concurrency", type=int, default=4)
+    parser.add_argument("--activity-workers", type=int, default=32)
+    parser.add_argument("--detections-per-plan", type=int, default=24)
+    parser.add_argument("--cv-latency", type=float, default=0.0, help="Seconds per Custom Vision call")
+    parser.add_argument("--openai-latency", type=float, default=0.0, help="Seconds per OpenAI call")
+    parser.add_argument("--openai-latency-jitter", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of OpenAI calls answered with a 429")
+    parser.add_argument("--retry-after-ms", type=int, default=200)
+    parser.add_argument("--option", action="append", default=[], metavar="KEY=VALUE",
+                        help="Orchestrator input option, e.g. classification_batch_size=8")
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    def image_paths(directory):
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                      if name.lower().endswith((".png", ".jpg", ".jpeg")))
+
+    plans = image_paths(args.plans)
+    if args.limit:
+        plans = plans[:args.limit]
+    options = {}
+    for option in args.option:
+        key, value = option.split("=", 1)
+        options[key] = json.loads(value) if value.replace(".", "", 1).isdigit() or value in ("true", "false") else value
+
+    report = run_harness(plans, image_paths(args.legends), options,
+                         plan_concurrency=args.plan_concurrency,
+                         activity_workers=args.activity_workers,
+                         cv_latency=args.cv_latency,
+                         detections_per_plan=args.detections_per_plan,
+                         openai_latency=args.openai_latency,
+                         openai_latency_jitter=args.openai_latency_jitter,
+                         throttle_rate=args.throttle_rate,
+                         retry_after_ms=args.retry_after_ms)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import pytest
+import os
+import sys
+import io
+import time
+from PIL import Image, ImageDraw
+
+# Add the api directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'api'))
+from classification_cache import (perceptual_hash, cache_key, MemoryCacheBackend, DiskCacheBackend,
+                                  ClassificationCache, create_classification_cache)
+
+def make_symbol(offset=0, size=(60, 60), fmt='JPEG'):
+    image = Image.new('RGB', size, color='white')
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((10 + offset, 10 + offset, 45 + offset, 45 + offset), outline='black', width=3)
+    draw.line((10 + offset, 28 + offset, 45 + offset, 28 + offset), fill='black', width=3)
+    img_io = io.BytesIO()
+    image.save(img_io, format=fmt)
+    return img_io.getvalue()
+
+def test_perceptual_hash_is_stable_for_repeated_symbols():
+    """Test the same symbol re-encoded or slightly shifted gets the same hash"""
+    assert perceptual_hash(make_symbol()) == perceptual_hash(make_symbol(fmt='PNG'))
+    assert perceptual_hash(make_symbol()) == perceptual_hash(make_symbol(offset=4))
+
+    blank = io.BytesIO()
+    Image.new('RGB', (60, 60), color='white').save(blank, format='PNG')
+    assert perceptual_hash(make_symbol()) != perceptual_hash(blank.getvalue())
+
+def test_cache_key_depends_on_legend_and_prompt():
+    """Test the key changes with the legend and the prompt"""
+    assert cache_key("abc", "legend1", "prompt") == cache_key("abc", "legend1", "prompt")
+    assert cache_key("abc", "legend1", "prompt") != cache_key("abc", "legend2", "prompt")
+    assert cache_key("abc", "legend1", "prompt") != cache_key("abc", "legend1", "other prompt")
+
+def test_memory_backend_evicts_least_recently_used():
+    """Test the in-memory backend keeps at most max_entries"""
+    backend = MemoryCacheBackend(max_entries=2)
+    backend.set("a", {"model_response": "A"})
+    backend.set("b", {"model_response": "B"})
+    backend.get("a")
+    backend.set("c", {"model_response": "C"})
+
+    assert backend.get("a") == {"model_response": "A"}
+    assert backend.get("b") is None
+    assert backend.get("c") == {"model_response": "C"}
+
+def test_memory_backend_expires_entries():
+    """Test entries older than the TTL are not returned"""
+    backend = MemoryCacheBackend(ttl=0.01)
+    backend.set("a", {"model_response": "A"})
+    time.sleep(0.02)
+    assert backend.get("a") is None
+
+def test_disk_backend_round_trip_and_eviction(tmp_path):
+    """Test the disk backend persists entries and evicts the oldest ones"""
+    backend = DiskCacheBackend(str(tmp_path), max_entries=2)
+    backend.set("a", {"model_response": "A"})
+    os.utime(tmp_path / "a.json", (time.time() - 100, time.time() - 100))
+    backend.set("b", {"model_response": "B"})
+    backend.set("c", {"model_response": "C"})
+
+    assert backend.get("a") is None
+    assert DiskCacheBackend(str(tmp_path)).get("c") == {"model_response": "C"}
+
+def test_disk_backend_lists_directory_only_to_evict(tmp_path, monkeypatch):
+    """Test writes under max_entries don't list the cache directory"""
+    backend = DiskCacheBackend(str(tmp_path), max_entries=10)
+    listings = []
+    monkeypatch.setattr(backend, "_entries", lambda original=backend._entries: listings.append(1) or original())
+    for index in range(10):
+        backend.set(str(index), {"model_response": str(index)})
+    backend.set("0", {"model_response": "0"})
+    assert listings == []
+
+    backend.set("10", {"model_response": "10"})
+    assert len(listings) == 1
+    assert len(os.listdir(tmp_path)) == backend.evict_to == 9
+
+def test_classification_cache_counts_hits_and_misses():
+    """Test the cache reports hit and miss counters"""
+    cache = ClassificationCache(MemoryCacheBackend())
+    assert cache.get("a") is None
+    cache.set("a", {"model_response": "A"})
+    assert cache.get("a") == {"model_response": "A"}
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+def test_create_classification_cache_from_environment(monkeypatch, tmp_path):
+    """Test the backend is picked from CLASSIFICATION_CACHE_BACKEND"""
+    monkeypatch.setenv("CLASSIFICATION_CACHE_BACKEND", "disk")
+    monkeypatch.setenv("CLASSIFICATION_CACHE_DIR", str(tmp_path))
+    assert isinstance(create_classification_cache().backend, DiskCacheBackend)
+
+    monkeypatch.setenv("CLASSIFICATION_CACHE_BACKEND", "none")
+    cache = create_classification_cache()
+    cache.set("a", {"model_response": "A"})
+    assert cache.get("a") is None
+
+    monkeypatch.setenv("CLASSIFICATION_CACHE_BACKEND", "unknown")
+    with pytest.raises(ValueError):
+        create_classification_cache()
@@ -0,0 +1,70 @@
+import pytest
+import os
+import sys
+import time
+import threading
+from unittest.mock import MagicMock
+
+# Add the api directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'api'))
+from clients import ClientRegistry, CachedTokenCredential
+
+class MockAccessToken:
+    def __init__(self, token, expires_on):
+        self.token = token
+        self.expires_on = expires_on
+
+def test_client_registry_creates_each_client_once():
+    """Test concurrent lookups share a single lazily created client"""
+    registry = ClientRegistry()
+    factory = MagicMock(side_effect=lambda: object())
+    clients = []
+
+    def lookup():
+        clients.append(registry.get("openai", "https://test-endpoint", factory))
+
+    threads = [threading.Thread(target=lookup) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    factory.assert_called_once()
+    assert len({id(client) for client in clients}) == 1
+    assert registry.stats()["openai"] == {"created": 1, "reused": 15}
+
+def test_client_registry_keys_on_settings():
+    """Test a different endpoint gets its own client"""
+    registry = ClientRegistry()
+    first = registry.get("storage", "https://account1.blob.core.windows.net", object)
+    second = registry.get("storage", "https://account2.blob.core.windows.net", object)
+    assert first is not second
+    assert registry.stats()["storage"] == {"created": 2, "reused": 0}
+
+def test_cached_token_credential_reuses_tokens():
+    """Test tokens are cached per scope until close to expiry"""
+    credential = MagicMock()
+    credential.get_token.return_value = MockAccessToken("token", time.time() + 3600)
+    cached = CachedTokenCredential(lambda: credential)
+
+    provider = cached.bearer_token_provider("https://cognitiveservices.azure.com/.default")
+    assert provider() == "token"
+    assert provider() == "token"
+    cached.get_token("https://storage.azure.com/.default")
+
+    assert credential.get_token.call_count == 2
+    assert cached.stats() == {"acquired": 2, "reused": 1}
+
+def test_cached_token_credential_refreshes_proactively():
+    """Test a token within the refresh margin is replaced before it expires"""
+    credential = MagicMock()
+    credential.get_token.side_effect = [
+        MockAccessToken("expiring", time.time() + 60),
+        MockAccessToken("fresh", time.time() + 3600),
+    ]
+    cached = CachedTokenCredential(lambda: credential, refresh_margin=300)
+
+    assert cached.get_token("scope").token == "expiring"
+    assert cached.get_token("scope").token == "fresh"
+    assert cached.get_token("scope").token == "fresh"
+    assert credential.get_token.call_count == 2
@@ -0,0 +1,118 @@
+import pytest
+import os
+import sys
+import time
+import importlib.util
+import subprocess
+import threading
+from unittest.mock import MagicMock, patch
+
+# Add the api directory to Python path
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'api')
+sys.path.insert(0, API_DIR)
+
+TOKEN_ENDPOINT_DELAY = 2.0
+
+def slow_credential_class():
+    """Credential whose token endpoint takes TOKEN_ENDPOINT_DELAY seconds to answer"""
+    def get_token(*scopes, **kwargs):
+        time.sleep(TOKEN_ENDPOINT_DELAY)
+        return MagicMock(token="token", expires_on=time.time() + 3600)
+    credential_class = MagicMock()
+    credential_class.return_value.get_token.side_effect = get_token
+    return credential_class
+
+def import_function_app():
+    """Import a fresh copy of the function app, like a cold start of the worker does"""
+    spec = importlib.util.spec_from_file_location("function_app_cold_start", os.path.join(API_DIR, "function_app.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_cold_start_does_not_wait_for_token_endpoint(use_azure_functions_test_env):
+    """Benchmark the import of the function app with a slow token endpoint stubbed in"""
+    managed_identity, default_credential = slow_credential_class(), slow_credential_class()
+    with patch('azure.identity.ManagedIdentityCredential', managed_identity), \
+         patch('azure.identity.DefaultAzureCredential', default_credential):
+        start = time.perf_counter()
+        module = import_function_app()
+        import_seconds = time.perf_counter() - start
+        print(f"\nfunction_app import: {import_seconds * 1000:.0f} ms with a {TOKEN_ENDPOINT_DELAY:.0f}s token endpoint")
+
+        assert import_seconds < TOKEN_ENDPOINT_DELAY
+        managed_identity.return_value.get_token.assert_not_called()
+        assert module.credential is None
+
+        # The chain is resolved once on first use and its token is reused
+        module.resolve_credential()
+        module.resolve_credential()
+        token = module.token_credential.get_token(module.STORAGE_SCOPE)
+
+    assert token.token == "token"
+    managed_identity.return_value.get_token.assert_called_once()
+    default_credential.assert_not_called()
+    assert module.token_credential.stats() == {"acquired": 1, "reused": 1}
+
+def test_first_token_request_resolves_credential(use_azure_functions_test_env):
+    """Test the first get_token on a fresh worker resolves the credential and reuses its token"""
+    module = import_function_app()
+    managed_identity = MagicMock()
+    managed_identity.return_value.get_token.return_value = MagicMock(token="token", expires_on=time.time() + 3600)
+    result = {}
+
+    with patch.object(module, 'ManagedIdentityCredential', managed_identity):
+        thread = threading.Thread(target=lambda: result.update(token=module.token_credential.get_token(module.STORAGE_SCOPE)),
+                                  daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+
+    assert not thread.is_alive(), "get_token deadlocked resolving the credential"
+    assert result["token"].token == "token"
+    assert module.credential is managed_identity.return_value
+    managed_identity.return_value.get_token.assert_called_once()
+    assert module.token_credential.stats() == {"acquired": 1, "reused": 1}
+
+def test_credential_chain_falls_back_and_retries(use_azure_functions_test_env):
+    """Test the default chain is used when managed identity fails, and a failure isn't memoized"""
+    module = import_function_app()
+    managed_identity = MagicMock()
+    managed_identity.return_value.get_token.side_effect = Exception("no managed identity")
+    default_credential = MagicMock()
+    default_credential.return_value.get_token.side_effect = [Exception("not signed in"),
+                                                             MagicMock(token="token", expires_on=time.time() + 3600)]
+
+    with patch.object(module, 'ManagedIdentityCredential', managed_identity), \
+         patch.object(module, 'DefaultAzureCredential', default_credential):
+        with pytest.raises(Exception, match="Failed to get valid credential"):
+            module.resolve_credential()
+        assert module.credential is None
+        assert module.resolve_credential() is default_credential.return_value
+
+# SDKs that only some activities need and that must not load with the function app
+HEAVY_MODULES = ["openai", "PIL", "pydantic", "numpy", "azure.storage.blob",
+                 "azure.cognitiveservices.vision.customvision", "msrest", "azure.identity"]
+
+def parse_importtime(stderr):
+    """Cumulative import time in microseconds per module from the -X importtime output"""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+def test_import_time_benchmark():
+    """Benchmark the function app import with -X importtime and check no heavy SDK is loaded"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import function_app"],
+                            cwd=API_DIR, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr[-2000:]
+    times = parse_importtime(result.stderr)
+
+    slowest = sorted(((cumulative, name) for name, cumulative in times.items() if "." not in name), reverse=True)[:5]
+    print(f"\nfunction_app import: {times['function_app'] / 1000:.0f} ms, slowest top level imports: "
+          + ", ".join(f"{name} {cumulative / 1000:.0f} ms" for cumulative, name in slowest))
+
+    loaded = [name for name in times if any(name == heavy or name.startswith(heavy + ".") for heavy in HEAVY_MODULES)]
+    assert loaded == []
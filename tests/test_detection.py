@@ -0,0 +1,92 @@
+import pytest
+import os
+import sys
+import numpy as np
+
+# Add the api directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'api'))
+from detection import plan_tiles, tile_to_plan_box, overlap_with, non_max_suppression, deduplicate_boxes
+import time
+
+def test_plan_tiles_cover_the_image_with_overlap():
+    """Test the tiles cover every pixel and overlap by at least the requested amount"""
+    tiles = plan_tiles(2500, 1200, tile_size=1024, overlap=128)
+    coverage = np.zeros((1200, 2500), dtype=bool)
+    for tile in tiles:
+        assert tile["width"] <= 1024 and tile["height"] <= 1024
+        coverage[tile["top"]:tile["top"] + tile["height"], tile["left"]:tile["left"] + tile["width"]] = True
+    assert coverage.all()
+
+    lefts = sorted({tile["left"] for tile in tiles})
+    assert all(second - first <= 1024 - 128 for first, second in zip(lefts, lefts[1:]))
+
+def test_plan_tiles_small_image_is_one_tile():
+    """Test an image smaller than a tile is detected in one call"""
+    assert plan_tiles(800, 600, tile_size=1024, overlap=128) == [{"left": 0, "top": 0, "width": 800, "height": 600}]
+    assert plan_tiles(4000, 3000, tile_size=0, overlap=128) == [{"left": 0, "top": 0, "width": 4000, "height": 3000}]
+
+def test_tile_to_plan_box():
+    """Test a tile relative box maps back to normalized plan coordinates"""
+    tile = {"left": 1000, "top": 500, "width": 1000, "height": 500}
+    box = tile_to_plan_box({"left": 0.5, "top": 0.5, "width": 0.1, "height": 0.2}, tile, 2000, 1000)
+    assert box == pytest.approx({"left": 0.75, "top": 0.75, "width": 0.05, "height": 0.1})
+
+def test_overlap_with():
+    """Test IoU and intersection over the smaller box"""
+    boxes = np.array([[0.0, 0.0, 0.2, 0.2], [0.1, 0.0, 0.2, 0.2], [0.0, 0.0, 0.1, 0.2]])
+    iou = overlap_with(boxes[0], boxes)
+    iomin = overlap_with(boxes[0], boxes, metric="iomin")
+    assert iou[0] == pytest.approx(1.0)
+    assert iou[1] == pytest.approx(1 / 3)
+    assert iou[2] == pytest.approx(0.5)
+    assert iomin[2] == pytest.approx(1.0)
+
+def test_non_max_suppression_merges_seam_duplicates():
+    """Test a symbol found whole in one tile and cut in half in the next is kept once"""
+    boxes = [
+        [0.40, 0.40, 0.10, 0.10],  # whole symbol
+        [0.45, 0.40, 0.05, 0.10],  # right half, cut by the tile seam
+        [0.80, 0.80, 0.10, 0.10],  # another symbol
+    ]
+    scores = [0.9, 0.7, 0.8]
+    assert list(non_max_suppression(boxes, scores, iou_threshold=0.5)) == [0, 2, 1]
+    assert list(non_max_suppression(boxes, scores, iou_threshold=0.5, metric="iomin")) == [0, 2]
+    assert non_max_suppression([], []).size == 0
+
+def test_non_max_suppression_per_label():
+    """Test boxes with different labels never suppress each other"""
+    boxes = [[0.1, 0.1, 0.2, 0.2], [0.11, 0.1, 0.2, 0.2], [0.1, 0.11, 0.2, 0.2]]
+    scores = [0.9, 0.8, 0.7]
+    assert list(non_max_suppression(boxes, scores, labels=["door", "door", "window"])) == [0, 2]
+    assert list(non_max_suppression(boxes, scores)) == [0]
+
+def test_deduplicate_boxes_reports_suppressed_and_capped():
+    """Test the de-duplication counts and the top-K cap"""
+    boxes = [[0.1, 0.1, 0.2, 0.2], [0.11, 0.1, 0.2, 0.2], [0.5, 0.5, 0.1, 0.1], [0.7, 0.7, 0.1, 0.1]]
+    scores = [0.9, 0.8, 0.6, 0.7]
+    labels = ["door", "door", "outlet", "door"]
+
+    keep, suppressed, capped = deduplicate_boxes(boxes, scores, labels, iou_threshold=0.5)
+    assert (list(keep), suppressed, capped) == ([0, 3, 2], 1, 0)
+
+    keep, suppressed, capped = deduplicate_boxes(boxes, scores, labels, iou_threshold=0.5, top_k=2)
+    assert (list(keep), suppressed, capped) == ([0, 3], 1, 1)
+
+def test_deduplicate_boxes_scales_to_thousands_of_boxes():
+    """Test the de-duplication stays fast with thousands of candidate boxes"""
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(0.05, 0.95, size=(1500, 2))
+    # Three jittered boxes per symbol
+    boxes = np.concatenate([np.hstack([centers + rng.normal(0, 0.0002, size=centers.shape), np.full((1500, 2), 0.004)])
+                            for _ in range(3)])
+    scores = rng.uniform(0.5, 1.0, size=len(boxes))
+    labels = rng.choice(["door", "outlet", "light"], size=1500).tolist() * 3
+
+    start = time.perf_counter()
+    keep, suppressed, _ = deduplicate_boxes(boxes, scores, labels, iou_threshold=0.3)
+    elapsed = time.perf_counter() - start
+
+    assert len(keep) <= 1500 + 50
+    assert suppressed >= 3000 - 50
+    assert elapsed < 2.0
+
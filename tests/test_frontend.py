@@ -5,9 +5,11 @@ from unittest.mock import MagicMock, patch
 from PIL import Image
 import sys
 import io
+import threading
+import hashlib
 
 # Import the frontend app
-from frontend.app import FloorplanApp
+from frontend.app import FloorplanApp, StatusPoller, get_container_client, get_status_session, render_overlay, render_thumbnails, display_plan, draw_boxes, crop_box
 
 def test_upload_to_blob():
     app = FloorplanApp()
@@ -37,6 +39,82 @@ def test_upload_to_blob():
         assert result == "https://teststorage.blob.core.windows.net/container/test.png"
         mock_blob_client.upload_blob.assert_called_once()
 
+def make_png(color='red'):
+    img_io = io.BytesIO()
+    Image.new('RGB', (100, 100), color=color).save(img_io, format='PNG')
+    img_io.seek(0)
+    return img_io
+
+def test_upload_reuses_cached_container_client():
+    get_container_client.clear()
+    app = FloorplanApp()
+    app.STORAGE_CONN_STR = "UseDevelopmentStorage=true"
+    mock_service = MagicMock()
+    mock_container = mock_service.get_container_client.return_value
+    mock_container.get_blob_client.side_effect = lambda name: MagicMock(url=f"https://test/{name}")
+
+    with patch('azure.storage.blob.BlobServiceClient.from_connection_string', return_value=mock_service) as mock_from_conn:
+        urls = [app.upload_to_blob(make_png(), f"test-{i}.png") for i in range(3)]
+
+    assert urls == [f"https://test/test-{i}.png" for i in range(3)]
+    # One client and one container check for every upload
+    mock_from_conn.assert_called_once()
+    assert mock_from_conn.call_args.kwargs["max_block_size"] == 4 * 1024 * 1024
+    mock_container.get_container_properties.assert_called_once()
+    mock_service.get_service_properties.assert_not_called()
+    get_container_client.clear()
+
+def test_content_addressed_name():
+    app = FloorplanApp()
+    image = make_png()
+    data = image.getvalue()
+    image.name = "Plan.PNG"
+    image.read(10)
+
+    name = app.content_addressed_name(image, "floorplan")
+
+    assert name == f"floorplan-{hashlib.sha256(data).hexdigest()}.png"
+    assert image.tell() == 0
+    assert app.content_addressed_name(make_png(), "floorplan") == name
+    assert app.content_addressed_name(make_png('blue'), "floorplan") != name
+
+def test_upload_skips_existing_content_addressed_blob():
+    get_container_client.clear()
+    app = FloorplanApp()
+    app.STORAGE_CONN_STR = "UseDevelopmentStorage=true"
+    mock_service = MagicMock()
+    mock_blob_client = mock_service.get_container_client.return_value.get_blob_client.return_value
+    mock_blob_client.url = "https://test/floorplan.png"
+    mock_blob_client.exists.side_effect = [False, True]
+
+    with patch('azure.storage.blob.BlobServiceClient.from_connection_string', return_value=mock_service):
+        first = app.upload_to_blob(make_png(), "floorplan.png", skip_existing=True)
+        second = app.upload_to_blob(make_png(), "floorplan.png", skip_existing=True)
+
+    assert first == second == "https://test/floorplan.png"
+    mock_blob_client.upload_blob.assert_called_once()
+    get_container_client.clear()
+
+def test_upload_files_runs_concurrently():
+    get_container_client.clear()
+    app = FloorplanApp()
+    app.STORAGE_CONN_STR = "UseDevelopmentStorage=true"
+    barrier = threading.Barrier(2, timeout=5)
+    blob_clients = {}
+    def make_blob_client(name):
+        # Both uploads must be in flight at the same time to pass the barrier
+        blob_clients[name] = MagicMock(url=f"https://test/{name}", **{"upload_blob.side_effect": lambda *a, **k: barrier.wait()})
+        return blob_clients[name]
+    mock_service = MagicMock()
+    mock_service.get_container_client.return_value.get_blob_client.side_effect = make_blob_client
+
+    with patch('azure.storage.blob.BlobServiceClient.from_connection_string', return_value=mock_service):
+        urls = app.upload_files([(make_png(), "floorplan.png"), (make_png('blue'), "legend.png")])
+
+    assert urls == ["https://test/floorplan.png", "https://test/legend.png"]
+    assert blob_clients["floorplan.png"].upload_blob.call_args.kwargs["max_concurrency"] == 4
+    get_container_client.clear()
+
 def test_start_durable_function():
     app = FloorplanApp()
     mock_response = MagicMock()
@@ -45,7 +123,7 @@ def test_start_durable_function():
     }
     mock_response.raise_for_status = MagicMock()
 
-    with patch('requests.post') as mock_post:
+    with patch('requests.Session.post') as mock_post:
         mock_post.return_value = mock_response
         
         # Test start_durable_function
@@ -78,7 +156,7 @@ def test_poll_function_status():
         )
     ]
     
-    with patch('requests.get') as mock_get, \
+    with patch('requests.Session.get') as mock_get, \
          patch('time.sleep') as mock_sleep:  # Mock sleep to speed up tests
         mock_get.side_effect = mock_responses
         
@@ -91,6 +169,96 @@ def test_poll_function_status():
         assert isinstance(result["output"]["detections"], list)
         assert mock_get.call_count == 2
 
+def test_poll_function_status_reports_progress():
+    app = FloorplanApp()
+    progress = {"phase": "classifying", "detections": 1, "classified": 0,
+                "results": [[0.1, 0.1, 0.2, 0.2, "door", 0.9, None]], "truncated": False}
+    mock_responses = [
+        MagicMock(json=MagicMock(return_value={"runtimeStatus": "Running", "customStatus": {"phase": "detecting"}})),
+        MagicMock(json=MagicMock(return_value={"runtimeStatus": "Running", "customStatus": progress})),
+        MagicMock(json=MagicMock(return_value={"runtimeStatus": "Running", "customStatus": progress})),
+        MagicMock(json=MagicMock(return_value={"runtimeStatus": "Completed", "output": {"summary": "", "detections": []}}))
+    ]
+    on_progress = MagicMock()
+
+    with patch('requests.Session.get') as mock_get, \
+         patch('time.sleep'):
+        mock_get.side_effect = mock_responses
+        result = app.poll_function_status("https://test-status-url", on_progress=on_progress)
+
+    assert result["runtimeStatus"] == "Completed"
+    # Unchanged statuses are only reported once
+    assert [call.args[0] for call in on_progress.call_args_list] == [{"phase": "detecting"}, progress]
+
+def make_status_response(runtime_status, retry_after=None, **extra):
+    response = MagicMock()
+    response.json.return_value = {"runtimeStatus": runtime_status, **extra}
+    response.headers = {"Retry-After": retry_after} if retry_after else {}
+    return response
+
+def test_poll_function_status_backs_off():
+    app = FloorplanApp()
+    app.poller = StatusPoller(initial_interval=0.5, max_interval=2)
+    responses = [make_status_response("Running") for _ in range(5)] + [make_status_response("Completed", output={})]
+
+    with patch('requests.Session.get', side_effect=responses), \
+         patch('time.sleep') as mock_sleep:
+        result = app.poll_function_status("https://test-status-url")
+
+    assert result["runtimeStatus"] == "Completed"
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [0.5, 0.75, 1.125, 1.6875, 2]
+    assert app.poller.last_metrics["polls"] == 6
+    assert app.poller.last_metrics["sleep_seconds"] == 6.0625
+
+def test_poll_function_status_honors_retry_after_and_progress():
+    app = FloorplanApp()
+    app.poller = StatusPoller(initial_interval=0.5, max_interval=5)
+    responses = [make_status_response("Running", retry_after="3"),
+                 make_status_response("Running"),
+                 make_status_response("Running", customStatus={"phase": "detecting"}),
+                 make_status_response("Completed", output={})]
+
+    with patch('requests.Session.get', side_effect=responses), \
+         patch('time.sleep') as mock_sleep:
+        app.poll_function_status("https://test-status-url")
+
+    # Retry-After wins over the backoff, new progress resets the interval
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [3.0, 0.5, 0.5]
+    assert app.poller.last_metrics["first_progress_seconds"] is not None
+
+def test_poll_function_status_reports_failure():
+    app = FloorplanApp()
+    with patch('requests.Session.get', return_value=make_status_response("Failed")), \
+         patch('time.sleep'):
+        assert app.poll_function_status("https://test-status-url") is None
+
+def test_start_and_poll_share_one_session():
+    app = FloorplanApp()
+    start_response = MagicMock()
+    start_response.json.return_value = {"statusQueryGetUri": "https://test-status-url"}
+    session = MagicMock()
+    session.post.return_value = start_response
+    session.get.return_value = make_status_response("Completed", output={})
+    app.poller = StatusPoller(session=session)
+
+    status_url = app.start_durable_function("floorplan.png", "reference.png", "Analyze this floorplan")
+    app.poll_function_status(status_url)
+
+    session.post.assert_called_once()
+    session.get.assert_called_once_with("https://test-status-url")
+
+def test_decode_progress():
+    app = FloorplanApp()
+    detections = app.decode_progress({"results": [[0.1, 0.1, 0.2, 0.2, "door", 0.9, None],
+                                                  [0.5, 0.5, 0.1, 0.1, "outlet", 0.8, "DUPLEX OUTLET"]]})
+
+    assert detections[0] == {"bounding_box": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2},
+                             "tag": "door", "probability": 0.9}
+    assert detections[1]["model_response"] == "DUPLEX OUTLET"
+    # The partial results can be drawn like the final ones
+    image = app.draw_bounding_boxes(Image.new('RGB', (100, 100), color='white'), detections)
+    assert image.size == (100, 100)
+
 def test_draw_bounding_boxes():
     app = FloorplanApp()
     # Create a test image
@@ -116,5 +284,90 @@ def test_draw_bounding_boxes():
     assert isinstance(result_image, Image.Image)
     assert result_image.size == (100, 100)
 
+def make_analysis(instance_id, size=(4000, 2000), detection_count=3):
+    plan = io.BytesIO()
+    Image.new('RGB', size, color='white').save(plan, format='PNG')
+    detections = [{"tag": "door", "probability": 0.9, "model_response": "DOOR",
+                   "bounding_box": {"left": 0.1 * (index + 1), "top": 0.5, "width": 0.05, "height": 0.1}}
+                  for index in range(detection_count)]
+    return {"instance_id": instance_id,
+            "plan_hash": "floorplan-" + hashlib.sha256(plan.getvalue()).hexdigest() + ".png",
+            "plan_bytes": plan.getvalue(),
+            "result": {"runtimeStatus": "Completed", "output": {"detections": detections, "summary": ""}}}
+
+def test_overlay_is_drawn_once_at_display_resolution():
+    """Test the overlay is rendered on a display copy and cached by plan hash and instance ID"""
+    for cached in (render_overlay, render_thumbnails, display_plan):
+        cached.clear()
+    app = FloorplanApp()
+    app.DISPLAY_MAX_SIDE = 1000
+    analysis = make_analysis("instance-1")
+
+    with patch('frontend.app.draw_boxes', wraps=draw_boxes) as mock_draw:
+        overlay = app.analysis_overlay(analysis)
+        app.analysis_overlay(analysis)
+        # A new analysis of the same plan is drawn again instead of showing stale boxes
+        app.analysis_overlay({**analysis, "instance_id": "instance-2"})
+
+    assert overlay.size == (1000, 500)
+    assert mock_draw.call_count == 2
+    # The first box starts at 10% of the display width
+    assert overlay.getpixel((100, 260))[:3] == (255, 0, 0)
+
+def test_thumbnails_are_generated_once():
+    for cached in (render_overlay, render_thumbnails, display_plan):
+        cached.clear()
+    app = FloorplanApp()
+    app.THUMBNAIL_SIZE = 64
+    analysis = make_analysis("instance-1")
+
+    with patch('frontend.app.crop_box', wraps=crop_box) as mock_crop:
+        thumbnails = app.analysis_thumbnails(analysis, range(3))
+        app.analysis_thumbnails(analysis, range(3))
+
+    assert len(thumbnails) == 3
+    assert all(max(thumbnail.size) <= 64 for thumbnail in thumbnails)
+    assert mock_crop.call_count == 3
+
+def test_filter_and_paginate_detections():
+    """Test the result browser only renders the filtered page of detections"""
+    app = FloorplanApp()
+    detections = [{"tag": "door" if index % 2 else "outlet", "probability": 0.9,
+                   "model_response": "DOOR" if index % 3 else "No Match"} for index in range(60)]
+
+    doors = app.filter_detections(detections, tags=["door"])
+    assert doors == list(range(1, 60, 2))
+    assert app.filter_detections(detections, tags=["door"], labels=["No Match"]) == list(range(3, 60, 6))
+    assert app.filter_detections(detections) == list(range(60))
+
+    page, page_count = app.paginate(doors, 2, 25)
+    assert page == doors[25:]
+    assert page_count == 2
+    # Out of range pages are clamped
+    assert app.paginate(doors, 5, 25) == (doors[25:], 2)
+    assert app.paginate([], 1, 25) == ([], 1)
+
+def test_thumbnails_are_cut_for_the_visible_page_only():
+    for cached in (render_overlay, render_thumbnails, display_plan):
+        cached.clear()
+    app = FloorplanApp()
+    analysis = make_analysis("instance-1", detection_count=50)
+    page, _ = app.paginate(app.filter_detections(analysis["result"]["output"]["detections"]), 2, 20)
+
+    with patch('frontend.app.crop_box', wraps=crop_box) as mock_crop:
+        thumbnails = app.analysis_thumbnails(analysis, page)
+
+    assert len(thumbnails) == 20
+    assert mock_crop.call_count == 20
+
 if __name__ == '__main__':
     pytest.main([__file__])
+
+def test_status_session_is_shared_across_reruns():
+    """Test every rerun polls over the same pooled session instead of opening a new one"""
+    get_status_session.clear()
+    first = FloorplanApp()
+    second = FloorplanApp()
+    assert first.poller is not second.poller
+    assert first.poller.session is second.poller.session
+    get_status_session.clear()
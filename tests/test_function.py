@@ -3,7 +3,10 @@ import azure.functions as func
 import azure.durable_functions as df
 import json
 import base64
-from unittest.mock import MagicMock, patch, AsyncMock
+import hashlib
+import re
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch, AsyncMock, ANY
 import os
 import sys
 from PIL import Image
@@ -14,7 +17,7 @@ from openai import AzureOpenAI
 
 # Add the root directory to Python path
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
-from api.function_app import myApp, read_image, object_detection, summarize_results, http_start
+from api.function_app import myApp, read_image, object_detection, summarize_results, http_start, vision_agent_orchestrator, crop_detections, register_legend, azure_openai_batch_processing, azure_openai_processing, client_registry, merge_detections, plan_detection_tiles, deduplicate_predictions, call_activities_adaptive, call_activities_bounded, batch_floorplan_orchestrator, token_credential, resolve_settings, list_floorplans, content_address, normalize_plan, get_classification_cache, match_legend_symbols, get_legend_symbols, remember_legend_entry, legend_entry_key, classification_cache_key, get_legend_index, get_legend_data_url
 
 class MockDurableOrchestrationClient:
     def __init__(self, client_config=None):
@@ -39,7 +42,8 @@ class MockDurableOrchestrationClient:
 
     def get_client_input_endpoint(self):
         return self._post_instance_url
-          async def start_new(self, orchestration_function_name, client_input=None):
+
+    async def start_new(self, orchestration_function_name, client_input=None):
         """Start a new orchestration instance"""
         if client_input is not None:
             instance_id = f"test-{orchestration_function_name}-{hash(str(client_input))}"
@@ -221,7 +225,9 @@ def test_object_detection(use_azure_functions_test_env):
         def detect_image(self, project_id, iteration_name, image_data):
             bbox = MockBBox(0.1, 0.1, 0.2, 0.2)
             pred = MockPrediction("door", 0.95, bbox)
-            return MockResponse([pred])    with patch('api.function_app.CustomVisionPredictionClient', MockCustomVisionPredictionClient), \
+            return MockResponse([pred])
+
+    with patch('api.function_app.CustomVisionPredictionClient', MockCustomVisionPredictionClient), \
          patch.dict(os.environ, {
             'CV_ENDPOINT': os.environ.get('CV_ENDPOINT', 'https://cog-ulc72fwx-zd61-vision-vision.cognitiveservices.azure.com/'),
             'CV_KEY': os.environ.get('CV_KEY', 'test-key'),
@@ -246,9 +252,9 @@ class MockAccessToken:
     def get_token(self, *args, **kwargs):
         return self
 
-@patch('openai.AzureOpenAI')
+@patch('api.function_app.AzureOpenAI')
 @patch('api.function_app.credential')
-def test_summarize_results(mock_openai_class, mock_credential, use_azure_functions_test_env):
+def test_summarize_results(mock_credential, mock_openai_class, use_azure_functions_test_env):
     """Test OpenAI result summarization"""
     test_payload = {
         "object_results": [
@@ -263,7 +269,9 @@ def test_summarize_results(mock_openai_class, mock_credential, use_azure_functio
 
     # Set up the Azure AD token mock
     mock_token = MockAccessToken("mock-token")
+    mock_token.expires_on = 2 ** 31
     mock_credential.get_token.return_value = mock_token
+    client_registry.reset()
     
     # Create a mock completion response
     class MockChoice:
@@ -286,20 +294,1211 @@ def test_summarize_results(mock_openai_class, mock_credential, use_azure_functio
     # Set up the mock OpenAI client
     mock_client = MagicMock()
     mock_client.chat = MockChat()
-    mock_openai_class.return_value = mock_client    with patch.dict(os.environ, {
+    mock_openai_class.return_value = mock_client
+
+    with patch.dict(os.environ, {
             'OPENAI_ENDPOINT': os.environ.get('OPENAI_ENDPOINT', 'https://test-endpoint'),
             'OPENAI_MODEL': os.environ.get('OPENAI_MODEL', 'gpt-4o'),
             'OPENAI_API_VERSION': os.environ.get('OPENAI_API_VERSION', '2024-02-01')
          }):
         # Test summarize_results function
         result = summarize_results(json.dumps(test_payload))
+        summarize_results(json.dumps({**test_payload, "analyze_prompt": "Another prompt"}))
         
         # Verify the result
-        assert result == "Test summary"
+        assert result["summary"] == "Test summary"
+        assert result["aggregate"]["symbols"] == [{"label": "DOOR", "count": 1, "tags": {"door": 1}, "mean_confidence": 0.95}]
         
-        # Verify the OpenAI client was created with correct parameters
+        # Verify the OpenAI client was created once with correct parameters and then reused
         mock_openai_class.assert_called_once_with(
             azure_endpoint=os.environ['OPENAI_ENDPOINT'],
             api_version=os.environ['OPENAI_API_VERSION'],
-            azure_ad_token_provider=mock_credential
+            azure_ad_token_provider=ANY
         )
+        token_provider = mock_openai_class.call_args.kwargs["azure_ad_token_provider"]
+        assert token_provider() == "mock-token"
+        assert client_registry.stats()["openai"] == {"created": 1, "reused": 1}
+    client_registry.reset()
+
+class FakeTask:
+    def __init__(self, result, raises=False, duration=None):
+        self.result = result
+        self.raises = raises
+        self.is_completed = True
+        # Orchestration time that passes before the task completes
+        self.duration = duration or timedelta(0)
+
+class FakeOrchestrationContext:
+    """Runs every activity inline so the orchestrator generator can be driven in a test"""
+    def __init__(self, payload, activities):
+        self._payload = payload
+        self._activities = activities
+        self.activity_calls = []
+        self.fan_out_sizes = []
+        self.retry_options = []
+        self.timers = []
+        self.current_utc_datetime = datetime(2025, 1, 1)
+        self.instance_id = "instance"
+        self.sub_orchestrations = []
+        self.custom_status = None
+        self.custom_statuses = []
+        self.continued_with = None
+
+    def get_input(self):
+        return self._payload
+
+    def call_activity(self, name, input_=None):
+        self.activity_calls.append((name, input_))
+        return FakeTask(self._activities[name](input_))
+
+    def call_activity_with_retry(self, name, retry_options, input_=None):
+        self.retry_options.append(retry_options)
+        return self.call_activity(name, input_)
+
+    def create_timer(self, fire_at):
+        self.timers.append(fire_at)
+        self.current_utc_datetime = fire_at
+        return FakeTask(None)
+
+    def task_all(self, tasks):
+        self.fan_out_sizes.append(len(tasks))
+        return FakeTask([task.result for task in tasks], duration=max((task.duration for task in tasks), default=None))
+
+    def call_sub_orchestrator(self, name, input_=None, instance_id=None):
+        self.sub_orchestrations.append((name, input_, instance_id))
+        task = FakeTask(None)
+        task.is_completed = False
+        task.run = lambda: self._activities[name](input_)
+        return task
+
+    def task_any(self, tasks):
+        # Activities run inline and are already complete, the first one completes the task.
+        # Otherwise the first pending sub-orchestration runs, advancing the clock by a minute per plan
+        self.fan_out_sizes.append(len(tasks))
+        if all(task.is_completed for task in tasks):
+            return FakeTask(tasks[0], duration=max(task.duration for task in tasks))
+        task = next(task for task in tasks if not task.is_completed)
+        self.current_utc_datetime += timedelta(minutes=1)
+        try:
+            task.result = task.run()
+        except Exception as e:
+            task.result = e
+        task.is_completed = True
+        # Like the SDK's task_any this never fails, it completes with the first task
+        # and a failed task holds its exception as result
+        return FakeTask(task)
+
+    def set_custom_status(self, status):
+        self.custom_status = status
+        self.custom_statuses.append(status)
+
+    def continue_as_new(self, input_):
+        self.continued_with = input_
+
+def run_orchestrator(context, orchestrator_trigger=None):
+    orchestrator = (orchestrator_trigger or vision_agent_orchestrator)._function._func.orchestrator_function
+    generator = orchestrator(context)
+    try:
+        task = next(generator)
+        while True:
+            context.current_utc_datetime += getattr(task, "duration", timedelta(0))
+            if task.raises:
+                task = generator.throw(task.result)
+            else:
+                task = generator.send(task.result)
+    except StopIteration as stop:
+        return stop.value
+
+def run_until_complete(context, orchestrator_trigger):
+    """Runs the orchestrator again with its new input every time it continues as new"""
+    executions = 0
+    while True:
+        executions += 1
+        result = run_orchestrator(context, orchestrator_trigger)
+        if context.continued_with is None:
+            return result, executions
+        context._payload, context.continued_with = context.continued_with, None
+
+def test_activity_metrics_carry_client_stats(use_azure_functions_test_env, caplog):
+    """Test the activity log lines carry the worker's client and token reuse counters"""
+    with caplog.at_level(logging.INFO, logger="pipeline.metrics"):
+        summarize_results(json.dumps({"object_results": [], "narrative": False}))
+
+    record = next(record for record in caplog.records if record.name == "pipeline.metrics")
+    assert record.metrics["tokens.acquired"] == token_credential.stats()["acquired"]
+    assert record.metrics["tokens.reused"] == token_credential.stats()["reused"]
+
+def test_summarize_results_aggregates_locally(use_azure_functions_test_env):
+    """Test the aggregate is computed without the model and the narrative can be turned off"""
+    object_results = ([{"tag": "outlet", "probability": 0.92, "model_response": "DUPLEX OUTLET"}] * 3 +
+                      [{"tag": "light", "probability": 0.55, "model_response": "No Match"}])
+    with patch('api.function_app.get_openai_client') as mock_get_client:
+        result = summarize_results(json.dumps({"object_results": object_results, "narrative": False}))
+
+    mock_get_client.assert_not_called()
+    aggregate = result["aggregate"]
+    assert aggregate["detections"] == 4
+    assert aggregate["symbols"] == [{"label": "DUPLEX OUTLET", "count": 3, "tags": {"outlet": 3}, "mean_confidence": 0.92}]
+    assert aggregate["tags"] == {"outlet": 3, "light": 1}
+    assert aggregate["no_match"] == {"count": 1, "rate": 0.25}
+    assert aggregate["confidence_histogram"]["0.9-1.0"] == 3
+    assert aggregate["confidence_histogram"]["0.5-0.6"] == 1
+    assert "- DUPLEX OUTLET: 3" in result["summary"]
+
+def test_summarize_results_caches_narrative(use_azure_functions_test_env):
+    """Test the narrative is written from the aggregate only and reused for the same aggregate and prompt"""
+    get_classification_cache.cache_clear()
+    mock_client = MagicMock()
+    mock_client.chat.completions.create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="Narrative"))])
+    object_results = [{"tag": "door", "probability": 0.9, "model_response": "DOOR", "bounding_box": {"left": 0.1}}] * 500
+    with patch('api.function_app.get_openai_client', return_value=mock_client), \
+         patch.dict(os.environ, {'OPENAI_MODEL': 'gpt-4o', 'CLASSIFICATION_CACHE_BACKEND': 'memory'}):
+        first = summarize_results(json.dumps({"object_results": object_results, "analyze_prompt": "Prompt"}))
+        second = summarize_results(json.dumps({"object_results": object_results, "analyze_prompt": "Prompt"}))
+        summarize_results(json.dumps({"object_results": object_results, "analyze_prompt": "Other prompt"}))
+    get_classification_cache.cache_clear()
+
+    assert first["summary"] == second["summary"] == "Narrative"
+    assert (first["cache_hit"], second["cache_hit"]) == (False, True)
+    assert mock_client.chat.completions.create.call_count == 2
+    # The prompt holds one line per distinct symbol, not one per detection
+    prompt = mock_client.chat.completions.create.call_args.kwargs["messages"][1]["content"]
+    assert prompt.count("- DOOR: 500") == 1
+    assert len(prompt) < 1000
+
+def test_read_image_by_reference(use_azure_functions_test_env):
+    """Test read_image returns a blob reference and not the image bytes"""
+    mock_blob_client = MagicMock()
+    mock_blob_client.get_blob_properties.return_value = MagicMock(size=12345678, etag='"0x8DC"')
+    mock_service = MagicMock()
+    mock_service.get_blob_client.return_value = mock_blob_client
+
+    with patch('api.function_app.get_storage_client', return_value=mock_service):
+        result = read_image(json.dumps({
+            "container": "floorplans",
+            "filename": "test.png",
+            "by_reference": True
+        }))
+
+    assert result == {"container": "floorplans", "blob": "test.png", "size": 12345678, "etag": "0x8DC"}
+    mock_blob_client.download_blob.assert_not_called()
+
+def make_pipeline_activities(image_size, detection_count=5):
+    """Stand-in activities that return references only, like the real ones do"""
+    def fake_crop_detections(payload):
+        data = json.loads(payload)
+        return [{"index": index,
+                 **json.loads(pred),
+                 "crop_ref": {"container": "floorplans", "blob": f"crops/plan.png/0x1/{index}.jpg", "size": 2048, "etag": "0x2"}}
+                for index, pred in enumerate(data["predictions"])]
+
+    return {
+        "read_image": lambda payload: {"container": "floorplans",
+                                       "blob": json.loads(payload)["filename"],
+                                       "size": image_size,
+                                       "etag": "0x1"},
+        "object_detection": lambda payload: [json.dumps({
+            "tag": "door", "probability": 0.9,
+            "bounding_box": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2}})] * detection_count,
+        "register_legend": lambda payload: {"legend_id": "a" * 64, "container": "floorplans", "size": 5_000_000},
+        "deduplicate_predictions": lambda payload: {"predictions": json.loads(payload)["predictions"],
+                                                    "candidates": len(json.loads(payload)["predictions"]),
+                                                    "suppressed": 0,
+                                                    "capped": 0},
+        "crop_detections": fake_crop_detections,
+        "azure_openai_processing": lambda payload: {"model_response": "DOOR",
+                                                    **{k: json.loads(payload)[k] for k in ("bounding_box", "tag", "probability")},
+                                                    "cache_hit": json.loads(payload)["crop_ref"]["blob"].endswith("0.jpg")},
+        "azure_openai_batch_processing": lambda payload: [
+            {"model_response": "DOOR", **{k: detection[k] for k in ("bounding_box", "tag", "probability")}}
+            for detection in json.loads(payload)["detections"]],
+        "summarize_results": lambda payload: {"summary": "Test summary", "aggregate": {"detections": len(json.loads(payload)["object_results"])}},
+        "save_plan_results": lambda payload: {"container": "floorplans",
+                                              "blob": f"results/{json.loads(payload)['instance_id']}.json",
+                                              "size": len(payload),
+                                              "etag": "0x3"},
+    }
+
+def make_orchestrator_input():
+    return {
+        "container": "floorplans",
+        "filename": "plan.png",
+        "reference_filename": "legend.png",
+        "analyze_prompt": "Test prompt"
+    }
+
+def test_orchestrator_history_does_not_grow_with_image_size(use_azure_functions_test_env):
+    """Test the orchestrator only passes blob references between activities"""
+    def run_with_image_size(size):
+        context = FakeOrchestrationContext(make_orchestrator_input(), make_pipeline_activities(size))
+        result = run_orchestrator(context)
+        assert result["summary"] == "Test summary"
+        assert len(result["detections"]) == 5
+        assert result["cache"] == {"hits": 1, "misses": 4}
+        return sum(len(payload) for _, payload in context.activity_calls)
+
+    small = run_with_image_size(10_000)
+    large = run_with_image_size(20_000_000)
+    # Only the size digits in the references differ
+    assert large - small < 100
+
+def test_orchestrator_replay_does_not_decode_images(use_azure_functions_test_env):
+    """Test replaying the orchestrator does no image work, whatever the image size"""
+    with patch('api.function_app.Image.open', side_effect=AssertionError("decoded in orchestrator")), \
+         patch('api.function_app.base64.b64decode', side_effect=AssertionError("decoded in orchestrator")):
+        # Each run is a full replay of the orchestration history
+        for size in (10_000, 20_000_000):
+            for _ in range(3):
+                context = FakeOrchestrationContext(make_orchestrator_input(), make_pipeline_activities(size))
+                result = run_orchestrator(context)
+                assert len(result["detections"]) == 5
+
+def test_crop_detections(use_azure_functions_test_env):
+    """Test every detection above the threshold is cropped in one pass"""
+    test_image = Image.new('RGB', (200, 100), color='white')
+    img_io = io.BytesIO()
+    test_image.save(img_io, format='PNG')
+
+    predictions = [
+        json.dumps({"tag": "door", "probability": 0.9,
+                    "bounding_box": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2}}),
+        json.dumps({"tag": "window", "probability": 0.3,
+                    "bounding_box": {"left": 0.5, "top": 0.5, "width": 0.1, "height": 0.1}}),
+        json.dumps({"tag": "outlet", "probability": 0.8,
+                    "bounding_box": {"left": 0.6, "top": 0.2, "width": 0.1, "height": 0.3}}),
+    ]
+    uploads = {}
+
+    def fake_upload(container, blob, data, content_type="application/octet-stream"):
+        uploads[blob] = data
+        return MagicMock(model_dump=lambda: {"container": container, "blob": blob, "size": len(data), "etag": "0x2"})
+
+    with patch('api.function_app.read_blob_reference', return_value=img_io.getvalue()) as mock_read, \
+         patch('api.function_app.upload_blob_bytes', side_effect=fake_upload):
+        crops = crop_detections(json.dumps({
+            "image_ref": {"container": "floorplans", "blob": "plan.png", "size": 1, "etag": "0x1"},
+            "predictions": predictions,
+            "prediction_threshold": 0.5
+        }))
+
+    mock_read.assert_called_once()
+    assert [crop["tag"] for crop in crops] == ["door", "outlet"]
+    assert [crop["index"] for crop in crops] == [0, 2]
+    crop_name = crops[0]["crop_ref"]["blob"]
+    assert re.fullmatch(r"crops/plan\.png/0x1/[0-9a-f]{16}/0\.jpg", crop_name)
+    # 40x20 box plus the 10px buffer on every side
+    assert Image.open(io.BytesIO(uploads[crop_name])).size == (60, 40)
+
+def test_crop_paths_depend_on_crop_settings(use_azure_functions_test_env):
+    """Test runs of the same plan with other crop or dedup options don't share crop paths"""
+    test_image = Image.new('RGB', (200, 100), color='white')
+    img_io = io.BytesIO()
+    test_image.save(img_io, format='PNG')
+    door = json.dumps({"tag": "door", "probability": 0.9,
+                       "bounding_box": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2}})
+    outlet = json.dumps({"tag": "outlet", "probability": 0.8,
+                         "bounding_box": {"left": 0.6, "top": 0.2, "width": 0.1, "height": 0.3}})
+
+    def crop_directory(predictions, normalization=None):
+        with patch('api.function_app.read_blob_reference', return_value=img_io.getvalue()), \
+             patch('api.function_app.upload_blob_bytes', side_effect=lambda container, blob, data, content_type=None:
+                   MagicMock(model_dump=lambda: {"container": container, "blob": blob, "size": len(data), "etag": "0x2"})):
+            crops = crop_detections(json.dumps({
+                "image_ref": {"container": "floorplans", "blob": "plan.png", "size": 1, "etag": "0x1"},
+                "predictions": predictions,
+                "normalization": normalization}))
+        return crops[0]["crop_ref"]["blob"].rsplit("/", 1)[0]
+
+    base = crop_directory([door, outlet])
+    assert crop_directory([door, outlet]) == base
+    # Another de-duplication keeps other predictions at the same index
+    assert crop_directory([outlet, door]) != base
+    assert crop_directory([door, outlet], {"max_side": 64, "color_mode": "grayscale", "palette_colors": 16,
+                                           "image_format": "JPEG", "quality": 50}) != base
+
+def test_crop_detections_normalizes_crops(use_azure_functions_test_env):
+    """Test crops are resized and encoded as configured, with the bytes saved reported"""
+    test_image = Image.new('RGB', (2000, 1000), color='white')
+    img_io = io.BytesIO()
+    test_image.save(img_io, format='PNG')
+    uploads = {}
+
+    def fake_upload(container, blob, data, content_type="application/octet-stream"):
+        uploads[blob] = (data, content_type)
+        return MagicMock(model_dump=lambda: {"container": container, "blob": blob, "size": len(data), "etag": "0x2"})
+
+    with patch('api.function_app.read_blob_reference', return_value=img_io.getvalue()), \
+         patch('api.function_app.upload_blob_bytes', side_effect=fake_upload):
+        crops = crop_detections(json.dumps({
+            "image_ref": {"container": "floorplans", "blob": "plan.png", "size": 1, "etag": "0x1"},
+            "predictions": [json.dumps({"tag": "door", "probability": 0.9,
+                                        "bounding_box": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2}})],
+            "normalization": {"max_side": 64, "color_mode": "grayscale", "palette_colors": 16, "image_format": "PNG", "quality": None}
+        }))
+
+    crop_name = crops[0]["crop_ref"]["blob"]
+    assert crop_name.startswith("crops/plan.png/0x1/") and crop_name.endswith("/0.png")
+    data, content_type = uploads[crop_name]
+    assert content_type == "image/png"
+    # 420x220 with the buffer, scaled to a 64px longest side
+    assert Image.open(io.BytesIO(data)).size == (64, 34)
+    assert Image.open(io.BytesIO(data)).mode == "L"
+    assert crops[0]["bytes_before"] > crops[0]["crop_ref"]["size"]
+
+def test_normalize_plan(use_azure_functions_test_env):
+    """Test the detection copy of the plan is downscaled and stored next to the crops"""
+    test_image = Image.new('RGB', (4000, 3000), color='white')
+    img_io = io.BytesIO()
+    test_image.save(img_io, format='PNG')
+    uploads = {}
+
+    def fake_upload(container, blob, data, content_type="application/octet-stream"):
+        uploads[blob] = data
+        return MagicMock(model_dump=lambda: {"container": container, "blob": blob, "size": len(data), "etag": "0x3"})
+
+    digest = hashlib.sha256(b"plan").hexdigest()
+    with patch('api.function_app.read_blob_reference', return_value=img_io.getvalue()), \
+         patch('api.function_app.upload_blob_bytes', side_effect=fake_upload):
+        result = normalize_plan(json.dumps({
+            "image_ref": {"container": "floorplans", "blob": f"floorplan-{digest}.png", "size": 5_000_000, "etag": "0x1"},
+            "max_side": 2000, "color_mode": "grayscale", "palette_colors": 16}))
+
+    assert result["image_ref"]["blob"] == f"normalized/{digest}/grayscale-2000-16.png"
+    assert Image.open(io.BytesIO(uploads[result["image_ref"]["blob"]])).size == (2000, 1500)
+    assert result["bytes_before"] == 5_000_000
+    assert result["bytes_after"] == len(uploads[result["image_ref"]["blob"]])
+
+def test_orchestrator_detects_on_normalized_plan(use_azure_functions_test_env):
+    """Test detection runs on the normalized copy while crops are cut from the original"""
+    activities = make_pipeline_activities(10_000)
+    activities["normalize_plan"] = lambda payload: {
+        "image_ref": {"container": "floorplans", "blob": "normalized/plan.png", "size": 1_000, "etag": "0x9"},
+        "bytes_before": 10_000, "bytes_after": 1_000}
+    payload = {**make_orchestrator_input(), "detection_max_side": 2048, "image_color_mode": "grayscale"}
+    context = FakeOrchestrationContext(payload, activities)
+    result = run_orchestrator(context)
+
+    calls = {name: json.loads(p) for name, p in context.activity_calls}
+    assert calls["normalize_plan"]["max_side"] == 2048
+    assert calls["object_detection"]["image_ref"]["blob"] == "normalized/plan.png"
+    assert calls["crop_detections"]["image_ref"]["blob"] == "plan.png"
+    assert calls["crop_detections"]["normalization"]["color_mode"] == "grayscale"
+    assert result["normalization"]["detection"] == {"bytes_before": 10_000, "bytes_after": 1_000}
+
+    # Without any setting the plan goes to detection as it is
+    context = FakeOrchestrationContext(make_orchestrator_input(), make_pipeline_activities(10_000))
+    result = run_orchestrator(context)
+    assert "normalize_plan" not in [name for name, _ in context.activity_calls]
+    assert result["normalization"]["detection"] == {"bytes_before": 10_000, "bytes_after": 10_000}
+
+def test_register_legend_is_content_addressed(use_azure_functions_test_env):
+    """Test the legend is stored once under its content hash"""
+    legend_bytes = b"legend-image-bytes"
+    mock_blob_client = MagicMock()
+    # The legend is missing on the first run, its index and both on the second one
+    mock_blob_client.exists.side_effect = [False, True, True, True]
+    mock_service = MagicMock()
+    mock_service.get_blob_client.return_value = mock_blob_client
+    payload = json.dumps({"reference_ref": {"container": "floorplans", "blob": "legend.png", "size": 18, "etag": "0x1"}})
+
+    with patch('api.function_app.read_blob_reference', return_value=legend_bytes), \
+         patch('api.function_app.get_storage_client', return_value=mock_service):
+        first = register_legend(payload)
+        second = register_legend(payload)
+
+    assert first == second
+    assert first["legend_id"] == hashlib.sha256(legend_bytes).hexdigest()
+    mock_service.get_blob_client.assert_any_call(container="floorplans", blob=f"legends/{first['legend_id']}")
+    mock_service.get_blob_client.assert_called_with(container="floorplans", blob=f"legend-index/{first['legend_id']}.json")
+    mock_blob_client.upload_blob.assert_called_once()
+
+def test_content_address():
+    """Test the SHA-256 is read back from content-addressed blob names only"""
+    digest = hashlib.sha256(b"plan").hexdigest()
+    assert content_address(f"floorplan-{digest}.png") == digest
+    assert content_address(f"site-a/reference-{digest}.jpeg") == digest
+    assert content_address(f"legends/{digest}") == digest
+    assert content_address("floorplan-3f2b1c4e-uuid.png") is None
+    assert content_address("plan.png") is None
+
+def test_register_legend_trusts_content_addressed_name(use_azure_functions_test_env):
+    """Test a content-addressed legend that is already registered is never downloaded"""
+    legend_id = hashlib.sha256(b"legend-image-bytes").hexdigest()
+    mock_blob_client = MagicMock()
+    mock_blob_client.exists.return_value = True
+    mock_service = MagicMock()
+    mock_service.get_blob_client.return_value = mock_blob_client
+    payload = json.dumps({"reference_ref": {"container": "floorplans", "blob": f"reference-{legend_id}.png", "size": 18, "etag": "0x1"}})
+
+    with patch('api.function_app.read_blob_reference') as mock_read, \
+         patch('api.function_app.get_storage_client', return_value=mock_service):
+        result = register_legend(payload)
+
+    assert result == {"legend_id": legend_id, "container": "floorplans", "size": 18}
+    mock_read.assert_not_called()
+    mock_blob_client.upload_blob.assert_not_called()
+
+def test_classification_payload_does_not_carry_legend(use_azure_functions_test_env):
+    """Test each classification task references the legend by ID only"""
+    context = FakeOrchestrationContext(make_orchestrator_input(), make_pipeline_activities(10_000))
+    run_orchestrator(context)
+
+    register_calls = [name for name, _ in context.activity_calls if name == "register_legend"]
+    classify_payloads = [json.loads(payload) for name, payload in context.activity_calls if name == "azure_openai_processing"]
+    assert len(register_calls) == 1
+    assert len(classify_payloads) == 5
+    for payload in classify_payloads:
+        assert payload["legend_id"] == "a" * 64
+        assert "reference_img" not in payload
+        assert len(json.dumps(payload)) < 1024
+
+def test_orchestrator_batches_classification(use_azure_functions_test_env):
+    """Test crops are classified in groups of classification_batch_size"""
+    payload = {**make_orchestrator_input(), "classification_batch_size": 2}
+    context = FakeOrchestrationContext(payload, make_pipeline_activities(10_000))
+    result = run_orchestrator(context)
+
+    batch_calls = [json.loads(p) for name, p in context.activity_calls if name == "azure_openai_batch_processing"]
+    assert [len(call["detections"]) for call in batch_calls] == [2, 2, 1]
+    assert not [name for name, _ in context.activity_calls if name == "azure_openai_processing"]
+    assert len(result["detections"]) == 5
+
+def make_blob_store(blobs):
+    """download_blob_bytes over a dict, a missing blob raises like the SDK does"""
+    from azure.core.exceptions import ResourceNotFoundError
+    def download(container, blob):
+        if blob not in blobs:
+            raise ResourceNotFoundError(f"{blob} not found")
+        return blobs[blob]
+    return download
+
+def test_legend_index_is_built_once_and_persisted(use_azure_functions_test_env):
+    """Test the legend is segmented once, stored under its content hash and reused from memory and storage"""
+    legend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'SampleDocs', 'DesignElements', 'floorplan_legend2.png')
+    with open(legend_path, 'rb') as f:
+        legend_bytes = f.read()
+    legend_id = hashlib.sha256(legend_bytes).hexdigest()
+    blobs = {f"legends/{legend_id}": legend_bytes}
+    downloads = []
+    def download(container, blob):
+        downloads.append(blob)
+        return make_blob_store(blobs)(container, blob)
+    def upload(container, blob, data, content_type="application/octet-stream"):
+        blobs[blob] = data
+    get_legend_index.cache_clear()
+    get_legend_data_url.cache_clear()
+
+    with patch('api.function_app.download_blob_bytes', side_effect=download), \
+         patch('api.function_app.upload_blob_bytes', side_effect=upload):
+        index = get_legend_index("floorplans", legend_id)
+        assert get_legend_index("floorplans", legend_id) is index
+        get_legend_index.cache_clear()
+        downloads.clear()
+        reloaded = get_legend_index("floorplans", legend_id)
+        compact_url = get_legend_data_url("floorplans", legend_id, True)
+    get_legend_index.cache_clear()
+    get_legend_data_url.cache_clear()
+
+    # Three chairs and two doors
+    assert len(index["entries"]) == 5
+    assert reloaded == index
+    assert json.loads(blobs[f"legend-index/{legend_id}.json"]) == index
+    # A stored index is read back without segmenting the legend again
+    assert f"legends/{legend_id}" not in downloads
+    sheet = Image.open(io.BytesIO(blobs[f"legend-index/{legend_id}.png"]))
+    legend = Image.open(io.BytesIO(legend_bytes))
+    assert sheet.width * sheet.height < legend.width * legend.height / 4
+    assert compact_url == "data:image/png;base64," + base64.b64encode(blobs[f"legend-index/{legend_id}.png"]).decode()
+
+def test_orchestrator_escalates_only_unmatched_crops(use_azure_functions_test_env):
+    """Test crops matched to a labelled legend symbol skip the model and the escalation rate is reported"""
+    activities = make_pipeline_activities(10_000)
+    matches = [{"entry": 0, "score": 0.97, "label": "DOOR"},
+               {"entry": 1, "score": 0.95, "label": None},
+               {"entry": None, "score": 0.4, "label": None},
+               {"entry": 0, "score": 0.93, "label": "DOOR"},
+               {"entry": None, "score": 0.2, "label": None}]
+    activities["match_legend_symbols"] = lambda payload: matches
+    context = FakeOrchestrationContext({**make_orchestrator_input(), "template_match_threshold": 0.9}, activities)
+    result = run_orchestrator(context)
+
+    match_call = next(json.loads(p) for name, p in context.activity_calls if name == "match_legend_symbols")
+    assert match_call["threshold"] == 0.9
+    assert len(match_call["crop_refs"]) == 5
+    classify_calls = [json.loads(p) for name, p in context.activity_calls if name == "azure_openai_processing"]
+    assert [call["crop_ref"]["blob"][-5:] for call in classify_calls] == ["1.jpg", "2.jpg", "4.jpg"]
+    # A match without a known label is escalated with its entry, the model's answer labels it
+    assert [call.get("legend_entry") for call in classify_calls] == [1, None, None]
+    assert [detection["model_response"] for detection in result["detections"]] == ["DOOR"] * 5
+    assert result["detections"][0]["match_score"] == 0.97
+    assert result["preclassification"] == {"threshold": 0.9, "local": 2, "escalated": 3, "escalation_rate": 0.6}
+
+def test_orchestrator_skips_template_matching_by_default(use_azure_functions_test_env):
+    context = FakeOrchestrationContext(make_orchestrator_input(), make_pipeline_activities(10_000))
+    result = run_orchestrator(context)
+
+    assert "match_legend_symbols" not in [name for name, _ in context.activity_calls]
+    assert result["preclassification"]["escalation_rate"] == 1.0
+
+def test_match_legend_symbols_learns_labels(use_azure_functions_test_env):
+    """Test a crop matching a legend symbol takes the label the model agreed on for that symbol"""
+    from classification_cache import ClassificationCache, MemoryCacheBackend
+    legend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'SampleDocs', 'DesignElements', 'floorplan_legend.png')
+    legend = Image.open(legend_path)
+    chair = legend.crop((150, 305, 350, 540)).convert('RGB')
+    chair_io = io.BytesIO()
+    chair.save(chair_io, format='JPEG')
+    with open(legend_path, 'rb') as f:
+        legend_bytes = f.read()
+    cache = ClassificationCache(MemoryCacheBackend())
+    payload = json.dumps({"crop_refs": [{"container": "floorplans", "blob": "crops/0.jpg", "size": 4, "etag": "0x1"}],
+                          "legend_id": "b" * 64, "legend_container": "floorplans",
+                          "analyze_prompt": "Test prompt", "threshold": 0.9})
+    get_legend_symbols.cache_clear()
+    get_legend_index.cache_clear()
+
+    with patch('api.function_app.get_classification_cache', return_value=cache), \
+         patch('api.function_app.download_blob_bytes', side_effect=make_blob_store({f"legends/{'b' * 64}": legend_bytes})), \
+         patch('api.function_app.upload_blob_bytes'), \
+         patch('api.function_app.read_blob_reference', return_value=chair_io.getvalue()):
+        first = match_legend_symbols(payload)[0]
+        # The model's answers for the escalated crops are votes for the legend symbol
+        remember_legend_entry("b" * 64, first["entry"], "Test prompt", "CHAIR")
+        remember_legend_entry("b" * 64, first["entry"], "Test prompt", "CHAIR")
+        unconfirmed = match_legend_symbols(payload)[0]
+        remember_legend_entry("b" * 64, first["entry"], "Test prompt", "CHAIR")
+        second = match_legend_symbols(payload)[0]
+    get_legend_symbols.cache_clear()
+    get_legend_index.cache_clear()
+
+    assert first["entry"] == 1
+    assert first["score"] > 0.9
+    assert first["label"] is None
+    assert unconfirmed["label"] is None
+    assert second["label"] == "CHAIR"
+
+def test_legend_entry_needs_agreeing_votes(use_azure_functions_test_env):
+    """Test a wrong answer doesn't label the symbol, and cached answers are counted too"""
+    from classification_cache import ClassificationCache, MemoryCacheBackend
+    cache = ClassificationCache(MemoryCacheBackend())
+    entry_key = legend_entry_key("c" * 64, 2, "Test prompt")
+
+    with patch('api.function_app.get_classification_cache', return_value=cache):
+        remember_legend_entry("c" * 64, 2, "Test prompt", "SINK")
+        for _ in range(3):
+            remember_legend_entry("c" * 64, 2, "Test prompt", "TOILET")
+        # 3 of 4 votes agree, below the 0.8 agreement
+        assert cache.get(entry_key)["model_response"] is None
+        remember_legend_entry("c" * 64, 2, "Test prompt", "TOILET")
+        assert cache.get(entry_key)["model_response"] == "TOILET"
+        for _ in range(2):
+            remember_legend_entry("c" * 64, 2, "Test prompt", "No Match.")
+        # Disagreement takes the label back
+        assert cache.get(entry_key)["model_response"] is None
+
+    # A crop answered from the classification cache still votes for its legend entry
+    symbol_io = io.BytesIO()
+    Image.new('RGB', (40, 40), color='white').save(symbol_io, format='JPEG')
+    cache = ClassificationCache(MemoryCacheBackend())
+    cache.set(classification_cache_key(symbol_io.getvalue(), "c" * 64, "Test prompt"), {"model_response": "SINK"})
+    with patch('api.function_app.get_classification_cache', return_value=cache), \
+         patch('api.function_app.read_blob_reference', return_value=symbol_io.getvalue()):
+        result = azure_openai_processing(json.dumps({
+            "crop_ref": {"container": "floorplans", "blob": "crops/0.jpg", "size": 4, "etag": "0x1"},
+            "legend_id": "c" * 64, "legend_entry": 2, "analyze_prompt": "Test prompt",
+            "bounding_box": {"left": 0.1, "top": 0.1, "width": 0.1, "height": 0.1}, "tag": "sink", "probability": 0.9}))
+    assert result["cache_hit"]
+    assert cache.get(entry_key)["votes"] == {"SINK": 1}
+
+def test_orchestrator_publishes_partial_results(use_azure_functions_test_env):
+    """Test the custom status carries the boxes first, then the labels as classifications complete"""
+    for batch_size in (1, 2):
+        payload = {**make_orchestrator_input(), "openai_max_parallel": 2, "classification_batch_size": batch_size}
+        context = FakeOrchestrationContext(payload, make_pipeline_activities(10_000))
+        run_orchestrator(context)
+
+        phases = [status["phase"] for status in context.custom_statuses]
+        assert phases[:3] == ["reading", "detecting", "classifying"]
+        assert phases[-1] == "summarizing"
+        first_results = context.custom_statuses[2]
+        assert first_results["detections"] == 5 and first_results["classified"] == 0
+        assert first_results["results"][0] == [0.1, 0.1, 0.2, 0.2, "door", 0.9, None]
+        classified = [status["classified"] for status in context.custom_statuses if status["phase"] == "classifying"]
+        assert classified == sorted(classified) and len(set(classified)) > 2
+        assert context.custom_statuses[-1]["results"][4][-1] == "DOOR"
+
+def test_partial_results_are_capped(use_azure_functions_test_env):
+    """Test the partial results stay within the 16KB custom status limit with the default settings"""
+    activities = make_pipeline_activities(10_000, detection_count=500)
+    activities["object_detection"] = lambda payload: [json.dumps({
+        "tag": "duplex_outlet", "probability": 0.912345,
+        "bounding_box": {"left": 0.123456, "top": 0.654321, "width": 0.023456, "height": 0.034567}})] * 500
+    label = "GROUND FAULT CIRCUIT INTERRUPTER OUTLET, WEATHERPROOF"
+    activities["azure_openai_processing"] = lambda payload: {
+        "model_response": label, **{k: json.loads(payload)[k] for k in ("bounding_box", "tag", "probability")}}
+    context = FakeOrchestrationContext(make_orchestrator_input(), activities)
+    run_orchestrator(context)
+
+    for status in context.custom_statuses:
+        # The host measures the status as UTF-16
+        assert len(json.dumps(status).encode("utf-16-le")) <= 16 * 1024
+    final = context.custom_statuses[-1]
+    assert final["detections"] == 500
+    assert 0 < len(final["results"]) < 500
+    assert final["results"][-1][-1] == "GROUND FAULT CIRCUIT INTERRUPTER OUTLET,"
+    assert final["truncated"]
+
+def test_progress_limit_comes_from_the_input(use_azure_functions_test_env):
+    """Test the status size limit is read from the orchestration input, not the app settings"""
+    context = FakeOrchestrationContext({**make_orchestrator_input(), "progress_max_chars": 300},
+                                       make_pipeline_activities(10_000, detection_count=50))
+    with patch.dict(os.environ, {"PROGRESS_MAX_CHARS": "100000"}):
+        run_orchestrator(context)
+
+    final = context.custom_statuses[-1]
+    assert len(json.dumps(final)) <= 300
+    assert final["truncated"]
+
+def test_azure_openai_batch_processing(use_azure_functions_test_env):
+    """Test one request classifies every crop and labels map back to their boxes"""
+    detections = [
+        {"tag": "door", "probability": 0.9,
+         "bounding_box": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2},
+         "crop_ref": {"container": "floorplans", "blob": "crops/0.jpg", "size": 4, "etag": "0x1"}},
+        {"tag": "outlet", "probability": 0.8,
+         "bounding_box": {"left": 0.5, "top": 0.5, "width": 0.1, "height": 0.1},
+         "crop_ref": {"container": "floorplans", "blob": "crops/1.jpg", "size": 4, "etag": "0x1"}},
+        {"tag": "light", "probability": 0.7,
+         "bounding_box": {"left": 0.7, "top": 0.2, "width": 0.1, "height": 0.1},
+         "crop_ref": {"container": "floorplans", "blob": "crops/2.jpg", "size": 4, "etag": "0x1"}},
+    ]
+    from classification_cache import ClassificationCache, MemoryCacheBackend
+    crops = {}
+    for index, color in enumerate(['black', 'gray', 'white']):
+        crop_io = io.BytesIO()
+        Image.new('RGB', (30 + index * 10, 30), color=color).save(crop_io, format='JPEG')
+        crops[f"crops/{index}.jpg"] = crop_io.getvalue()
+    mock_client = MagicMock()
+    mock_client.with_options.return_value = mock_client
+    mock_client.chat.completions.create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(
+        content=json.dumps({"labels": [{"symbol": 2, "label": "DUPLEX OUTLET"}, {"symbol": 1, "label": "DOOR"}]})))])
+
+    with patch('api.function_app.get_openai_client', return_value=mock_client), \
+         patch('api.function_app.get_legend_data_url', return_value="data:image/png;base64,AAAA"), \
+         patch('api.function_app.read_blob_reference', side_effect=lambda ref, cache=True: crops[ref["blob"]]), \
+         patch('api.function_app.get_classification_cache', return_value=ClassificationCache(MemoryCacheBackend())), \
+         patch.dict(os.environ, {'OPENAI_MODEL': 'gpt-4o'}):
+        results = azure_openai_batch_processing(json.dumps({
+            "detections": detections,
+            "legend_id": "a" * 64,
+            "analyze_prompt": "Test prompt"
+        }))
+
+    mock_client.chat.completions.create.assert_called_once()
+    messages = mock_client.chat.completions.create.call_args.kwargs["messages"]
+    image_parts = [part for part in messages[1]["content"] if part["type"] == "image_url"]
+    assert len(image_parts) == 3
+    assert [r["model_response"] for r in results] == ["DOOR", "DUPLEX OUTLET", "No Match"]
+    assert [r["bounding_box"] for r in results] == [d["bounding_box"] for d in detections]
+
+def test_azure_openai_processing_skips_model_for_cached_symbols(use_azure_functions_test_env):
+    """Test a repeated symbol is answered from the classification cache"""
+    from classification_cache import ClassificationCache, MemoryCacheBackend
+    symbol = Image.new('RGB', (40, 40), color='white')
+    symbol_io = io.BytesIO()
+    symbol.save(symbol_io, format='JPEG')
+    payload = json.dumps({
+        "tag": "door", "probability": 0.9,
+        "bounding_box": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2},
+        "crop_ref": {"container": "floorplans", "blob": "crops/0.jpg", "size": 4, "etag": "0x1"},
+        "legend_id": "a" * 64,
+        "analyze_prompt": "Test prompt"
+    })
+    mock_client = MagicMock()
+    mock_client.with_options.return_value = mock_client
+    mock_client.chat.completions.create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="DOOR"))])
+    cache = ClassificationCache(MemoryCacheBackend())
+
+    with patch('api.function_app.get_openai_client', return_value=mock_client), \
+         patch('api.function_app.get_classification_cache', return_value=cache), \
+         patch('api.function_app.get_legend_data_url', return_value="data:image/png;base64,AAAA"), \
+         patch('api.function_app.read_blob_reference', return_value=symbol_io.getvalue()), \
+         patch.dict(os.environ, {'OPENAI_MODEL': 'gpt-4o'}):
+        first = azure_openai_processing(payload)
+        second = azure_openai_processing(payload)
+
+    mock_client.chat.completions.create.assert_called_once()
+    assert first["model_response"] == second["model_response"] == "DOOR"
+    assert (first["cache_hit"], second["cache_hit"]) == (False, True)
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+def test_azure_openai_processing_adapts_image_detail(use_azure_functions_test_env):
+    """Test small crops are sent at low detail and the token usage is recorded"""
+    legend_io = io.BytesIO()
+    Image.new('RGB', (1600, 1200), color='white').save(legend_io, format='PNG')
+    legend_url = "data:image/png;base64," + base64.b64encode(legend_io.getvalue()).decode()
+    mock_client = MagicMock()
+    mock_client.with_options.return_value = mock_client
+    mock_client.chat.completions.create.return_value = MagicMock(
+        choices=[MagicMock(message=MagicMock(content="DOOR"))],
+        usage=MagicMock(prompt_tokens=1200, completion_tokens=3))
+
+    def classify(size, budget=0):
+        crop_io = io.BytesIO()
+        Image.new('RGB', size, color='white').save(crop_io, format='JPEG')
+        with patch('api.function_app.get_openai_client', return_value=mock_client), \
+             patch('api.function_app.get_legend_data_url', return_value=legend_url), \
+             patch('api.function_app.read_blob_reference', return_value=crop_io.getvalue()), \
+             patch.dict(os.environ, {'OPENAI_MODEL': 'gpt-4o', 'CLASSIFICATION_CACHE_BACKEND': 'none'}):
+            result = azure_openai_processing(json.dumps({
+                "tag": "door", "probability": 0.9,
+                "bounding_box": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2},
+                "crop_ref": {"container": "floorplans", "blob": "crops/0.jpg", "size": 4, "etag": "0x1"},
+                "legend_id": "a" * 64,
+                "image_token_budget": budget}))
+        messages = mock_client.chat.completions.create.call_args.kwargs["messages"]
+        return result, messages[0]["content"][1]["image_url"], messages[1]["content"][1]["image_url"]
+
+    result, legend_part, crop_part = classify((40, 40))
+    assert crop_part["detail"] == "low"
+    assert legend_part["detail"] == "high"
+    assert result["detail"] == "low"
+    # 765 for the legend (2x2 tiles at 1024x768) and 85 for the crop, plus the prompt text
+    assert 850 < result["usage"]["estimated_prompt_tokens"] < 1000
+    assert result["usage"]["prompt_tokens"] == 1200
+    assert result["usage"]["completion_tokens"] == 3
+
+    # A large crop is shrunk to its share of the budget
+    result, _, crop_part = classify((1800, 1800), budget=1400)
+    sent = Image.open(io.BytesIO(base64.b64decode(crop_part["url"].split(",", 1)[1])))
+    assert crop_part["detail"] == "high"
+    assert max(sent.size) < 1800
+
+    with patch.dict(os.environ, {'IMAGE_DETAIL_POLICY': 'high'}):
+        _, _, crop_part = classify((40, 40))
+    assert crop_part["detail"] == "high"
+
+def test_orchestrator_reports_token_usage(use_azure_functions_test_env):
+    """Test the run's image token budget is shared by the requests and their usage summed"""
+    activities = make_pipeline_activities(10_000)
+    activities["azure_openai_processing"] = lambda payload: {
+        "model_response": "DOOR", "tag": "door", "probability": 0.9, "bounding_box": json.loads(payload)["bounding_box"],
+        "detail": "low", "usage": {"estimated_prompt_tokens": 300, "prompt_tokens": 310, "completion_tokens": 2}}
+    context = FakeOrchestrationContext({**make_orchestrator_input(), "image_token_budget": 5000}, activities)
+    result = run_orchestrator(context)
+
+    payloads = [json.loads(p) for name, p in context.activity_calls if name == "azure_openai_processing"]
+    assert [p["image_token_budget"] for p in payloads] == [1000] * 5
+    assert result["tokens"] == {"requests": 5, "estimated_prompt_tokens": 1500, "prompt_tokens": 1550, "completion_tokens": 10}
+    assert result["image_detail"] == {"low": 5}
+
+def test_orchestrator_reports_stage_metrics(use_azure_functions_test_env):
+    """Test every stage's wall time, payload bytes and token usage are returned in the metrics block"""
+    activities = make_pipeline_activities(10_000)
+    activities["azure_openai_processing"] = lambda payload: {
+        "model_response": "DOOR", "tag": "door", "probability": 0.9, "bounding_box": json.loads(payload)["bounding_box"],
+        "usage": {"estimated_prompt_tokens": 300, "prompt_tokens": 310, "completion_tokens": 2}}
+    context = FakeOrchestrationContext(make_orchestrator_input(), activities)
+    # Every activity takes a second of orchestration time, object detection takes ten
+    call_activity = context.call_activity
+    def timed_call_activity(name, input_=None):
+        task = call_activity(name, input_)
+        task.duration = timedelta(seconds=10 if name == "object_detection" else 1)
+        return task
+    context.call_activity = timed_call_activity
+    result = run_orchestrator(context)
+
+    metrics = result["metrics"]
+    stages = metrics["stages"]
+    assert list(stages) == ["read_image", "register_legend", "object_detection", "deduplicate_predictions",
+                            "crop_detections", "azure_openai_processing", "summarize_results"]
+    assert stages["read_image"]["calls"] == 2
+    assert stages["object_detection"]["seconds"] == 10
+    assert stages["azure_openai_processing"]["calls"] == 5
+    assert stages["azure_openai_processing"]["prompt_tokens"] == 1550
+    assert stages["azure_openai_processing"]["completion_tokens"] == 10
+    assert stages["summarize_results"]["output_bytes"] == len(json.dumps({"summary": "Test summary", "aggregate": {"detections": 5}}))
+    for name, payload in context.activity_calls:
+        assert stages[name]["input_bytes"] >= len(payload)
+    assert metrics["hot_stage"] == "object_detection"
+    assert stages["read_image"]["seconds"] == 1
+    assert metrics["total_seconds"] == 16
+
+def test_orchestrator_does_not_read_app_settings(use_azure_functions_test_env):
+    """Test a setting changed during a run doesn't change what a replay schedules, only the input does"""
+    with patch.dict(os.environ, {"DETECTION_TILE_SIZE": "1024", "CLASSIFICATION_BATCH_SIZE": "4"}):
+        context = FakeOrchestrationContext(make_orchestrator_input(), make_pipeline_activities(10_000))
+        run_orchestrator(context)
+        resolved = resolve_settings("vision_agent_orchestrator", {**make_orchestrator_input(), "classification_batch_size": 2})
+        batch = resolve_settings("batch_floorplan_orchestrator", {"container": "floorplans", "options": {"detection_tile_size": 0}})
+
+    names = [name for name, _ in context.activity_calls]
+    assert "plan_detection_tiles" not in names and "azure_openai_batch_processing" not in names
+    # The app settings are resolved into the input when the run starts, the request wins
+    assert resolved["detection_tile_size"] == "1024"
+    assert resolved["classification_batch_size"] == 2
+    assert batch["options"] == {"detection_tile_size": 0, "classification_batch_size": "4"}
+
+def test_orchestrator_tiled_detection(use_azure_functions_test_env):
+    """Test tiled detection fans out over the tiles with bounded parallelism and merges the boxes"""
+    activities = make_pipeline_activities(10_000)
+    tiles = [{"left": left, "top": 0, "width": 1024, "height": 1024} for left in range(0, 896 * 5, 896)]
+    tile_refs = [{"container": "floorplans", "blob": f"tiles/plan.png/0x1/1024-128/{index}.png", "size": 100, "etag": "0x4"}
+                 for index in range(5)]
+    activities["plan_detection_tiles"] = lambda payload: {"width": 4608, "height": 1024, "tiles": [
+        {**tile, "tile_ref": tile_ref} for tile, tile_ref in zip(tiles, tile_refs)]}
+    activities["object_detection"] = lambda payload: [json.dumps({
+        "tag": "door", "probability": 0.9,
+        "bounding_box": {"left": json.loads(payload)["tile"]["left"] / 4608, "top": 0.1, "width": 0.01, "height": 0.05}})]
+    activities["merge_detections"] = lambda payload: [p for tile in json.loads(payload)["tile_predictions"] for p in tile]
+    payload = {**make_orchestrator_input(), "detection_tile_size": 1024, "detection_max_parallel": 2}
+
+    context = FakeOrchestrationContext(payload, activities)
+    result = run_orchestrator(context)
+
+    detection_calls = [json.loads(p) for name, p in context.activity_calls if name == "object_detection"]
+    assert [call["tile"] for call in detection_calls] == tiles
+    # Each tile activity only references its own tile, not the plan
+    assert [call["tile_ref"] for call in detection_calls] == tile_refs
+    assert all("image_ref" not in call for call in detection_calls)
+    assert [name for name, _ in context.activity_calls].count("merge_detections") == 1
+    # Five tiles with at most two in flight
+    assert context.fan_out_sizes[1:4] == [2, 2, 1]
+    assert result["deduplication"] == {"candidates": 5, "suppressed": 0, "capped": 0}
+    assert len(result["detections"]) == 5
+
+def test_plan_detection_tiles_cuts_tiles_once(use_azure_functions_test_env):
+    """Test the plan is decoded once and every tile is uploaded for its detection activity"""
+    test_image = Image.new('RGB', (400, 200), color='white')
+    img_io = io.BytesIO()
+    test_image.save(img_io, format='PNG')
+    uploads = {}
+
+    def fake_upload(container, blob, data, content_type="application/octet-stream"):
+        uploads[blob] = data
+        return MagicMock(model_dump=lambda: {"container": container, "blob": blob, "size": len(data), "etag": "0x2"})
+
+    with patch('api.function_app.read_blob_reference', return_value=img_io.getvalue()) as mock_read, \
+         patch('api.function_app.upload_blob_bytes', side_effect=fake_upload):
+        result = plan_detection_tiles(json.dumps({
+            "image_ref": {"container": "floorplans", "blob": "plan.png", "size": 1, "etag": "0x1"},
+            "tile_size": 200,
+            "tile_overlap": 0}))
+
+    mock_read.assert_called_once()
+    assert (result["width"], result["height"]) == (400, 200)
+    assert [tile["tile_ref"]["blob"] for tile in result["tiles"]] == ["tiles/plan.png/0x1/200-0/0.png",
+                                                                      "tiles/plan.png/0x1/200-0/1.png"]
+    assert [Image.open(io.BytesIO(data)).size for data in uploads.values()] == [(200, 200), (200, 200)]
+
+def test_object_detection_on_tile(use_azure_functions_test_env):
+    """Test boxes found on a tile are returned in plan coordinates"""
+    test_image = Image.new('RGB', (200, 200), color='white')
+    img_io = io.BytesIO()
+    test_image.save(img_io, format='PNG')
+    detected_sizes = []
+
+    class MockPredictor:
+        def detect_image(self, project_id, iteration_name, image_data):
+            detected_sizes.append(Image.open(io.BytesIO(image_data)).size)
+            box = MagicMock(left=0.5, top=0.5, width=0.25, height=0.25)
+            return MagicMock(predictions=[MagicMock(tag_name="door", probability=0.9, bounding_box=box)])
+
+    with patch('api.function_app.read_blob_reference', return_value=img_io.getvalue()), \
+         patch('api.function_app.get_custom_vision_client', return_value=MockPredictor()), \
+         patch.dict(os.environ, {'CV_PROJECT_ID': 'test-project', 'CV_MODEL_NAME': 'test-model'}):
+        result = object_detection(json.dumps({
+            "tile_ref": {"container": "floorplans", "blob": "tiles/plan.png/0x1/200-0/1.png", "size": 1, "etag": "0x2"},
+            "tile": {"left": 200, "top": 0, "width": 200, "height": 200},
+            "image_width": 400,
+            "image_height": 200
+        }))
+
+    assert detected_sizes == [(200, 200)]
+    box = json.loads(result[0])["bounding_box"]
+    assert box == {"left": 0.75, "top": 0.5, "width": 0.125, "height": 0.25}
+
+def test_merge_detections_across_tiles(use_azure_functions_test_env):
+    """Test duplicates from overlapping tiles are merged per tag"""
+    def prediction(tag, probability, left):
+        return json.dumps({"tag": tag, "probability": probability,
+                           "bounding_box": {"left": left, "top": 0.4, "width": 0.1, "height": 0.1}})
+
+    merged = merge_detections(json.dumps({"tile_predictions": [
+        [prediction("door", 0.9, 0.40), prediction("window", 0.8, 0.40)],
+        [prediction("door", 0.7, 0.41)],
+    ]}))
+
+    tags = sorted((json.loads(p)["tag"], json.loads(p)["probability"]) for p in merged)
+    assert tags == [("door", 0.9), ("window", 0.8)]
+
+def test_deduplicate_predictions(use_azure_functions_test_env):
+    """Test overlapping predictions of one symbol are classified once"""
+    def prediction(tag, probability, left):
+        return json.dumps({"tag": tag, "probability": probability,
+                           "bounding_box": {"left": left, "top": 0.4, "width": 0.1, "height": 0.1}})
+
+    result = deduplicate_predictions(json.dumps({
+        "predictions": [prediction("door", 0.9, 0.40), prediction("door", 0.8, 0.405),
+                        prediction("door", 0.7, 0.41), prediction("door", 0.3, 0.8),
+                        prediction("window", 0.6, 0.40)],
+        "prediction_threshold": 0.5,
+        "iou_threshold": 0.5
+    }))
+
+    kept = [(json.loads(p)["tag"], json.loads(p)["probability"]) for p in result["predictions"]]
+    assert kept == [("door", 0.9), ("window", 0.6)]
+    assert (result["candidates"], result["suppressed"], result["capped"]) == (4, 2, 0)
+
+def test_adaptive_fan_out_backs_off_on_throttling(use_azure_functions_test_env):
+    """Test throttled classifications are retried after a durable timer with a smaller window"""
+    calls = []
+
+    def fake_classify(payload):
+        calls.append(payload)
+        # The deployment throttles the first window
+        if len(calls) <= 4:
+            return {"throttled": True, "retry_after": 7}
+        return {"model_response": payload}
+
+    context = FakeOrchestrationContext({}, {"azure_openai_processing": fake_classify})
+    payloads = [f"symbol-{index}" for index in range(10)]
+    retry_options = object()
+
+    generator = call_activities_adaptive(context, "azure_openai_processing", payloads, 4, retry_options)
+    try:
+        task = next(generator)
+        while True:
+            task = generator.send(task.result)
+    except StopIteration as stop:
+        results, stats = stop.value
+
+    assert [result["model_response"] for result in results] == payloads
+    assert context.timers == [datetime(2025, 1, 1) + timedelta(seconds=7)]
+    # Halved after the throttled completions, then grows by 1/window per success
+    assert context.fan_out_sizes == [4, 2, 2, 3, 3]
+    assert stats == {"throttled": 4, "backoffs": 1, "min_window": 2}
+    assert all(options is retry_options for options in context.retry_options)
+
+class SlidingWindowContext:
+    """Activities take the given orchestration seconds, task_any completes the first one to finish"""
+    def __init__(self, durations):
+        self.durations = durations
+        self.now = 0
+        self.in_flight = []
+        self.max_in_flight = 0
+
+    def call_activity(self, name, input_=None):
+        task = FakeTask(input_)
+        task.is_completed = False
+        task.finish = self.now + self.durations[input_]
+        self.in_flight.append(task)
+        self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+        return task
+
+    def task_any(self, tasks):
+        first = min((task for task in tasks if not task.is_completed), key=lambda task: task.finish)
+        self.now = first.finish
+        for task in tasks:
+            if task.finish <= self.now:
+                task.is_completed = True
+                self.in_flight.remove(task)
+        return FakeTask(first)
+
+def test_bounded_fan_out_refills_slots_as_tasks_complete(use_azure_functions_test_env):
+    """Test one slow activity doesn't hold back the other slots of the window"""
+    context = SlidingWindowContext({"slow": 10, "a": 1, "b": 1, "c": 1, "d": 1})
+    generator = call_activities_bounded(context, "object_detection", ["slow", "a", "b", "c", "d"], 2)
+    try:
+        task = next(generator)
+        while True:
+            task = generator.send(task.result)
+    except StopIteration as stop:
+        results = stop.value
+
+    assert results == ["slow", "a", "b", "c", "d"]
+    assert context.max_in_flight == 2
+    # The four fast activities run one after the other next to the slow one
+    assert context.now == 10
+
+def test_adaptive_fan_out_gives_up_after_max_throttle_retries(use_azure_functions_test_env):
+    """Test a payload that stays throttled eventually fails the orchestration"""
+    context = FakeOrchestrationContext({}, {"azure_openai_processing": lambda payload: {"throttled": True, "retry_after": 1}})
+    generator = call_activities_adaptive(context, "azure_openai_processing", ["symbol"], 4, object(), max_throttle_retries=2)
+    with pytest.raises(Exception, match="still throttled"):
+        task = next(generator)
+        while True:
+            task = generator.send(task.result)
+
+def test_azure_openai_processing_reports_retry_after(use_azure_functions_test_env):
+    """Test a 429 from Azure OpenAI is returned to the orchestrator with its Retry-After"""
+    from openai import RateLimitError
+    symbol_io = io.BytesIO()
+    Image.new('RGB', (40, 40), color='white').save(symbol_io, format='JPEG')
+    rate_limit = RateLimitError("Too many requests",
+                                response=MagicMock(status_code=429, headers={"retry-after-ms": "2500"}),
+                                body=None)
+    mock_client = MagicMock()
+    mock_client.with_options.return_value = mock_client
+    mock_client.chat.completions.create.side_effect = rate_limit
+
+    with patch('api.function_app.get_openai_client', return_value=mock_client), \
+         patch('api.function_app.get_legend_data_url', return_value="data:image/png;base64,AAAA"), \
+         patch('api.function_app.read_blob_reference', return_value=symbol_io.getvalue()), \
+         patch.dict(os.environ, {'OPENAI_MODEL': 'gpt-4o', 'CLASSIFICATION_CACHE_BACKEND': 'none'}):
+        result = azure_openai_processing(json.dumps({
+            "tag": "door", "probability": 0.9,
+            "bounding_box": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2},
+            "crop_ref": {"container": "floorplans", "blob": "crops/0.jpg", "size": 4, "etag": "0x1"},
+            "legend_id": "b" * 64
+        }))
+
+    assert result == {"throttled": True, "retry_after": 2.5}
+    mock_client.with_options.assert_called_with(max_retries=0)
+
+
+def make_batch_activities(filenames, failing=(), saved=None, previous_manifest=None):
+    saved = saved if saved is not None else []
+    def analyze(payload):
+        if payload["filename"] in failing:
+            raise Exception(f"Analysis failed for {payload['filename']}")
+        return {"results_ref": {"container": "floorplans", "blob": f"results/{payload['filename']}.json", "size": 100, "etag": "0x1"},
+                "detections": 2}
+    return {
+        "list_floorplans": lambda payload: list(filenames),
+        "load_batch_manifest": lambda payload: previous_manifest,
+        "save_batch_manifest": lambda payload: saved.append(json.loads(payload)),
+        "vision_agent_orchestrator": analyze
+    }
+
+def make_batch_input(**extra):
+    return {"container": "floorplans",
+            "prefix": "site-a/",
+            "reference_filename": "site-a/legend.png",
+            "analyze_prompt": "Test prompt",
+            **extra}
+
+def test_batch_orchestrator_caps_concurrent_plans(use_azure_functions_test_env):
+    """Test the batch runs every plan as a sub-orchestration with at most max_concurrent_plans in flight"""
+    filenames = [f"site-a/plan-{i}.png" for i in range(5)]
+    saved = []
+    context = FakeOrchestrationContext(make_batch_input(max_concurrent_plans=2, options={"classification_batch_size": 4}),
+                                       make_batch_activities(filenames, saved=saved))
+    manifest = run_orchestrator(context, batch_floorplan_orchestrator)
+
+    assert max(context.fan_out_sizes) == 2
+    assert [name for name, _, _ in context.sub_orchestrations] == ["vision_agent_orchestrator"] * 5
+    assert [instance_id for _, _, instance_id in context.sub_orchestrations] == [f"instance-{i}" for i in range(5)]
+    assert context.sub_orchestrations[0][1] == {"container": "floorplans",
+                                                "filename": "site-a/plan-0.png",
+                                                "reference_filename": "site-a/legend.png",
+                                                "analyze_prompt": "Test prompt",
+                                                "classification_batch_size": 4,
+                                                "save_results": True}
+    assert manifest["completed"] == 5 and manifest["failed"] == 0
+    assert [plan["filename"] for plan in manifest["plans"]] == filenames
+    assert all(plan["status"] == "Completed" and plan["detections"] == 2 for plan in manifest["plans"])
+    assert manifest["plans"][0]["duration_seconds"] == 60
+    assert manifest["plans"][0]["results_ref"]["blob"] == "results/site-a/plan-0.png.json"
+    assert saved == [manifest]
+    assert context.custom_status == {"total": 5, "completed": 5, "failed": 0, "running": 0, "pending": 0}
+
+def test_batch_orchestrator_continues_as_new_per_chunk(use_azure_functions_test_env):
+    """Test a large batch runs in chunks with a fresh history, carrying and saving the partial manifest"""
+    filenames = [f"plan-{i}.png" for i in range(7)]
+    saved = []
+    context = FakeOrchestrationContext(make_batch_input(max_concurrent_plans=2, chunk_size=3),
+                                       make_batch_activities(filenames, failing={"plan-4.png"}, saved=saved))
+    manifest, executions = run_until_complete(context, batch_floorplan_orchestrator)
+
+    assert executions == 3
+    # The plans are only listed once, the continued executions work from the carried manifest
+    assert [name for name, _ in context.activity_calls].count("list_floorplans") == 1
+    assert [input_["filename"] for _, input_, _ in context.sub_orchestrations] == filenames
+    assert [instance_id for _, _, instance_id in context.sub_orchestrations] == [f"instance-{i}" for i in range(7)]
+    assert [partial["completed"] + partial["failed"] for partial in saved] == [3, 6, 7]
+    assert saved[0]["plans"][3]["status"] == "Pending"
+    assert saved[-1] == manifest
+    assert manifest["completed"] == 6 and manifest["failed"] == 1
+    assert manifest["plans"][4]["status"] == "Failed"
+
+def test_batch_settings_are_resolved_at_start(use_azure_functions_test_env):
+    """Test the batch reads its chunking from its input, which continue_as_new carries over"""
+    filenames = [f"plan-{i}.png" for i in range(4)]
+    with patch.dict(os.environ, {"BATCH_CHUNK_SIZE": "2", "BATCH_MAX_CONCURRENT_PLANS": "1"}):
+        payload = resolve_settings("batch_floorplan_orchestrator", make_batch_input())
+    context = FakeOrchestrationContext(payload, make_batch_activities(filenames))
+    # A setting changed during the run doesn't change the chunks
+    with patch.dict(os.environ, {"BATCH_CHUNK_SIZE": "3", "BATCH_MAX_CONCURRENT_PLANS": "4"}):
+        manifest, executions = run_until_complete(context, batch_floorplan_orchestrator)
+
+    assert executions == 2
+    assert max(context.fan_out_sizes) == 1
+    assert context._payload["chunk_size"] == "2"
+    assert manifest["completed"] == 4
+
+def test_orchestrator_saves_results_for_batches(use_azure_functions_test_env):
+    """Test a plan run by a batch saves its results to blob storage and only returns a compact status"""
+    payload = {**make_orchestrator_input(), "save_results": True}
+    context = FakeOrchestrationContext(payload, make_pipeline_activities(10_000))
+    result = run_orchestrator(context)
+
+    assert result == {"results_ref": {"container": "floorplans", "blob": "results/instance.json",
+                                      "size": len(context.activity_calls[-1][1]), "etag": "0x3"},
+                      "detections": 5}
+    saved = json.loads(context.activity_calls[-1][1])
+    assert context.activity_calls[-1][0] == "save_plan_results"
+    assert len(saved["results"]["detections"]) == 5 and saved["results"]["summary"] == "Test summary"
+
+def test_batch_orchestrator_records_failed_plans(use_azure_functions_test_env):
+    """Test a failing plan is recorded in the manifest without stopping the others"""
+    filenames = ["plan-0.png", "plan-1.png", "plan-2.png"]
+    context = FakeOrchestrationContext(make_batch_input(max_concurrent_plans=1),
+                                       make_batch_activities(filenames, failing={"plan-1.png"}))
+    manifest = run_orchestrator(context, batch_floorplan_orchestrator)
+
+    assert [plan["status"] for plan in manifest["plans"]] == ["Completed", "Failed", "Completed"]
+    assert "Analysis failed for plan-1.png" in manifest["plans"][1]["error"]
+    assert manifest["completed"] == 2 and manifest["failed"] == 1
+
+def test_batch_orchestrator_completes_when_every_plan_fails(use_azure_functions_test_env):
+    """Test the batch still writes its manifest when every plan in a window fails"""
+    filenames = ["plan-0.png", "plan-1.png"]
+    context = FakeOrchestrationContext(make_batch_input(max_concurrent_plans=2),
+                                       make_batch_activities(filenames, failing=set(filenames)))
+    manifest = run_orchestrator(context, batch_floorplan_orchestrator)
+
+    assert [plan["status"] for plan in manifest["plans"]] == ["Failed", "Failed"]
+    assert manifest["completed"] == 0 and manifest["failed"] == 2
+
+def test_batch_orchestrator_resumes_previous_batch(use_azure_functions_test_env):
+    """Test resuming a batch only runs the plans that didn't complete"""
+    filenames = ["plan-0.png", "plan-1.png", "plan-2.png"]
+    previous_manifest = {"plans": [
+        {"filename": "plan-0.png", "status": "Completed", "detections": 2},
+        {"filename": "plan-1.png", "status": "Failed", "error": "boom"},
+        {"filename": "plan-2.png", "status": "Completed", "detections": 2}]}
+    context = FakeOrchestrationContext(make_batch_input(resume_from="previous"),
+                                       make_batch_activities(filenames, previous_manifest=previous_manifest))
+    manifest = run_orchestrator(context, batch_floorplan_orchestrator)
+
+    assert [input_["filename"] for _, input_, _ in context.sub_orchestrations] == ["plan-1.png"]
+    assert ("load_batch_manifest", json.dumps({"container": "floorplans", "instance_id": "previous"})) in context.activity_calls
+    assert manifest["completed"] == 3 and manifest["resumed"] == 2
+
+def test_list_floorplans_skips_reference_and_pipeline_blobs(use_azure_functions_test_env):
+    """Test list_floorplans only returns plan images under the prefix"""
+    names = ["site-a/plan-1.png", "site-a/legend.png", "site-a/notes.txt", "site-a/plan-0.JPG",
+             "crops/site-a/plan-1.png/0x1/0.jpg", "legends/abc", "site-a/reference-" + "a" * 64 + ".png"]
+    mock_container = MagicMock()
+    blobs = [MagicMock() for _ in names]
+    for blob, name in zip(blobs, names):
+        blob.name = name
+    mock_container.list_blobs.return_value = blobs
+    mock_service = MagicMock()
+    mock_service.get_container_client.return_value = mock_container
+
+    with patch('api.function_app.get_storage_client', return_value=mock_service):
+        result = list_floorplans(json.dumps({"container": "floorplans", "prefix": "", "exclude": ["site-a/legend.png"]}))
+
+    assert result == ["site-a/plan-0.JPG", "site-a/plan-1.png"]
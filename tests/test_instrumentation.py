@@ -0,0 +1,104 @@
+import pytest
+import os
+import sys
+import json
+import inspect
+import logging
+from unittest.mock import patch
+
+# Add the api directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'api'))
+import instrumentation
+from instrumentation import instrument_activity, collect_usage, payload_bytes
+
+@pytest.fixture(autouse=True)
+def reset_tracer():
+    instrumentation.tracer = None
+    worker_stats = instrumentation.worker_stats
+    instrumentation.set_worker_stats(None)
+    yield
+    instrumentation.tracer = None
+    instrumentation.set_worker_stats(worker_stats)
+
+def test_payload_bytes():
+    assert payload_bytes(None) == 0
+    assert payload_bytes(b"abc") == 3
+    assert payload_bytes("é") == 2
+    assert payload_bytes({"a": 1}) == len(json.dumps({"a": 1}))
+
+def test_collect_usage_sums_nested_results():
+    usage = {"estimated_prompt_tokens": 100, "prompt_tokens": 110, "completion_tokens": 5}
+    results = [[{"usage": usage}, {"model_response": "DOOR"}], [{"usage": usage}]]
+    assert collect_usage(results) == {"estimated_prompt_tokens": 200, "prompt_tokens": 220, "completion_tokens": 10}
+    assert collect_usage("summary") == {}
+
+def test_instrumented_activity_logs_metrics(caplog):
+    """The wrapped activity keeps its signature and result, its metrics are logged"""
+    @instrument_activity
+    def classify(activitypayload):
+        return {"model_response": "DOOR", "usage": {"prompt_tokens": 10, "completion_tokens": 1}}
+
+    assert list(inspect.signature(classify).parameters) == ["activitypayload"]
+    with caplog.at_level(logging.INFO, logger="pipeline.metrics"):
+        result = classify(activitypayload='{"image": "x"}')
+
+    assert result["model_response"] == "DOOR"
+    record = next(record for record in caplog.records if record.name == "pipeline.metrics")
+    assert "activity classify took" in record.getMessage()
+    assert record.metrics["input_bytes"] == len('{"image": "x"}')
+    assert record.metrics["output_bytes"] == payload_bytes(result)
+    assert record.metrics["prompt_tokens"] == 10
+
+def test_instrumented_activity_logs_worker_stats(caplog):
+    """The worker's client and token reuse counters are added to every activity's metrics"""
+    instrumentation.set_worker_stats(lambda: {"clients": {"storage": {"created": 1, "reused": 9}, "openai": {"created": 1, "reused": 4}},
+                                              "tokens": {"acquired": 1, "reused": 13}})
+
+    @instrument_activity
+    def read(activitypayload):
+        return "ok"
+
+    with caplog.at_level(logging.INFO, logger="pipeline.metrics"):
+        read("{}")
+
+    record = next(record for record in caplog.records if record.name == "pipeline.metrics")
+    assert record.metrics["clients.storage.reused"] == 9
+    assert record.metrics["tokens.acquired"] == 1
+    assert record.getMessage().endswith("SDK clients 2 created, 13 reused")
+
+def test_instrumented_activity_logs_failures(caplog):
+    @instrument_activity
+    def failing(activitypayload):
+        raise ValueError("boom")
+
+    with caplog.at_level(logging.INFO, logger="pipeline.metrics"), pytest.raises(ValueError):
+        failing("{}")
+    assert any("activity failing failed" in record.getMessage() for record in caplog.records)
+
+def test_instrumented_activity_exports_spans():
+    """With an exporter configured every activity call becomes a span"""
+    pytest.importorskip("opentelemetry.sdk")
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+
+    @instrument_activity
+    def detect(activitypayload):
+        return ["prediction"]
+
+    with patch.dict(os.environ, {"TELEMETRY_EXPORTER": "opentelemetry"}), \
+         patch("opentelemetry.trace.get_tracer", side_effect=lambda name, *args, **kwargs: provider.get_tracer(name)):
+        detect("{}")
+
+    span = exporter.get_finished_spans()[0]
+    assert span.name == "activity detect"
+    assert span.attributes["pipeline.activity"] == "detect"
+    assert span.attributes["pipeline.output_bytes"] == payload_bytes(["prediction"])
+
+def test_no_spans_without_exporter():
+    with patch.dict(os.environ, {"TELEMETRY_EXPORTER": "none"}):
+        assert instrumentation.get_tracer() is None
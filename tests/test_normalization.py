@@ -0,0 +1,69 @@
+import pytest
+import os
+import sys
+import io
+from PIL import Image, ImageDraw
+
+# Add the api directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'api'))
+from normalization import downscale, convert_color, encode_image, normalize_image, is_identity
+
+def make_line_drawing(size=(3000, 2000)):
+    """Black lines on white, like a scanned floorplan saved as RGB"""
+    image = Image.new('RGB', size, color='white')
+    draw = ImageDraw.Draw(image)
+    for offset in range(0, size[0], 150):
+        draw.line([(offset, 0), (offset, size[1])], fill='black', width=4)
+        draw.rectangle([offset + 40, 200, offset + 80, 240], outline='black', width=3)
+    return image
+
+def test_downscale_keeps_aspect_ratio():
+    """Test the longest side is capped and smaller images are left alone"""
+    image = make_line_drawing()
+    assert downscale(image, 1500).size == (1500, 1000)
+    assert downscale(image, 0) is image
+    assert downscale(image, 4000) is image
+
+def test_normalized_boxes_still_apply_to_the_original():
+    """Test a box found on the downscaled image covers the same symbol on the original"""
+    image = Image.new('L', (3000, 2000), color=255)
+    ImageDraw.Draw(image).rectangle([1500, 1000, 1599, 1099], fill=0)
+    small = downscale(image, 750)
+    ink = Image.eval(small, lambda p: 255 - p).point(lambda p: 255 if p > 127 else 0).getbbox()
+    box = [ink[0] / small.width, ink[1] / small.height, ink[2] / small.width, ink[3] / small.height]
+    assert box == pytest.approx([0.5, 0.5, 0.5333, 0.55], abs=0.002)
+
+def test_grayscale_and_palette_shrink_line_drawings():
+    """Test dropping the color channels cuts the encoded size of line art"""
+    image = make_line_drawing((1200, 800))
+    original = len(encode_image(image, "PNG"))
+    grayscale = normalize_image(image, color_mode="grayscale")
+    palette = normalize_image(image, color_mode="palette", palette_colors=4)
+
+    assert Image.open(io.BytesIO(grayscale)).mode == "L"
+    assert Image.open(io.BytesIO(palette)).mode == "P"
+    assert len(grayscale) < original
+    assert len(palette) < original
+
+def test_crop_format_and_quality():
+    """Test crops are encoded in the requested format and quality"""
+    crop = make_line_drawing((300, 200))
+    high = normalize_image(crop, image_format="JPEG", quality=95)
+    low = normalize_image(crop, image_format="JPEG", quality=40)
+    png = normalize_image(crop, max_side=100, color_mode="grayscale", image_format="PNG")
+
+    assert len(low) < len(high)
+    assert Image.open(io.BytesIO(png)).format == "PNG"
+    assert Image.open(io.BytesIO(png)).size == (100, 67)
+
+def test_unknown_color_mode():
+    with pytest.raises(ValueError):
+        convert_color(make_line_drawing((10, 10)), "sepia")
+
+def test_is_identity():
+    assert is_identity()
+    assert is_identity(max_side=0, color_mode="rgb", image_format="JPEG", palette_colors=16)
+    assert not is_identity(max_side=1024)
+    assert not is_identity(color_mode="grayscale")
+    assert not is_identity(image_format="PNG")
+    assert not is_identity(quality=60)
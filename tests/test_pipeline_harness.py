@@ -0,0 +1,48 @@
+import pytest
+import os
+import sys
+import importlib.util
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+PLANS_DIR = os.path.join(ROOT_DIR, 'SampleDocs', 'FloorPlans')
+LEGENDS_DIR = os.path.join(ROOT_DIR, 'SampleDocs', 'DesignElements')
+
+def import_harness():
+    spec = importlib.util.spec_from_file_location("pipeline_harness", os.path.join(ROOT_DIR, "scripts", "pipeline_harness.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope="module")
+def harness():
+    return import_harness()
+
+def sample_plans(count):
+    return [os.path.join(PLANS_DIR, name) for name in sorted(os.listdir(PLANS_DIR)) if name.endswith(".png")][:count]
+
+def test_harness_runs_plans_offline(harness):
+    """The real orchestrator runs end to end against the local stand-ins"""
+    report = harness.run_harness(sample_plans(2), [os.path.join(LEGENDS_DIR, "floorplan_legend.png")],
+                                 detections_per_plan=6)
+
+    assert report["plans"] == 2
+    assert report["completed"] == 2
+    assert report["failed"] == []
+    assert report["plans_per_minute"] > 0
+    assert 0 < report["latency_p50"] <= report["latency_p95"]
+    assert report["detections"] > 0
+    for stage in ("read_image", "object_detection", "deduplicate_predictions", "register_legend",
+                  "crop_detections", "azure_openai_processing", "summarize_results"):
+        assert report["stages"][stage]["calls"] > 0
+    assert report["stages"]["object_detection"]["blob_read_bytes"] > 0
+    assert report["stages"]["crop_detections"]["blob_written_bytes"] > 0
+    assert report["openai"]["requests"] > 0
+    assert "plans/min" in harness.format_report(report)
+
+def test_harness_recovers_from_throttling(harness):
+    """Injected 429s are backed off and retried, the plans still complete"""
+    report = harness.run_harness(sample_plans(1), [os.path.join(LEGENDS_DIR, "floorplan_legend.png")],
+                                 detections_per_plan=8, throttle_rate=0.3, retry_after_ms=10, seed=1)
+
+    assert report["completed"] == 1
+    assert report["openai"]["throttled"] > 0
@@ -0,0 +1,58 @@
+import pytest
+import os
+import sys
+import io
+import numpy as np
+from PIL import Image
+
+# Add the api directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'api'))
+from template_matching import segment_legend, crop_descriptor, best_match, runs
+
+LEGEND_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'SampleDocs', 'DesignElements', 'floorplan_legend.png')
+
+@pytest.fixture(scope="module")
+def legend():
+    return Image.open(LEGEND_PATH)
+
+def crop_bytes(image, box, rotate=0, scale=1.0, buffer=10):
+    left, top, right, bottom = box
+    crop = image.crop((left - buffer, top - buffer, right + buffer, bottom + buffer)).convert('RGB').rotate(rotate, expand=True)
+    crop = crop.resize((round(crop.width * scale), round(crop.height * scale)))
+    output = io.BytesIO()
+    crop.save(output, format='JPEG')
+    return output.getvalue()
+
+def test_runs_joins_small_gaps():
+    flags = np.array([1, 1, 0, 1, 0, 0, 0, 1], dtype=bool)
+    assert runs(flags) == [(0, 2), (3, 4), (7, 8)]
+    assert runs(flags, max_gap=1) == [(0, 4), (7, 8)]
+
+def test_segment_legend_splits_symbols_and_labels(legend):
+    """The sample legend has a sofa, a chair and a door, each with its label to the right"""
+    entries = segment_legend(legend)
+
+    assert len(entries) == 3
+    for entry in entries:
+        glyph_left, _, glyph_right, _ = entry["glyph_box"]
+        label_left, _, _, _ = entry["label_box"]
+        assert glyph_right < label_left
+        assert entry["descriptor"].shape == (32 * 32,)
+    # Rows top to bottom
+    assert [entry["glyph_box"][1] for entry in entries] == sorted(entry["glyph_box"][1] for entry in entries)
+
+def test_crops_match_their_legend_symbol(legend):
+    """A rotated and scaled crop of a symbol correlates with its own glyph and not the others"""
+    entries = segment_legend(legend)
+    descriptors = [entry["descriptor"] for entry in entries]
+    for index, entry in enumerate(entries):
+        match, score = best_match(crop_descriptor(crop_bytes(legend, entry["glyph_box"], rotate=90, scale=0.5)), descriptors)
+        assert match == index
+        assert score > 0.9
+
+def test_blank_crop_has_no_match():
+    output = io.BytesIO()
+    Image.new('RGB', (40, 40), color='white').save(output, format='PNG')
+    descriptor = crop_descriptor(output.getvalue())
+    assert descriptor is None
+    assert best_match(descriptor, [np.ones(32 * 32)]) == (None, 0.0)
@@ -0,0 +1,43 @@
+import pytest
+import os
+import sys
+import io
+import base64
+from PIL import Image
+
+# Add the api directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'api'))
+from vision_tokens import estimate_image_tokens, estimate_text_tokens, choose_detail, data_url_image_size
+
+def test_estimate_image_tokens():
+    """Test the estimates follow the tiling of high detail images"""
+    assert estimate_image_tokens(40, 40, "low") == 85
+    assert estimate_image_tokens(40, 40) == 255
+    assert estimate_image_tokens(1024, 1024) == 765
+    # Scaled to 2048x1024 then to 1536x768: 3x2 tiles
+    assert estimate_image_tokens(4096, 2048) == 1105
+
+def test_small_crops_use_low_detail():
+    """Test symbol crops that fit the low detail view don't pay for tiles"""
+    assert choose_detail(40, 40) == {"detail": "low", "size": None, "tokens": 85}
+    assert choose_detail(512, 300)["detail"] == "low"
+    assert choose_detail(600, 300, low_detail_max_side=256)["detail"] == "high"
+
+def test_large_images_shrink_to_the_budget():
+    """Test an image above its token budget is resized until it fits"""
+    assert choose_detail(2000, 2000) == {"detail": "high", "size": None, "tokens": 765}
+    choice = choose_detail(2000, 2000, max_tokens=400)
+    assert choice == {"detail": "high", "size": (512, 512), "tokens": 255}
+    # A budget below one tile falls back to low detail
+    assert choose_detail(2000, 2000, max_tokens=100)["detail"] == "low"
+
+def test_estimate_text_tokens():
+    assert estimate_text_tokens("") == 0
+    assert estimate_text_tokens("a" * 400) == 100
+
+def test_data_url_image_size():
+    image_io = io.BytesIO()
+    Image.new('RGB', (120, 80)).save(image_io, format='PNG')
+    data_url = "data:image/png;base64," + base64.b64encode(image_io.getvalue()).decode()
+    assert data_url_image_size(data_url) == (120, 80)
+    assert data_url_image_size("data:image/png;base64,AAAA") is None